@@ -0,0 +1,58 @@
+# Copyright 2014-2025 Carnegie Mellon University
+
+"""Times Agent.instances_frame() with each engine, for agents of various sizes.
+
+Usage: python benchmarks/instances_frame.py [instances ...]
+
+Each agent is prepopulated with the given number of instances, by default 20,000 and
+200,000, either spread among 100 choices, or each of a distinct choice, the latter being
+the worst case for the "array" engine, which must then gather the arrays of a separate
+group for every instance.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pyibl import Agent
+
+CHOICES = 100
+REPEATS = 5
+
+
+def run(instances, engine, distinct):
+    a = Agent(["x", "y"], engine=engine, seed=1)
+    rnd = random.Random(1)
+    if distinct:
+        a.populate_many([{"x": i % 500, "y": i // 500, "outcome": rnd.random()}
+                         for i in range(instances)])
+    else:
+        a.populate_many([{"x": i % CHOICES, "y": 0, "outcome": i // CHOICES}
+                         for i in range(instances)])
+    for i in range(CHOICES):
+        a.choose([{"x": 1, "y": 0}, {"x": 2, "y": 0}])
+        a.respond(rnd.random())
+    timings = []
+    for i in range(REPEATS):
+        start = time.perf_counter()
+        a.instances_frame()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(sizes):
+    variants = {"pyactup": ("pyactup", False),
+                "array": ("array", False),
+                "pyactup+distinct": ("pyactup", True),
+                "array+distinct": ("array", True)}
+    print(f"{'instances':>10}" + "".join(f"{k:>18}" for k in variants))
+    for instances in sizes:
+        timings = [run(instances, *v) for v in variants.values()]
+        print(f"{instances:>10}" + "".join(f"{t:>17.3f}s" for t in timings))
+
+
+if __name__ == "__main__":
+    main([int(s) for s in sys.argv[1:]] or [20_000, 200_000])
@@ -0,0 +1,52 @@
+# Copyright 2014-2025 Carnegie Mellon University
+
+"""Times choices of a partially matching agent with each engine, with and without domains.
+
+Usage: python benchmarks/partial_matching.py [values ...]
+
+Each agent is prepopulated with one instance for every pair of values of two partially
+matched attributes, each taking one of the given number of values; by default 10 and 30
+values are used, giving 100 and 900 instances.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pyibl import Agent, positive_linear_similarity
+
+CHOICES = 100
+OPTIONS = 4
+
+
+def run(values, engine, domain):
+    a = Agent(["x", "y"], engine=engine, mismatch_penalty=1, seed=1)
+    domain_values = list(range(1, values + 1))
+    a.similarity(["x", "y"], positive_linear_similarity,
+                 domain=(domain_values if domain else None))
+    pairs = [{"x": x, "y": y} for x in domain_values for y in domain_values]
+    a.populate(pairs, 10)
+    rnd = random.Random(2)
+    start = time.perf_counter()
+    for i in range(CHOICES):
+        a.choose(rnd.sample(pairs, OPTIONS))
+        a.respond(rnd.random() * 10)
+    return time.perf_counter() - start
+
+
+def main(sizes):
+    variants = {"pyactup": ("pyactup", False),
+                "pyactup+domain": ("pyactup", True),
+                "array": ("array", False),
+                "array+domain": ("array", True)}
+    print(f"{'instances':>10}" + "".join(f"{k:>16}" for k in variants))
+    for values in sizes:
+        timings = [run(values, *v) for v in variants.values()]
+        print(f"{values**2:>10}" + "".join(f"{t:>15.3f}s" for t in timings))
+
+
+if __name__ == "__main__":
+    main([int(s) for s in sys.argv[1:]] or [10, 30])
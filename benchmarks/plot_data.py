@@ -0,0 +1,65 @@
+# Copyright 2014-2025 Carnegie Mellon University
+
+"""Times the extraction of plot data from synthetic aggregate details of various sizes.
+
+Usage: python benchmarks/plot_data.py [rows ...]
+
+By default aggregates of 10^5, 10^6 and 10^7 rows are used.
+"""
+
+import numpy as np
+import os
+import pandas as pd
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pyibl import ChoicePlot, OptionPlot, InstancePlot, AGGREGATE_COLUMNS
+
+OPTIONS = ["safe", "risky", "medium"]
+UTILITIES = [0.0, 1.0, 3.0, 4.0, 10.0]
+ROUNDS = 100
+INSTANCES_PER_ROUND = 10
+
+
+def synthetic_aggregate(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    decisions = rows // INSTANCES_PER_ROUND
+    iterations = np.repeat(np.arange(decisions) // ROUNDS + 1, INSTANCES_PER_ROUND)
+    times = np.repeat(np.arange(decisions) % ROUNDS + 1, INSTANCES_PER_ROUND)
+    n = len(times)
+    choices = np.repeat(rng.integers(len(OPTIONS), size=decisions), INSTANCES_PER_ROUND)
+    options = rng.integers(len(OPTIONS), size=n)
+    utilities = np.array(UTILITIES)[rng.integers(len(UTILITIES), size=n)]
+    categories = pd.Index(OPTIONS, dtype=object)
+    return pd.DataFrame({"iteration": iterations,
+                         "time": times,
+                         "choice": pd.Categorical.from_codes(choices, categories),
+                         "utility": utilities,
+                         "option": pd.Categorical.from_codes(options, categories),
+                         "blended_value": rng.normal(3, 1, n),
+                         "retrieval_probability": rng.random(n),
+                         "activation": rng.normal(0, 1, n),
+                         "base_level_activation": rng.normal(0, 1, n),
+                         "activation_noise": rng.logistic(0, 0.25, n)},
+                        columns=AGGREGATE_COLUMNS)
+
+
+def main(sizes):
+    plots = {"choice": ChoicePlot("choice", ""),
+             "bv": OptionPlot("blended_value", ""),
+             "activation": InstancePlot("activation", "")}
+    print(f"{'rows':>10}" + "".join(f"{k:>14}" for k in plots))
+    for rows in sizes:
+        df = synthetic_aggregate(rows)
+        timings = []
+        for p in plots.values():
+            start = time.perf_counter()
+            p.get_data(df, None, None, None, None, None, None)
+            timings.append(time.perf_counter() - start)
+        print(f"{len(df):>10}" + "".join(f"{t:>13.3f}s" for t in timings))
+
+
+if __name__ == "__main__":
+    main([int(float(s)) for s in sys.argv[1:]] or [10**5, 10**6, 10**7])
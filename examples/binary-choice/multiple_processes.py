@@ -1,11 +1,9 @@
 # Copyright 2024–2025 Carnegie Mellon University
 # Binary choice example using PyIBL and multiple processes
 
-from alhazen import IteratedExperiment
 import matplotlib.pyplot as plt
 import numpy as np
-from pyibl import Agent
-from random import random
+from pyibl import Agent, Experiment
 
 HIGH_PAYOUTS = [4, 6, 12]
 SAFE_PAYOUT = 3
@@ -13,35 +11,33 @@ PLOT_FILE = "binary-choice.png"
 ROUNDS = 60
 PARTICIPANTS = 10_000
 PREPOPULATED_MULTIPLIER = 1.2
-PROCESSES = 0
-
-class BinaryChoice(IteratedExperiment):
-
-    def prepare_condition(self, condition, context):
-        context["high-probability"] = SAFE_PAYOUT / condition
-
-    def run_participant_prepare(self, participant, condition, context):
-        self.agent = Agent(default_utility=(PREPOPULATED_MULTIPLIER * condition))
-
-    def run_participant_run(self, round, participant, condition, context):
-        choice = self.agent.choose(["safe", "risky"])
-        if choice == "safe":
-            payoff = SAFE_PAYOUT
-        elif random() < context["high-probability"]:
-            payoff = condition
-        else:
-            payoff = 0
-        self.agent.respond(payoff)
-        return int(choice == "risky")
+PROCESSES = None
+SEED = 1
+
+def make_agent(condition):
+    return Agent(default_utility=(PREPOPULATED_MULTIPLIER * condition))
+
+def run_round(agent, condition, round, rng):
+    choice = agent.choose(["safe", "risky"])
+    if choice == "safe":
+        payoff = SAFE_PAYOUT
+    elif rng.random() < SAFE_PAYOUT / condition:
+        payoff = condition
+    else:
+        payoff = 0
+    agent.respond(payoff)
+    return int(choice == "risky")
 
 def main():
-      exp = BinaryChoice(rounds=ROUNDS,
-                         conditions=HIGH_PAYOUTS,
-                         participants=PARTICIPANTS,
-                         process_count=PROCESSES)
+      exp = Experiment(make_agent, run_round,
+                       conditions=HIGH_PAYOUTS,
+                       participants=PARTICIPANTS,
+                       rounds=ROUNDS,
+                       seed=SEED,
+                       workers=PROCESSES)
       results = exp.run()
-      for condition in exp.conditions:
-          plt.plot(range(1, ROUNDS + 1), np.mean(np.asarray(results[condition]), axis=0),
+      for condition, result in zip(exp.conditions, results):
+          plt.plot(range(1, ROUNDS + 1), np.mean(result, axis=0),
                    label=f"risky high payoff = {condition} points")
       plt.xticks([1] + [10 * n for n in range(1, round((ROUNDS + 10) / 10))])
       plt.ylim([0, 1])
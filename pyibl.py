@@ -9,7 +9,7 @@ facilities for inspecting details of the IBL decision making process programmati
 facilitating debugging, logging and fine grained control of complex models.
 """
 
-__version__ = "5.2.1"
+__version__ = "5.3.0"
 
 PYACTUP_MINIMUM_VERSION = "2.2.3"
 
@@ -17,21 +17,32 @@ if "dev" in __version__:
     print("PyIBL version", __version__)
 
 import collections.abc as abc
+import contextlib
+import copy
 import csv
+import functools
 import io
+import json
 import math
 import matplotlib.pyplot as plt
 import numbers
 import numpy as np
 import os
 import pandas as pd
+import pickle
 import pyactup
+import pylru
+import queue
 import random
+import struct
 import sys
+import threading
 import warnings
 
-from collections import Counter, defaultdict
-from itertools import count
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import chain, compress, count, product, repeat
+from operator import attrgetter, itemgetter
 from numbers import Real
 from packaging import version
 from prettytable import PrettyTable
@@ -45,7 +56,8 @@ warnings.formatwarning = (lambda message, category, filename, lineno, line=None:
 if version.parse(pyactup.__version__) < version.parse(PYACTUP_MINIMUM_VERSION):
     warn(f"PyACTUp version {pyactup.__version__} is older than that required by this version of PyIBL")
 
-__all__ = ["Agent", "DelayedResponse",
+__all__ = ["Agent", "DelayedResponse", "Cohort", "Experiment", "ParquetSink", "CSVSink",
+           "AggregateRecorder", "AggregateSummary", "DetailsPolicy", "TraceWriter", "print_trace", "fit",
            "positive_linear_similarity", "positive_quadratic_similarity",
            "bounded_linear_similarity", "bounded_quadratic_similarity"]
 
@@ -56,6 +68,39 @@ AGGREGATE_COLUMNS = tuple(("iteration,time,choice,utility,option,blended_value,"
                            "retrieval_probability,activation,base_level_activation,"
                            "activation_noise").split(","))
 
+SUMMARY_COLUMNS = ("statistic", "time", "option", "utility", "count", "sum", "sum_of_squares")
+
+AGGREGATE_CHUNK_ROWS = 65536
+AGGREGATE_SINK_FLUSH_ROWS = 100_000
+AGGREGATE_SINK_QUEUE_SIZE = 4
+
+TRACE_BUFFER_RECORDS = 1000
+
+COHORT_INITIAL_INSTANCES = 8
+COHORT_INITIAL_REFERENCES = 64
+COHORT_GROWTH_FACTOR = 2
+
+ARRAY_MEMORY_INITIAL_SIZE = 16
+ARRAY_MEMORY_GROWTH_FACTOR = 2
+
+ENGINES = ("pyactup", "array")
+
+EVICTION_INTERVAL = 100
+EVICTION_RETAINED = 0.9
+
+ACTIVATION_TOLERANCE = 1e-3
+REFERENCE_COARSENING_MINIMUM = 256
+REFERENCE_COARSENING_FACTOR = 2
+
+SNAPSHOT_MAGIC = b"PyIBL\x00snapshot"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ALIGNMENT = 64
+
+EXPERIMENT_CHUNKS_PER_WORKER = 4
+
+LAG_TABLE_INITIAL_SIZE = 1024
+LAG_TABLE_GROWTH_FACTOR = 2
+
 PLOT_COLORS = "blue,green,red,black,magenta,orange,cyan".split(",")
 PLOT_LINE_STYLES = ("-", "--", ":", "-.", (0, (3, 6)),  (5, (10, 3)), (0, (3, 2, 1, 2)),
                     (0, (3, 3, 2, 3)))
@@ -77,8 +122,21 @@ class Agent:
 
     The agent properties :attr:`noise`, :attr:`decay`, :attr:`temperature`,
     :attr:`mismatch_penalty`, :attr:`optimized_learning`, :attr:`default_utility`,
-    :attr:`default_utility_populates` and :attr:`fixed_noise` can be initialized when
-    creating an Agent.
+    :attr:`default_utility_populates`, :attr:`fixed_noise`, :attr:`retrieval_epsilon`,
+    :attr:`max_instances`, :attr:`evict_below_activation` and
+    :attr:`activation_tolerance` can be initialized when creating an Agent.
+
+    The *engine* determines how the agent's instances are stored, and cannot be changed
+    after the agent is created. If it is ``"pyactup"``, the default, each instance is a
+    separate PyACTUp chunk. If it is ``"array"`` the instances of each choice are held
+    together in NumPy arrays, and their activations computed in a single pass, which can
+    be considerably faster for agents with many instances, particularly when partial
+    matching attributes with a *domain* declared (see :meth:`similarity`). In all other
+    respects agents using the two engines behave identically. If *engine* is not one of
+    these two strings a :exc:`ValueError` is raised.
+
+    The random number generator used by the agent can be determined by supplying either
+    a *seed* or an *rng*, but not both; see :attr:`rng`.
 
     """
 
@@ -94,30 +152,59 @@ class Agent:
                  optimized_learning=False,
                  default_utility=None,
                  default_utility_populates=True,
-                 fixed_noise=False):
+                 fixed_noise=False,
+                 engine="pyactup",
+                 seed=None,
+                 rng=None,
+                 retrieval_epsilon=None,
+                 max_instances=None,
+                 evict_below_activation=None,
+                 activation_tolerance=ACTIVATION_TOLERANCE):
         self._attributes = pyactup.Memory._ensure_slot_names(attributes)
+        if engine not in ENGINES:
+            raise ValueError(f"The engine, {engine}, is not one of {', '.join(ENGINES)}")
+        self._engine = engine
         if name is None:
             Agent._agent_number += 1
             name = f"agent-{Agent._agent_number}"
         elif not (isinstance(name, str) and len(name) > 0):
             raise TypeError(f"Agent name {name} is not a non-empty string")
         self._name = name
-        self._memory = pyactup.Memory(optimized_learning=optimized_learning,
-                                      threshold=None,
-                                      index=(self._attributes or ("_decision",)))
+        self._memory = (_ArrayMemory if engine == "array" else pyactup.Memory)(
+            optimized_learning=(False if optimized_learning == "auto" else optimized_learning),
+            threshold=None,
+            index=(self._attributes or ("_decision",)))
         self.temperature = temperature # set temperature BEFORE noise
         self.noise = noise
         self.decay = decay
         self.mismatch_penalty = mismatch_penalty
+        self.retrieval_epsilon = retrieval_epsilon
+        self.max_instances = max_instances
+        self.evict_below_activation = evict_below_activation
+        self.activation_tolerance = activation_tolerance
+        if optimized_learning == "auto":
+            self.optimized_learning = optimized_learning
         self.default_utility = default_utility
         self.default_utility_populates = default_utility_populates
         self._details = None
+        self._details_policy = None
+        self._details_options = None
+        self._details_participant = 0
+        self._details_choices = 0
         self._aggregate_details = None
-        self._aggregate_similarities = False
         self._aggregate_iteration = 0
         self._trace = False
+        self._trace_participant = 0
+        self._trace_choices = 0
         self._fixed_noise = fixed_noise
         self._weights = {}
+        self._explicit_rng = False
+        if seed is not None:
+            if rng is not None:
+                raise ValueError("Only one of seed and rng may be supplied")
+            rng = np.random.default_rng(seed)
+        if rng is not None:
+            self.rng = rng
         self.reset()
         self._test_default_utility()
 
@@ -145,8 +232,16 @@ class Agent:
         """
         return self._attributes
 
+    @property
+    def engine(self):
+        """The name of the engine used to store this agent's instances, either ``"pyactup"`` or ``"array"``.
+        This is set when the agent is created, and cannot be changed thereafter.
+        """
+        return self._engine
+
     def _preferred_index(self):
-        return [a for a in self.attributes if not self._memory._similarities.get(a)]
+        return [a for a in (self.attributes or ["_decision"])
+                if not self._memory._similarities.get(a)]
 
     def reset(self, preserve_prepopulated=False):
         """Erases this agent's memory and resets its time to zero.
@@ -162,6 +257,15 @@ class Agent:
         self._previous_choices = None
         self._pending_decision = None
         self._aggregate_iteration += 1
+        self._trace_participant += 1
+        self._trace_choices = 0
+        self._details_participant += 1
+        self._details_choices = 0
+        if self._engine == "array":
+            self._memory._pruned = 0
+        self._evicted_instances = 0
+        self._evicted_activation = None
+        self._next_eviction = EVICTION_INTERVAL
 
     @property
     def time(self):
@@ -266,6 +370,41 @@ class Agent:
     def fixed_noise(self, value):
         self._fixed_noise = bool(value)
 
+    @property
+    def rng(self):
+        """The NumPy :class:`numpy.random.Generator` from which this agent's activation noise is drawn.
+        If it has been set, either explicitly or by supplying a *seed* or *rng* when the
+        agent was created, ties between choices with the same blended value are also
+        broken by drawing from it, so that an agent whose generator has been seeded makes
+        the same sequence of choices whatever other random numbers are being drawn
+        elsewhere, for example by other agents in the same process. Otherwise, as in
+        earlier versions of PyIBL, the generator is itself seeded from Python's
+        :mod:`random` module when the agent is created, and ties are broken using
+        :func:`random.choice`. The generator is not affected by :meth:`reset`.
+
+        Setting this to ``None`` replaces the generator with a fresh one seeded from
+        Python's :mod:`random` module, and restores the default tie breaking. Attempting to
+        set it to anything other than ``None`` or a :class:`numpy.random.Generator` raises
+        a :exc:`ValueError`.
+        """
+        return self._memory._rng
+
+    @rng.setter
+    def rng(self, value):
+        if value is None:
+            self._memory._rng = np.random.default_rng(random.getrandbits(128))
+            self._explicit_rng = False
+        elif isinstance(value, np.random.Generator):
+            self._memory._rng = value
+            self._explicit_rng = True
+        else:
+            raise ValueError(f"The rng, {value}, is not a numpy.random.Generator")
+
+    def _random_choice(self, seq):
+        if self._explicit_rng:
+            return seq[self._memory._rng.integers(len(seq))]
+        return random.choice(seq)
+
     @property
     def temperature(self):
         """The temperature parameter used for blending values.
@@ -324,6 +463,191 @@ class Agent:
         self._memory.mismatch = v
         self._test_default_utility()
 
+    @property
+    def retrieval_epsilon(self):
+        """How far instances left out of blending may move a blended value, or ``None``.
+        When partially matching, every instance in memory is typically considered when
+        computing the blended value of every choice, though many may have retrieval
+        probabilities so small that they contribute nothing noticeable. If this is a
+        positive real number :meth:`choose` bounds the activations of the instances from
+        above, using their base level activations and noise together with the best
+        possible similarities of their partially matched attributes, and skips computing
+        the similarities of, and blending, those whose combined retrieval probability,
+        times the range of the utilities considered, is at most this value. Each blended
+        value is thus within :attr:`retrieval_epsilon` of the value that would have been
+        computed without skipping. Only similarities that must be computed by calling a
+        similarity function once for each instance are skipped: those of attributes with
+        a declared *domain*, or with one of the similarity functions supplied by PyIBL,
+        are computed for all instances at once. If any partially matched attribute uses a
+        similarity function returned by :func:`bounded_linear_similarity` or
+        :func:`bounded_quadratic_similarity`, and its value in the choice is a real
+        number, instances are instead found from an index of that attribute's values
+        sorted, and only those whose values are near enough to that of the choice to
+        possibly matter are considered at all; if none can be skipped in this way every
+        instance is considered. This helps most when similarity falls off steeply compared
+        to the :attr:`temperature`. The number of instances skipped by the most recent
+        call of :meth:`choose` is available as :attr:`pruned_instances`.
+
+        This is only supported by agents using the ``"array"`` :attr:`engine`. Attempting
+        to set it for an agent using the ``"pyactup"`` engine to a value other than
+        ``None``, or to set it to a value other than ``None`` or a positive real number,
+        raises a :exc:`ValueError`.
+        """
+        return self._retrieval_epsilon
+
+    @retrieval_epsilon.setter
+    def retrieval_epsilon(self, value):
+        if value is False:
+            value = None
+        if value is not None:
+            if not isinstance(value, Real) or not value > 0:
+                raise ValueError(f"The retrieval_epsilon, {value}, is neither a positive "
+                                 f"real number nor None")
+            if self._engine != "array":
+                raise ValueError("The retrieval_epsilon is only supported by the array engine")
+        self._retrieval_epsilon = value
+        if self._engine == "array":
+            self._memory._retrieval_epsilon = value
+
+    @property
+    def pruned_instances(self):
+        """The number of instances skipped because of :attr:`retrieval_epsilon` by the most recent call of :meth:`choose`.
+        This is the sum over all the choices considered by that call. It is zero if no
+        instances were skipped, or if :meth:`choose` has not been called since the agent
+        was created or last :meth:`reset`.
+        """
+        return self._memory._pruned if self._engine == "array" else 0
+
+    @property
+    def max_instances(self):
+        """The greatest number of instances this agent retains in memory, or ``None``.
+        If this is a positive integer, whenever :meth:`choose` is called with more than
+        this many instances in memory those with the lowest base level activations at
+        the current time are evicted, that is, removed from memory, until only
+        ``EVICTION_RETAINED`` (by default 0.9) times this many remain, so that evictions
+        happen only periodically. Ties are broken by evicting the oldest instances first.
+        If it is ``None``, the default, instances are never evicted for this reason.
+
+        Instances that are evicted are gone: if the same choice and outcome are later
+        experienced again a new instance is created. The number of instances evicted is
+        available as :attr:`evicted_instances`, and the greatest base level activation any
+        of them had when evicted as :attr:`evicted_activation`, which bounds how much they
+        could have contributed to later choices; see :attr:`evict_below_activation`.
+
+        Attempting to set this to a value other than ``None`` or a positive integer
+        raises a :exc:`ValueError`.
+        """
+        return self._max_instances
+
+    @max_instances.setter
+    def max_instances(self, value):
+        if value is False:
+            value = None
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool)
+                                  or value < 1):
+            raise ValueError(f"The max_instances, {value}, is neither a positive integer "
+                             f"nor None")
+        self._max_instances = value
+
+    @property
+    def evict_below_activation(self):
+        """A base level activation below which instances are evicted from memory, or ``None``.
+        If this is a real number, then when :meth:`choose` is first called at least
+        ``EVICTION_INTERVAL`` (by default 100) time units after the previous such check,
+        or after the agent was created or last :meth:`reset`, every instance whose base
+        level activation at the current time is below this value is removed from memory.
+        As base level activations only decrease with time unless an instance is
+        reinforced, an evicted instance with base level activation *b* would, were it
+        retained, have had a retrieval probability less than
+        ``exp((b - a) / temperature)`` in any later choice in which another instance of
+        base level activation *a* at that time was also consulted, before adding noise
+        and mismatch penalties. The greatest such *b* of all the instances evicted is
+        available as :attr:`evicted_activation`, and their number as
+        :attr:`evicted_instances`. This may be combined with :attr:`max_instances`.
+
+        Attempting to set this to a value other than ``None`` or a real number raises a
+        :exc:`ValueError`.
+        """
+        return self._evict_below_activation
+
+    @evict_below_activation.setter
+    def evict_below_activation(self, value):
+        if value is False:
+            value = None
+        if value is not None and not isinstance(value, Real):
+            raise ValueError(f"The evict_below_activation, {value}, is neither a real "
+                             f"number nor None")
+        self._evict_below_activation = value
+
+    @property
+    def evicted_instances(self):
+        """The number of instances evicted from memory since this agent was created or last :meth:`reset`.
+        See :attr:`max_instances` and :attr:`evict_below_activation`.
+        """
+        return self._evicted_instances
+
+    @property
+    def evicted_activation(self):
+        """The greatest base level activation, when evicted, of any instance evicted since this agent was created or last :meth:`reset`.
+        It is ``None`` if no instances have been evicted. See :attr:`max_instances` and
+        :attr:`evict_below_activation`.
+        """
+        return self._evicted_activation
+
+    def _base_level_activations(self):
+        # Returns a list of the live instances, and an array of their base level
+        # activations at the current time.
+        m = self._memory
+        if self._engine == "array":
+            return m._live_base_levels()
+        saved = (m._noise, m._mismatch, m._activation_history)
+        try:
+            m._noise = 0
+            m._mismatch = None
+            m._activation_history = None
+            activations, chunks, n = m._activations({}, partial=False)
+        finally:
+            m._noise, m._mismatch, m._activation_history = saved
+        if activations is None:
+            return [], np.empty(0)
+        return list(chunks), activations
+
+    def _evict(self):
+        m = self._memory
+        full = self._max_instances is not None and len(m) > self._max_instances
+        due = (self._evict_below_activation is not None and m.time >= self._next_eviction)
+        if not (full or due):
+            return
+        if due:
+            self._next_eviction = m.time + EVICTION_INTERVAL
+        instances, activations = self._base_level_activations()
+        evicted = np.zeros(len(instances), dtype=bool)
+        if self._evict_below_activation is not None:
+            evicted = activations < self._evict_below_activation
+        if full:
+            retained = int(self._max_instances * EVICTION_RETAINED)
+            if (excess := len(instances) - int(evicted.sum()) - retained) > 0:
+                order = np.argsort(np.where(evicted, np.inf, activations), kind="stable")
+                evicted[order[:excess]] = True
+        if not evicted.any():
+            return
+        victims = [c for c, e in zip(instances, evicted.tolist()) if e]
+        if self._engine == "array":
+            m._remove(victims)
+        else:
+            doomed = set(map(id, victims))
+            for c in victims:
+                del m[pyactup.Memory._signature(c, None)]
+            for index in (m._slot_name_index, m._index):
+                for k in list(index):
+                    index[k] = [c for c in index[k] if id(c) not in doomed]
+                    if not index[k]:
+                        del index[k]
+        self._evicted_instances += len(victims)
+        highest = float(activations[evicted].max())
+        if self._evicted_activation is None or highest > self._evicted_activation:
+            self._evicted_activation = highest
+
     @property
     def optimized_learning(self):
         """Whether or not this :class:`Agent` uses the optimized learning approximation when computing instance activations.
@@ -332,7 +656,20 @@ class Agent:
         an instance are used exactly, with any older rehearsals having their contributions
         to the activation approximated.
 
-        Optimized learning can only be used if the :attr:`decay` is less than one.
+        If ``"auto"``, which is only supported by agents using the ``"array"``
+        :attr:`engine`, activations are computed exactly until an instance has been
+        reinforced many times, after which those of its older rehearsals that occurred
+        close together, relative to how long ago they occurred, are merged into single,
+        weighted rehearsals at about their mean time. Rehearsals are only merged if doing
+        so changes the instance's base level activation, then or at any later time, by at
+        most :attr:`activation_tolerance`, provided the :attr:`decay` is not subsequently
+        increased. Frequently reinforced instances thus cost time roughly proportional to
+        the logarithm of the number of their rehearsals to compute the activations of,
+        while rarely reinforced ones remain exact. Attempting to set it to ``"auto"`` for
+        an agent using the ``"pyactup"`` engine raises a :exc:`ValueError`.
+
+        Optimized learning can only be used if the :attr:`decay` is less than one, except
+        when ``"auto"``.
         Attempting to set this parameter to ``True`` or an integer when :attr:`decay` is
         one or greater raises a :exc:`ValueError`.
 
@@ -347,11 +684,41 @@ class Agent:
             after an instance has been created or reinforced, producing biologically
             implausible results.
         """
+        if self._engine == "array" and self._memory._activation_tolerance is not None:
+            return "auto"
         return self._memory.optimized_learning
 
     @optimized_learning.setter
     def optimized_learning(self, value):
-        self._memory.optimized_learning = value
+        auto = isinstance(value, str) and value == "auto"
+        if auto and self._engine != "array":
+            raise ValueError("An optimized_learning of 'auto' is only supported by the "
+                             "array engine")
+        if self._memory and auto != (self.optimized_learning == "auto"):
+            raise RuntimeError("Cannot change optimized learning for a Memory that "
+                               "already contains chunks")
+        self._memory.optimized_learning = False if auto else value
+        if self._engine == "array":
+            self._memory._activation_tolerance = self._activation_tolerance if auto else None
+
+    @property
+    def activation_tolerance(self):
+        """The greatest change in a base level activation allowed when :attr:`optimized_learning` is ``"auto"``.
+        It is a positive real number, by default 0.001, and is ignored unless
+        :attr:`optimized_learning` is ``"auto"``. Changing it affects only how rehearsals
+        are merged subsequently. Attempting to set it to anything other than a positive
+        real number raises a :exc:`ValueError`.
+        """
+        return self._activation_tolerance
+
+    @activation_tolerance.setter
+    def activation_tolerance(self, value):
+        if not isinstance(value, Real) or isinstance(value, bool) or not value > 0:
+            raise ValueError(f"The activation_tolerance, {value}, is not a positive real "
+                             f"number")
+        self._activation_tolerance = value
+        if self._engine == "array" and self._memory._activation_tolerance is not None:
+            self._memory._activation_tolerance = value
 
     @property
     def details(self):
@@ -367,8 +734,17 @@ class Agent:
             a lot of information quickly. It is often best to ``clear()`` or otherwise
             reset the ``details`` frequently.
 
+        It can also be set to a :class:`DetailsPolicy`, in which case the value of
+        :attr:`details` is a fresh, empty list, or, if the policy has a *maxlen*, a
+        :class:`collections.deque` of that length, into which details are accumulated
+        for only those choices the policy selects. The intermediate values describing
+        the choices it does not select are not computed at all. When a policy is
+        assigned the participants are numbered from zero, the number being incremented
+        each time :meth:`reset` is called.
+
         A :exc:`ValueError` is raised if an attempt is made to set its value to anything
-        other than ``None``, ``True`` or a :class:`MutableSequence`.
+        other than ``None``, ``True``, a :class:`DetailsPolicy` or a
+        :class:`MutableSequence`.
 
         >>> from pprint import pp
         >>> a = Agent(default_utility=10, default_utility_populates=True)
@@ -422,13 +798,34 @@ class Agent:
 
     @details.setter
     def details(self, value):
-        if value == 0:
+        policy = None
+        options = None
+        if isinstance(value, DetailsPolicy):
+            policy = value
+            if policy._choices is not None:
+                # compared in canonical form, as the same choice may be given as a
+                # tuple, list or dict
+                options = frozenset(tuple(q.items())
+                                    for q in self._make_queries(policy._choices))
+            value = [] if policy._maxlen is None else deque(maxlen=policy._maxlen)
+            self._details_participant = 0
+            self._details_choices = 0
+        elif value == 0:
             value = None
         elif value == True:
             value = []
         if not (value is None or isinstance(value, abc.MutableSequence)):
             raise ValueError("the value of details must be None or a list or other MutableSequence")
         self._details = value
+        self._details_policy = policy
+        self._details_options = options
+
+    @property
+    def details_policy(self):
+        """The :class:`DetailsPolicy` most recently assigned to :attr:`details`, or ``None``.
+        It is ``None`` if :attr:`details` has since been assigned anything else.
+        """
+        return self._details_policy
 
     @property
     def aggregate_details(self):
@@ -493,9 +890,32 @@ class Agent:
         for this query. After this there is one column for each attribute that was
         partially matched, the similarity value computed for this attribute.
 
-        Note that each time the ``aggregate_details`` attribute is queried a new DataFrame
-        is created from an internal data structure. If you wish to modify a DataFrame and
-        have those changes retained you need to retain this DataFrame.
+        If this property is set to ``"summary"`` rather than ``True`` none of the above
+        rows are retained. Instead just enough information is accumulated to draw the
+        plots made by :meth:`plot`, requiring far less space when there are many
+        iterations. In this case the value of :attr:`aggregate_details` is a DataFrame of
+        those summary statistics, with columns ``statistic``, ``time``, ``option``,
+        ``utility``, ``count``, ``sum`` and ``sum_of_squares``. Each row contains the
+        count, sum and sum of squares of the values of the column named by ``statistic``
+        from the rows that would have been in the full aggregate details with the given
+        ``time`` and ``option``, and, for per instance quantities such as ``activation``,
+        the given ``utility``. For the ``blended_value`` statistic the ``utility`` is
+        missing, and for the ``choice`` statistic the ``option`` is the choice made and
+        the ``count`` the number of times it was made at that time. Such a DataFrame can
+        also be passed to :func:`df_plot`.
+
+        Instead of ``True`` this property may be set to a :class:`ParquetSink` or
+        :class:`CSVSink`, in which case the aggregate details are written to disk as they
+        are gathered, rather than being held in memory, and the value of this property is
+        that sink. When aggregating into a sink :meth:`plot` reads back from the files
+        written just the data needed for the requested plot.
+
+        The ``choice`` and ``option`` columns are categorical. The information is gathered
+        column by column into an internal data structure, from which the DataFrame is
+        built incrementally, only rows added since the attribute was last queried being
+        converted. Each time the ``aggregate_details`` attribute is queried a new
+        DataFrame is returned, so if you wish to modify a DataFrame and have those changes
+        retained you need to retain this DataFrame.
 
         .. warning::
             Collecting ``aggregate_details`` incurs costs, both in space and time, and for
@@ -541,25 +961,56 @@ class Agent:
         """
         if self._aggregate_details is None:
             return None
-        cols = self._aggregate_details_columns()
-        result = pd.DataFrame(self._aggregate_details, columns=cols)
-        result.dropna(axis="columns", how="all", inplace=True)
-        return result
+        elif self._aggregate_details._sink is not None:
+            return self._aggregate_details._sink
+        return self._aggregate_details.frame()
 
     @aggregate_details.setter
     def aggregate_details(self, value):
-        if value:
-            self._aggregate_details = []
+        if self._aggregate_details is not None and self._aggregate_details._sink is not None:
+            self._aggregate_details._sink.close()
+        if isinstance(value, _AggregateSink):
+            self._aggregate_details = value._attach(self._attributes)
+        elif isinstance(value, str) and value == "summary":
+            self._aggregate_details = AggregateSummary(self._attributes)
+        elif value:
+            self._aggregate_details = AggregateRecorder(self._attributes)
         else:
             self._aggregate_details = None
-        self._aggregate_similarities = False
         self._aggregate_iteration = 0
 
-    def _aggregate_details_columns(self):
-        cols = AGGREGATE_COLUMNS
-        if self._aggregate_similarities:
-            cols += ("mismatch",) + tuple(f"{a}.similarity" for a in self._attributes)
-        return cols
+    @property
+    def aggregate_accumulator(self):
+        """The object accumulating this agent's :attr:`aggregate_details`, or ``None``.
+        If :attr:`aggregate_details` has been set to ``True`` this is an
+        :class:`AggregateRecorder`, and if to ``"summary"`` an :class:`AggregateSummary`.
+        Otherwise, including when the aggregate details are being written to a sink, it
+        is ``None``.
+
+        When virtual participants are run in several processes, each process can return
+        its agent's accumulator, which is much cheaper to pickle than the DataFrame of
+        aggregate details, and the parent process can then combine them with their
+        ``merge()`` method, and pass the result to :func:`df_plot`.
+
+        >>> def run_participants(n):
+                a = Agent(default_utility=2.2)
+                a.aggregate_details = "summary"
+                for participant in range(n):
+                    a.reset()
+                    for round in range(60):
+                        if a.choose(["a", "b"]) == "a":
+                            a.respond(1)
+                        else:
+                            a.respond(2 if random.random() < 0.5 else 0)
+                return a.aggregate_accumulator
+        >>> with ProcessPoolExecutor() as executor:
+                summary = functools.reduce(AggregateSummary.merge,
+                                           executor.map(run_participants, [1000] * 32))
+        >>> df_plot(summary, "choice")
+        """
+        if self._aggregate_details is None or self._aggregate_details._sink is not None:
+            return None
+        return self._aggregate_details
 
     @property
     def trace(self):
@@ -614,12 +1065,29 @@ class Agent:
          +------+----------+---------+-------------+---------+---------------------+--------------------+----------------------+--------------------+-----------------------+
 
          'b'
-         """
+
+        Printing such tables is slow, and is unsuitable for tracing long simulations. For
+        these a :class:`TraceWriter` may instead be assigned to :attr:`trace`, in which
+        case the same values are written compactly to a file, possibly only for some of
+        the choices made, and can be printed as above later by :func:`print_trace`.
+        When a :class:`TraceWriter` is assigned the participants it sees are numbered
+        from zero, the number being incremented each time :meth:`reset` is called. In
+        this case the value of :attr:`trace` is that :class:`TraceWriter`.
+        """
         return self._trace
 
     @trace.setter
     def trace(self, value):
-        self._trace = bool(value)
+        if isinstance(self._trace, TraceWriter) and value is not self._trace:
+            self._trace.flush()
+        if isinstance(value, TraceWriter):
+            if value._closed:
+                raise RuntimeError(f"{value} has already been closed")
+            self._trace = value
+            self._trace_participant = 0
+            self._trace_choices = 0
+        else:
+            self._trace = bool(value)
 
     @property
     def default_utility(self):
@@ -742,6 +1210,96 @@ class Agent:
             self._memory.learn(Agent._add_utility(choice, outcome))
             self._last_learn_time = max(self._last_learn_time, self._memory.time)
 
+    def populate_many(self, data, outcome="outcome", time=None):
+        """Adds many instances to memory at once, each with its own choice, outcome and, optionally, time.
+        The *data* may be a Pandas DataFrame, a NumPy structured array, an iterable of
+        dictionaries, one for each instance, or the path of a CSV file with a header
+        row, which is read into a DataFrame. There should be a column for each of this
+        agent's :attr:`attributes`, or, if it has none, a ``decision`` column, giving the
+        choice of each instance; the column named by *outcome* giving its outcome; and,
+        if *time* is not ``None``, the column named by *time* giving the time at which it
+        is added. Any other columns are ignored. If *time* is ``None`` all the instances
+        are added at the current time.
+
+        The result is the same as calling :meth:`populate` for each row, with a single
+        choice and *when* the row's time, in order of increasing time, and for rows with
+        the same time in the order in which they appear. However, the data are validated
+        just once, for all the rows together, before any are added, and the rows are then
+        added in a single pass, making this far faster for large numbers of instances.
+        Rows repeating the same choice and outcome add further occurrences of the same
+        instance.
+
+        Raises a :exc:`ValueError`, without adding any instances, if any of the
+        columns are missing, if any of the outcomes are not real numbers, if any of the
+        choices are not hashable, if any of the times are not integers, or if any of the
+        times are in the future.
+
+        >>> a = Agent(["button", "lit"])
+        >>> a.advance(2)
+        >>> a.populate_many(pd.DataFrame({"button": ["left", "right", "left"],
+                                          "lit": [True, False, True],
+                                          "outcome": [3, 5, 3],
+                                          "time": [2, 0, 0]}),
+                            time="time")
+        >>> a.instances()
+        +--------+-------+---------+---------+-------------+
+        | button |  lit  | outcome | created | occurrences |
+        +--------+-------+---------+---------+-------------+
+        | right  | False |    5    |    0    |     (0,)    |
+        |  left  |  True |    3    |    0    |    (0, 2)   |
+        +--------+-------+---------+---------+-------------+
+        """
+        if isinstance(data, (str, os.PathLike)):
+            data = pd.read_csv(data)
+        elif not isinstance(data, pd.DataFrame):
+            data = pd.DataFrame(data if isinstance(data, np.ndarray) else list(data))
+        names = list(self._attributes) or ["decision"]
+        for c in names + [outcome] + ([time] if time is not None else []):
+            if c not in data.columns:
+                raise ValueError(f"The data have no {c} column")
+        outcomes = data[outcome]
+        if not (pd.api.types.is_numeric_dtype(outcomes)
+                or all(isinstance(v, numbers.Real) for v in outcomes)):
+            raise ValueError(f"The {outcome} column contains values that are not real numbers")
+        for c in names:
+            try:
+                pd.unique(data[c])
+            except TypeError:
+                raise ValueError(f"The {c} column contains values that are not hashable")
+        if not self._attributes and data["decision"].isna().any():
+            raise ValueError("None cannot be used as a choice")
+        if time is None:
+            times = np.full(len(data), self.time, dtype=np.int64)
+        else:
+            times = data[time]
+            if not pd.api.types.is_integer_dtype(times):
+                raise ValueError(f"The {time} column contains values that are not integers")
+            times = times.to_numpy(dtype=np.int64)
+            if len(times) and times.max() > self.time:
+                raise ValueError(f"The time {times.max()} must not be in the future")
+        order = np.argsort(times, kind="stable")
+        columns = [data[c].to_numpy(dtype=object)[order].tolist() for c in names]
+        outcomes = outcomes.to_numpy(dtype=object)[order].tolist()
+        keys = self._attributes or ("_decision",)
+        times = times[order].tolist()
+        rows = []
+        for i in range(len(times)):
+            slots = {"_utility": outcomes[i]}
+            slots.update(zip(keys, (col[i] for col in columns)))
+            rows.append(slots)
+        if self._engine == "array":
+            self._memory.learn_many(rows, times)
+        else:
+            saved = self._memory._time
+            try:
+                for slots, when in zip(rows, times):
+                    self._memory._time = when
+                    self._memory.learn(slots)
+            finally:
+                self._memory._time = saved
+        if times:
+            self._last_learn_time = max(self._last_learn_time, times[-1])
+
     @staticmethod
     def _attribute_value(value, attribute):
         if not isinstance(value, abc.Hashable):
@@ -915,20 +1473,39 @@ class Agent:
                 raise ValueError("no choices were supplied and no default ones are available")
         queries = self._make_queries(choices)
         self._previous_choices = choices
-        det = [] if self._details is not None else None
+        tracing = self._trace is True or (
+            self._trace and self._trace._wants(self._trace_participant, self._trace_choices))
+        self._trace_choices += 1
+        traced = [] if tracing else None
         try:
-            if details or det is not None or self._trace or self._aggregate_details is not None:
-                history = []
-                self._memory.activation_history = history
-            else:
-                history = None
             if self._last_learn_time >= self._memory.time:
                 self._memory.advance(self._last_learn_time - self._memory.time + 1)
+            policy = self._details_policy
+            if self._details is None:
+                det = None
+            elif policy is None:
+                det = []
+            else:
+                det = [] if policy._wants(self._details_participant, self._details_choices,
+                                          self.time) else None
+                self._details_choices += 1
+            # Activation histories are only built for the options where something
+            # will consume them, as building them is costly.
+            collect = bool(details or tracing or self._aggregate_details is not None)
+            options = self._details_options if det is not None else None
+            self._evict()
+            if self._engine == "array":
+                self._memory._pruned = 0
             utilities = []
             ret_probs = []
-            agg_len = len(self._aggregate_details) if self._aggregate_details is not None else None
-            def do_choose(history):
+            agg_len = (self._aggregate_details.start(self._aggregate_iteration)
+                       if self._aggregate_details is not None else None)
+            def do_choose():
                 for c, q in zip(choices, queries):
+                    record = det is not None and (options is None
+                                                  or tuple(q.items()) in options)
+                    history = [] if collect or record else None
+                    self._memory.activation_history = history
                     u = self._memory.blend("_utility", q)
                     if u is None:
                         if self._default_utility is not None:
@@ -945,48 +1522,25 @@ class Agent:
                         ret_probs.append([{"utility": Agent._extract_instance_utility(inst),
                                            "retrieval_probability": inst["retrieval_probability"]}
                                           for inst in self._memory.activation_history])
-                    if det is not None:
+                    if record:
                         d = dict(q) if self.attributes else {"decision": q["_decision"]}
                         d["activations"] = history
                         d["blended"] = u
                         det.append(d)
                     if history is not None:
-                        if self._trace:
-                            self._print_trace(q, u, history)
+                        if tracing:
+                            traced.append(self._trace_option(q, u, history))
                         if (ad := self._aggregate_details) is not None:
-                            agg = None
-                            for d in history:
-                                # cf. the definition of AGGREGATE_COLUMNS near the top of
-                                #     this file
-                                agg = [self._aggregate_iteration,
-                                       self.time,
-                                       None,
-                                       (att := d["attributes"])[0][1],
-                                       tuple(a[1] for a in att[1:]) if self._attributes else att[1][1],
-                                       u,
-                                       d["retrieval_probability"],
-                                       d["activation"],
-                                       d["base_level_activation"],
-                                       d.get("activation_noise", 0)]
-                                if sim := d.get("similarities"):
-                                    self._aggregate_similarities = True
-                                    agg.append(d.get("mismatch", 0))
-                                    agg.extend([sim.get(a, np.nan) for a in self._attributes])
-                                if agg is not None:
-                                    ad.append(agg)
-                        history = []
-                        self._memory.activation_history = history
+                            ad.record(self._aggregate_iteration, self.time, u, history)
             if (not self._fixed_noise):
-                do_choose(history)
+                do_choose()
             else:
                 with self._memory.fixed_noise:
-                    do_choose(history)
+                    do_choose()
         finally:
             self._memory.activation_history = None
-        if self._details is not None:
+        if det:
             self._details.append(det)
-        if self._trace:
-            print(f"\n   {'='*140}")
         best_indecies = [0]
         best_utility = utilities[0]
         for u, i in zip(utilities[1:], count(1)):
@@ -995,11 +1549,26 @@ class Agent:
                 best_indecies = [i]
             elif u == best_utility:
                 best_indecies.append(i)
-        best = random.choice(best_indecies)
+        best = self._random_choice(best_indecies)
         self._pending_decision = (best, choices, queries, utilities)
+        if tracing:
+            record = {"agent": self._name,
+                      "participant": self._trace_participant,
+                      "choice": self._trace_choices - 1,
+                      "time": self.time,
+                      "attributes": list(self._attributes) or ["decision"],
+                      "mismatch": bool(self._memory.mismatch),
+                      "temperature": self.temperature or SQRT2 * self.noise,
+                      "chosen": best,
+                      "options": traced}
+            if self._trace is True:
+                _print_trace_record(record, sys.stdout)
+            else:
+                self._trace._write(record)
         if agg_len is not None:
-            for v in self._aggregate_details[agg_len:]:
-                v[2] = tuple(queries[best].values()) if self._attributes else queries[best]["_decision"]
+            self._aggregate_details.set_choice(agg_len, (tuple(queries[best].values())
+                                                         if self._attributes
+                                                         else queries[best]["_decision"]))
         result = choices[best]
         if details:
             return result, sorted(({"choice": c,
@@ -1016,40 +1585,33 @@ class Agent:
         assert first_attr[0] == "_utility"
         return first_attr[1]
 
-    def _print_trace(self, query, utility, history):
-        print()
-        if self.attributes:
-            print(", ".join(list(f"{k}: {v}" for k, v in query.items())), end="")
-        else:
-            print(query["_decision"], end="")
-        print(f" → {utility} @ time={self.time}")
-        tab = PrettyTable()
-        fields = (["id"] + (list(self.attributes) or ["decision"]) +
-                  ["created", "occurrences", "outcome", "base activation", "activation noise"])
-        if self._memory.mismatch:
-            fields.append("mismatch adjustment")
-        fields.extend(["total activation", "exp(act / temp)", "retrieval probability"])
-        tab.field_names = fields
+    def _trace_option(self, query, utility, history):
+        # Returns a dict describing the computation of the blended value of one option,
+        # which, together with others of the same choice, is printed or written as a
+        # single record of the trace.
+        instances = []
         for h in history:
             attrs = dict(h["attributes"])
-            row = [h["name"]]
-            if self.attributes:
-                for a in self.attributes:
-                    row.append(attrs.get(a, ""))
+            d = {"id": h["name"]}
+            if self._attributes:
+                d["attributes"] = {a: attrs.get(a, "") for a in self._attributes}
             else:
-                row.append(attrs["_decision"])
-            row.append(h["creation_time"])
-            row.append(h["references"] if self._memory.optimized_learning else list(h["references"]))
-            row.append(attrs["_utility"])
-            row.append(h["base_level_activation"])
-            row.append(h.get("activation_noise") or 0.0)
+                d["attributes"] = {"decision": attrs["_decision"]}
+            d["created"] = h["creation_time"]
+            refs = h["references"]
+            d["occurrences"] = (int(refs) if isinstance(refs, numbers.Real)
+                                else list(map(int, refs)))
+            d["outcome"] = attrs["_utility"]
+            d["base_activation"] = h["base_level_activation"]
+            d["activation_noise"] = h.get("activation_noise") or 0.0
             if self._memory.mismatch:
-                row.append(h["mismatch"])
-            row.append(h["activation"])
-            row.append(math.exp(h["activation"] / (self.temperature or SQRT2 * self.noise)))
-            row.append(h["retrieval_probability"])
-            tab.add_row(row)
-        print(tab, flush=True)
+                d["mismatch"] = h["mismatch"]
+            d["activation"] = h["activation"]
+            d["retrieval_probability"] = h["retrieval_probability"]
+            instances.append(d)
+        return {"option": dict(query) if self._attributes else query["_decision"],
+                "blended": utility,
+                "instances": instances}
 
     def respond(self, outcome=None, choice=None):
         """Provide the *outcome* resulting from the most recent decision selected by :meth:`choose`.
@@ -1122,7 +1684,109 @@ class Agent:
         conditions = self._make_queries([conditions])[0]
         if outcome_attribute in conditions:
             del conditions[outcome_attribute]
-        return self._memory.discrete_blend(outcome_attribute, conditions)
+        result, probabilities = self._memory.discrete_blend(outcome_attribute, conditions)
+        if self._explicit_rng and probabilities:
+            best = max(probabilities.values())
+            result = self._random_choice([v for v, p in probabilities.items() if p == best])
+        return result, probabilities
+
+    def trace_likelihood(self, df, choice_col, outcome_col, choices=None, choices_col=None,
+                         participant_col=None, temperature=None, workers=0):
+        """Replays human choices recorded in the DataFrame *df*, and returns the log likelihood of those choices according to this :class:`Agent`.
+        Each row of *df* is one trial, and the trials of each participant are replayed in
+        the order in which they appear. If *participant_col* is supplied it names a
+        column identifying the participant of each row; otherwise all the rows are of a
+        single participant. Each participant is replayed by an independent copy of this
+        :class:`Agent`, made with :meth:`fork`, so that each starts with this agent's
+        current instances and parameters, which are not changed by the replay.
+
+        For each trial the copy computes the blended value of each of the choices on
+        offer, and from them the probability of its choosing the one the human chose,
+        which is named by *choice_col*, the softmax of the blended values divided by
+        *temperature*; if *temperature* is ``None``, the default, this agent's
+        :attr:`temperature`, or its default based on :attr:`noise`, is used. It then
+        learns the outcome in column *outcome_col* for the human's choice, as
+        :meth:`respond` would with its *choice* argument. The choices on offer may be
+        given as a list of choices available on every trial, *choices*, or as a column,
+        *choices_col*, each of whose values is a list of the choices available on that
+        trial. If neither is supplied the distinct values of the *choice_col* column are
+        used as the choices on offer on every trial. Choices are as for :meth:`choose`.
+
+        The replay draws activation noise as usual, and each copy draws the same random
+        numbers, so for a likelihood independent of noise it may be appropriate to set
+        :attr:`noise` to zero, and supply an explicit *temperature*.
+
+        If *workers* is zero, the default, the participants are replayed in turn in the
+        calling process. Otherwise they are divided among that many processes, or as many
+        as the machine has CPUs if *workers* is ``None``, in which case this
+        :class:`Agent`, including any similarity or default utility functions, must be
+        picklable. The result is the same however many processes are used.
+
+        If *participant_col* is supplied the result is a Pandas Series, indexed by
+        participant in the order in which they first appear in *df*, of the total log
+        likelihood of each participant's choices. Otherwise it is a single float, the
+        total log likelihood of all the choices in *df*.
+
+        A :exc:`ValueError` is raised if any of the columns named do not appear in *df*,
+        if a human choice is not one of those on offer, or if a value in the
+        *participant_col* is missing. A :exc:`RuntimeError` is raised if this
+        :class:`Agent` is awaiting a call to :meth:`respond`.
+
+        >>> a = Agent(noise=0, temperature=1, default_utility=10)
+        >>> human = pd.DataFrame({"subject": [1, 1, 1, 2, 2, 2],
+                                  "choice": ["safe", "risky", "risky", "risky", "safe", "safe"],
+                                  "payoff": [3, 0, 10, 10, 3, 3]})
+        >>> a.trace_likelihood(human, "choice", "payoff", ["safe", "risky"], participant_col="subject")
+        subject
+        1   -3.275695
+        2   -5.835869
+        Name: log_likelihood, dtype: float64
+        """
+        if self._pending_decision:
+            raise RuntimeError("likelihood requested while a previous outcome is awaited")
+        for c in (choice_col, outcome_col, choices_col, participant_col):
+            if c is not None and c not in df.columns:
+                raise ValueError(f"The DataFrame has no column {c}")
+        if temperature is None:
+            temperature = self.temperature or SQRT2 * self.noise
+        pyactup.Memory.is_real(temperature, "temperature", True, True)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = _count(workers, "number of workers", 0)
+        human = df[choice_col].to_numpy(dtype=object)
+        outcomes = df[outcome_col].to_numpy(dtype=np.float64)
+        if choices_col is not None:
+            offered = df[choices_col].to_numpy(dtype=object)
+        else:
+            offered = list(choices) if choices is not None else list(pd.unique(human))
+        if participant_col is not None:
+            if (missing := df[participant_col].isna()).any():
+                raise ValueError(f"The {participant_col} column is missing a participant "
+                                 f"in {missing.sum()} rows")
+            codes, participants = pd.factorize(df[participant_col])
+            if not len(participants):
+                return pd.Series([], index=participants, name="log_likelihood",
+                                 dtype=np.float64).rename_axis(participant_col)
+            rows = np.split(np.argsort(codes, kind="stable"),
+                            np.cumsum(np.bincount(codes, minlength=len(participants)))[:-1])
+        else:
+            rows = [np.arange(len(df))]
+        trials = [(human[r], outcomes[r], offered[r] if choices_col is not None else offered)
+                  for r in rows]
+        if not workers or len(trials) < 2:
+            result = _trace_participants(self, trials, float(temperature))
+        else:
+            size = -(-len(trials) // (EXPERIMENT_CHUNKS_PER_WORKER * workers))
+            template = self.fork()
+            with ProcessPoolExecutor(min(workers, -(-len(trials) // size))) as executor:
+                result = np.concatenate(list(executor.map(
+                    _trace_participants, repeat(template),
+                    (trials[i:i+size] for i in range(0, len(trials), size)),
+                    repeat(float(temperature)))))
+        if participant_col is None:
+            return float(result[0])
+        return pd.Series(result, index=participants, name="log_likelihood").rename_axis(
+            participant_col)
 
     def instances(self, file=sys.stdout, pretty=True):
         """Prints or returns all the instances currently stored in this :class:`Agent`.
@@ -1136,23 +1800,235 @@ class Agent:
         reading by humans is used. Otherwise comma separated values (CSV) format, more
         suitable for importing into spreadsheets, numpy, and the like, is used.
         """
+        result = list(self.iter_instances())
+        if file is None:
+            return result
+        if isinstance(file, io.TextIOBase):
+            Agent._print_instance_data(result, pretty, file)
+        else:
+            with open(file, "w+", newline=(None if pretty else "")) as f:
+                Agent._print_instance_data(result, pretty, f)
+
+    def iter_instances(self):
+        """Returns an iterator over the instances currently stored in this :class:`Agent`, without first gathering them all.
+        Each instance is a dictionary, as in the list returned by :meth:`instances` when
+        its *file* is ``None``, and they are generated in the same order, that in which
+        they were created. The agent should not be modified while iterating over its
+        instances.
+        """
         attrs = [ (a, a) for a in self.attributes ]
         if not attrs:
             attrs = [ ("decision", "_decision") ]
-        result = []
         for c in self._memory.values():
             d = {name: c[a] for name, a in attrs}
             d["outcome"] = c["_utility"]
             d["created"] = c._creation
             d["occurrences"] = tuple(map(int, c.references))
-            result.append(d)
-        if file is None:
-            return result
-        if isinstance(file, io.TextIOBase):
-            Agent._print_instance_data(result, pretty, file)
+            yield d
+
+    def instances_frame(self, references=False):
+        """Returns a Pandas DataFrame describing the instances currently stored in this :class:`Agent`, one per row.
+        The rows are in the order in which the instances were created. The columns are
+        one for each of the agent's :attr:`attributes`, or a ``decision`` column if it
+        has none; ``outcome``; ``created``, the time at which the instance was created;
+        ``reference_count``, the number of times it has occurred; and
+        ``last_reference``, the time of its most recent occurrence, or missing if that is
+        not known because :attr:`optimized_learning` is in use.
+
+        Each column is built directly as a typed array, so this is far faster, and uses
+        far less memory, than :meth:`instances` for agents with many instances.
+
+        If *references* is true two further values are returned, NumPy integer arrays
+        describing the times at which the instances occurred, as reported in the
+        ``occurrences`` of :meth:`instances`, without creating a separate tuple of them
+        for each instance. The second is the times of the occurrences of all the
+        instances, one after another, and the first the offsets into it of those of each
+        instance, with a final entry of its length, so that those of the instance in the
+        row *i* are ``times[offsets[i]:offsets[i+1]]``.
+
+        >>> a = Agent(["button", "lit"], noise=0, temperature=1)
+        >>> a.populate([("left", True), ("right", False)], 4)
+        >>> a.choose([("left", True), ("right", False)])
+        ('left', True)
+        >>> a.respond(3)
+        >>> a.choose()
+        ('right', False)
+        >>> a.respond(4)
+        >>> df, offsets, times = a.instances_frame(references=True)
+        >>> df
+          button    lit  outcome  created  reference_count  last_reference
+        0   left   True        4        0                1               0
+        1  right  False        4        0                2               2
+        2   left   True        3        1                1               1
+        >>> offsets, times
+        (array([0, 1, 3, 4]), array([0, 0, 2, 1]))
+        """
+        keys = self._attributes or ("_decision",)
+        if self._engine == "array":
+            columns, creations, counts, offsets, times = self._memory.instance_table()
         else:
-            with open(file, "w+", newline=(None if pretty else "")) as f:
-                Agent._print_instance_data(result, pretty, f)
+            values = list(self._memory.values())
+            n = len(values)
+            creations = np.fromiter((c._creation for c in values), np.int64, n)
+            counts = np.fromiter((c.reference_count for c in values), np.int64, n)
+            lengths = np.fromiter((len(c.references) for c in values), np.int64, n)
+            offsets = np.concatenate(([0], np.cumsum(lengths)))
+            times = np.fromiter((t for c in values for t in c.references), np.int64,
+                                offsets[-1])
+            columns = {k: [v[k] for v in values] for k in keys + ("_utility",)}
+        data = {name: columns[k]
+                for name, k in zip(self._attributes or ("decision",), keys)}
+        data["outcome"] = columns["_utility"]
+        data["created"] = creations
+        data["reference_count"] = counts
+        present = offsets[1:] > offsets[:-1]
+        last = np.zeros(len(creations), dtype=np.int64)
+        if present.any():
+            last[present] = np.maximum.reduceat(times, offsets[:-1][present])
+        data["last_reference"] = pd.arrays.IntegerArray(last, ~present)
+        result = pd.DataFrame(data)
+        if references:
+            return result, offsets, times
+        return result
+
+    def snapshot(self):
+        """Returns a :class:`bytes` object capturing the current state of this :class:`Agent`, from which :meth:`restore` can recreate it.
+        The state captured includes the agent's instances, its time, its parameters, its
+        similarity functions and attribute weights, any pending decision awaiting a
+        call to :meth:`respond`, and the state of its random number generator, so that
+        the restored agent goes on to make exactly the same choices as would this one.
+        The values of :attr:`details` and :attr:`aggregate_details` are not captured,
+        and are ``None`` in a restored agent; nor are the contents of similarity caches,
+        nor a :class:`TraceWriter` assigned to :attr:`trace`.
+
+        Arrays, such as those of the times at which instances were reinforced, are
+        copied into the result directly, rather than being converted element by element,
+        using pickle protocol 5 out-of-band buffers. The cost of restoring an agent
+        nonetheless grows with the number of its instances, and, for the ``"array"``
+        :attr:`engine`, with the number of distinct choices among them. For example, for
+        an agent with 100,000 instances of 100 choices taking a snapshot and restoring it
+        each take about 75 milliseconds with the ``"array"`` engine, while restoring it
+        with the ``"pyactup"`` engine, which requires recreating each instance, takes
+        about 0.4 seconds. If instead every one of the 100,000 instances is of a
+        different choice, taking a snapshot takes about 0.35 seconds and restoring it
+        about 0.7 seconds with the ``"array"`` engine, and about 0.1 and 0.55 seconds
+        with the ``"pyactup"`` engine.
+
+        Any similarity functions, or a callable :attr:`default_utility`, must be
+        picklable, that is, typically, defined at the top level of a module; if not an
+        exception is raised. Snapshots are intended for checkpointing and for moving
+        agents between processes running the same versions of PyIBL and its
+        dependencies; as with any pickled data, only :meth:`restore` snapshots from
+        trusted sources. See also :meth:`save`.
+        """
+        state = {k: v for k, v in self.__dict__.items()
+                 if k not in ("_memory", "_details", "_details_policy", "_details_options",
+                              "_aggregate_details")}
+        if isinstance(self._trace, TraceWriter):
+            state["_trace"] = False
+        if self._engine == "array":
+            state["_memory"] = self._memory
+        else:
+            state["_memory"] = _chunk_table(self._memory)
+        buffers = []
+        data = pickle.dumps(state, protocol=5, buffer_callback=buffers.append)
+        buffers = [b.raw() for b in buffers]
+        sizes = [len(data)] + [b.nbytes for b in buffers]
+        header = SNAPSHOT_MAGIC + struct.pack(f"<II{len(sizes)}Q", SNAPSHOT_VERSION,
+                                              len(sizes), *sizes)
+        parts = [header]
+        offset = len(header)
+        for part in [data] + buffers:
+            padding = -offset % SNAPSHOT_ALIGNMENT
+            parts.append(bytes(padding))
+            parts.append(part)
+            offset += padding + len(part)
+        return b"".join(parts)
+
+    @classmethod
+    def restore(cls, snapshot):
+        """Returns a new :class:`Agent` recreated from a *snapshot* returned by :meth:`snapshot`.
+        The *snapshot* may be any bytes-like object. The new agent has the same name as
+        that from which the snapshot was taken, and is independent of it, and of any
+        other agents restored from the same snapshot. If *snapshot* was not produced by
+        :meth:`snapshot`, or by a version of PyIBL using an incompatible snapshot format,
+        a :exc:`ValueError` is raised.
+        """
+        # A single writable copy, so that the arrays restored can share it rather than
+        # each being copied separately.
+        buffer = memoryview(bytearray(snapshot))
+        start = len(SNAPSHOT_MAGIC) + 8
+        if len(buffer) < start or buffer[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError("Not a PyIBL Agent snapshot")
+        version, n = struct.unpack("<II", buffer[len(SNAPSHOT_MAGIC):start])
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported PyIBL snapshot version {version}")
+        sizes = struct.unpack(f"<{n}Q", buffer[start:start + 8 * n])
+        offset = start + 8 * n
+        parts = []
+        for size in sizes:
+            offset += -offset % SNAPSHOT_ALIGNMENT
+            parts.append(buffer[offset:offset + size])
+            offset += size
+        if offset != len(buffer):
+            raise ValueError("Malformed PyIBL Agent snapshot")
+        state = pickle.loads(parts[0], buffers=parts[1:])
+        result = cls.__new__(cls)
+        result.__dict__.update(state)
+        if isinstance(result._memory, dict) and not isinstance(result._memory, _ArrayMemory):
+            result._memory = _memory_from_chunk_table(result._memory)
+        result._details = None
+        result._details_policy = None
+        result._details_options = None
+        result._aggregate_details = None
+        return result
+
+    def fork(self):
+        """Returns a new :class:`Agent` that starts in the same state as this one, but then evolves independently of it.
+        The new agent has the same name, attributes, parameters, similarity functions,
+        attribute weights, instances, time and pending decision, if any, as this one,
+        and a copy of its random number generator, so that, given the same calls to
+        :meth:`choose` and :meth:`respond`, it would make the same choices. It can then
+        :meth:`choose` and :meth:`respond`, or be altered in any other way, without
+        affecting this agent, and vice versa. This is useful for exploring what an agent
+        would do in various hypothetical futures, such as in a search over possible
+        rollouts. The :attr:`details` and :attr:`aggregate_details` of the new agent are
+        ``None``, and if this agent's :attr:`trace` is a :class:`TraceWriter` the new
+        agent's is ``False``.
+
+        For an agent using the ``"array"`` :attr:`engine` forking is cheap, taking time
+        independent of the number of instances in memory: the two agents share their
+        instances, the instances of a choice only being copied the first time either
+        agent adds or reinforces one of them. Forking an agent using the ``"pyactup"``
+        engine instead copies all its instances.
+        """
+        result = copy.copy(self)
+        if self._engine == "array":
+            result._memory = self._memory.fork()
+        else:
+            result._memory = _memory_from_chunk_table(_chunk_table(self._memory))
+        result._weights = dict(self._weights)
+        result._details = None
+        result._details_policy = None
+        result._details_options = None
+        result._aggregate_details = None
+        if isinstance(self._trace, TraceWriter):
+            result._trace = False
+        return result
+
+    def save(self, path):
+        """Writes a :meth:`snapshot` of this :class:`Agent` to the file *path*, from which :meth:`load` can recreate it.
+        """
+        with open(path, "wb") as f:
+            f.write(self.snapshot())
+
+    @classmethod
+    def load(cls, path):
+        """Returns a new :class:`Agent` recreated from a file written by :meth:`save`.
+        See :meth:`restore`.
+        """
+        with open(path, "rb") as f:
+            return cls.restore(f.read())
 
     @staticmethod
     def _print_instance_data(data, pretty, file):
@@ -1275,12 +2151,18 @@ class Agent:
         """
         if self._aggregate_details is None:
             raise RuntimeError("Can't make plot unless aggregate_details is set")
-        return df_plot(self.aggregate_details, kind=kind, title=title,
+        if (sink := self._aggregate_details._sink) is not None:
+            sink.flush()
+            details = sink.path
+        else:
+            details = self.aggregate_details
+        return df_plot(details, kind=kind, title=title,
                        xlabel=xlabel, ylabel=ylabel, include=include, exclude=exclude,
                        min=min, max=max, earliest=earliest, latest=latest,
                        legend=legend, limits=limits, filename=filename, show=show)
 
-    def similarity(self, attributes=None, function=None, weight=None):
+    def similarity(self, attributes=None, function=None, weight=None, cache=None,
+                   domain=None):
         """Assigns a function and/or corresponding weight to be used when computing the similarity of attribute values.
         The *attributes* are names of attributes of the :class:`Agent`. The value of
         *attributes*, if present, should be an :class:`Iterable` of strings. As a
@@ -1330,6 +2212,42 @@ class Agent:
         ...
         >>> a.similarity("color", color_similarity, 0.5)
 
+        Since similarity functions are required to be stateless their results may be
+        memoized. If *cache* is supplied it should be a positive integer, the maximum
+        number of pairs of attribute values whose similarities are retained for each of
+        the *attributes*, the least recently used being discarded when it is exceeded.
+        Hits and misses in this cache are counted and can be retrieved with
+        :meth:`similarity_cache_info`. The cache is retained when the agent is
+        :meth:`reset`, so subsequent virtual participants need not call the similarity
+        function again for pairs already seen; it is emptied, and its counts zeroed,
+        whenever this method is called again for its attribute. If *cache* is not a
+        positive integer a :exc:`ValueError` is raised.
+
+        >>> a.similarity(["height", "width"], lambda v1, v2: 1 - abs(v1 - v2) / 10, cache=4096)
+
+        If the values an attribute can take are known in advance, a *domain* may be
+        supplied, an :class:`Iterable` of those values. The similarity function is then
+        called once for every ordered pair of them, the resulting matrix of similarities
+        stored, and all subsequent similarities of values in the domain simply looked up
+        in it; values outside the domain are compared by calling the function, as usual.
+        If any of the similarities is not a real number between zero and one, inclusive,
+        or if the matrix is not symmetric, a :exc:`ValueError` is raised at once. With the
+        ``"array"`` :attr:`engine` the mismatch penalties of all the instances with values
+        in the domain are found in a single indexing operation. A domain is retained, and
+        its matrix recomputed as necessary, if this method is called again for the same
+        attribute with a different *function* or *weight*, until the similarity function
+        is removed.
+
+        >>> a.similarity("color", color_similarity, 0.5,
+        ...              domain=["red", "pink", "green", "blue"])
+
+        The similarity functions supplied by PyIBL, :func:`positive_linear_similarity`,
+        :func:`positive_quadratic_similarity`, and those returned by
+        :func:`bounded_linear_similarity` and :func:`bounded_quadratic_similarity`, can
+        also be applied to the values of many instances at once. With the ``"array"``
+        :attr:`engine` the similarities of all the instances considered by :meth:`choose`
+        are then computed in a single NumPy operation, with no per-instance function calls.
+
         """
         if weight:
             try:
@@ -1337,8 +2255,31 @@ class Agent:
                     raise RuntimeError()
             except:
                 raise ValueError(f"Weight {weight} is not a positive number <= 1")
+        if cache is not None and (isinstance(cache, bool)
+                                  or not isinstance(cache, numbers.Integral)
+                                  or cache <= 0):
+            raise ValueError(f"The similarity cache size, {cache}, is not a positive integer")
         attrs = (pyactup.Memory._ensure_slot_names(attributes) or [ "_decision" ])
+        sims = self._memory._similarities
+        matrices = {}
+        if function is not None or domain is not None:
+            for a in attrs:
+                old = sims.get(a)
+                if (d := domain if domain is not None else getattr(old, "_domain", None)) is None:
+                    continue
+                if function is not None:
+                    f = function
+                else:
+                    f = old._function if old is not None else True
+                matrices[a] = _similarity_matrix(f, d, self._memory)
         self._memory.similarity(attrs, function, weight)
+        for a, (values, matrix) in matrices.items():
+            if (old := sims.get(a)) is not None:
+                sims[a] = _DomainSimilarity(old, values, matrix)
+        if cache is not None:
+            for a in attrs:
+                if a in self._memory._similarities:
+                    self._memory._similarities[a]._cache = _CountingLRU(cache)
         if (attributes is None and function is None and weight is None):
             for a in attrs:
                 try:
@@ -1353,6 +2294,1106 @@ class Agent:
         except RuntimeError:
             pass
 
+    def similarity_cache_info(self, attribute=None):
+        """Returns statistics about the similarity cache of the attribute named *attribute*.
+        The result is a dictionary with the keys ``"hits"`` and ``"misses"``, the numbers
+        of times a similarity value was, or was not, found in the cache since it was last
+        emptied; ``"size"``, the number of entries currently in it; and ``"capacity"``,
+        the maximum number of entries it may hold. Each pair of attribute values
+        compared occupies two entries, one for each order of the values. If no
+        similarity function with a *cache* has been set, using :meth:`similarity`, for
+        *attribute*, ``None`` is returned. For an :class:`Agent` that has no attributes
+        the *attribute* argument should be omitted.
+
+        >>> a.similarity("size", lambda x, y: 1 - abs(x - y) / 10, cache=1000)
+        >>> a.similarity_cache_info("size")
+        {'hits': 0, 'misses': 0, 'size': 0, 'capacity': 1000}
+        """
+        sim = self._memory._similarities.get(attribute or "_decision")
+        if sim is None or not isinstance(sim._cache, _CountingLRU):
+            return None
+        return sim._cache.info()
+
+    def cohort(self, participants):
+        """Returns a new :class:`Cohort` of *participants* virtual participants, each like this :class:`Agent`.
+        The :class:`Cohort` has the same :attr:`attributes`, :attr:`noise`,
+        :attr:`decay`, :attr:`temperature`, :attr:`optimized_learning`,
+        :attr:`default_utility` and :attr:`default_utility_populates` as this
+        :class:`Agent`, but the participants' memories are initially empty; any instances
+        in this :class:`Agent` are not copied.
+
+        Raises a :exc:`ValueError` if this :class:`Agent` uses partial matching, that is
+        its :attr:`mismatch_penalty` is not ``None``, or if its
+        :attr:`optimized_learning` is an integer, as neither of these are supported by a
+        :class:`Cohort`.
+        """
+        if self.mismatch_penalty is not None:
+            raise ValueError("A Cohort cannot be made from an Agent that uses partial matching")
+        if self.optimized_learning not in (True, False):
+            raise ValueError(f"A Cohort cannot be made from an Agent with optimized_learning "
+                             f"{self.optimized_learning}")
+        return Cohort(participants,
+                      attributes=self._attributes,
+                      noise=self.noise,
+                      decay=self.decay,
+                      temperature=self.temperature,
+                      optimized_learning=self.optimized_learning,
+                      default_utility=self.default_utility,
+                      default_utility_populates=self.default_utility_populates)
+
+
+class _CountingLRU(pylru.lrucache):
+    # A bounded LRU cache, as used by pyactup's similarity memoization, that also counts
+    # lookups that hit and miss.
+
+    def __init__(self, size):
+        super().__init__(size)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        if key in self.table:
+            self.hits += 1
+            return self[key]
+        self.misses += 1
+        return default
+
+    def clear(self):
+        super().clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self), "capacity": self.size()}
+
+
+def _detached_similarities(similarities):
+    # Returns copies of the similarities of a memory without references to it, and with
+    # their caches replaced by the type and size of cache to be recreated, empty, by
+    # _attach_similarities(), suitable for pickling.
+    result = {}
+    for name, similarity in similarities.items():
+        result[name] = similarity = copy.copy(similarity)
+        similarity._memory = None
+        similarity._cache = (type(similarity._cache), similarity._cache.size())
+    return result
+
+
+def _attach_similarities(memory, similarities):
+    memory._similarities = similarities
+    for similarity in similarities.values():
+        similarity._memory = memory
+        cache_type, size = similarity._cache
+        similarity._cache = cache_type(size)
+
+
+def _chunk_table(memory):
+    # Returns the state of a pyactup.Memory as a dict, with the contents of its chunks
+    # gathered into lists and arrays, for snapshots.
+    chunks = list(memory.values())
+    state = {k: v for k, v in memory.__dict__.items()
+             if k not in ("_slot_name_index", "_index", "_activation_history")}
+    # copies of the mutable parts, so that the result can also be used directly to
+    # make a copy of memory
+    state["_rng"] = copy.deepcopy(memory._rng)
+    state["_indexed_attributes"] = set(memory._indexed_attributes)
+    if memory._fixed_noise is not None:
+        state["_fixed_noise"] = dict(memory._fixed_noise)
+    state["_similarities"] = _detached_similarities(memory._similarities)
+    state["contents"] = [tuple(c.items()) for c in chunks]
+    state["names"] = [c._name for c in chunks]
+    # kept as they are, as times are usually, but not necessarily, integers
+    state["creations"] = [c._creation for c in chunks]
+    state["counts"] = np.array([c._reference_count for c in chunks], dtype=np.int64)
+    state["lengths"] = np.array([len(c._references) for c in chunks], dtype=np.int64)
+    state["references"] = (np.concatenate([c._references for c in chunks]) if chunks
+                           else np.empty(0))
+    return state
+
+
+def _memory_from_chunk_table(state):
+    # The inverse of _chunk_table().
+    state = dict(state)
+    contents = state.pop("contents")
+    names = state.pop("names")
+    creations = state.pop("creations")
+    counts = state.pop("counts").tolist()
+    lengths = state.pop("lengths")
+    references = np.split(state.pop("references"), np.cumsum(lengths)[:-1])
+    similarities = state.pop("_similarities")
+    memory = pyactup.Memory.__new__(pyactup.Memory)
+    memory.__dict__.update(state)
+    memory._slot_name_index = defaultdict(list)
+    memory._index = defaultdict(list)
+    memory._activation_history = None
+    _attach_similarities(memory, similarities)
+    for content, name, creation, n, refs in zip(contents, names, creations, counts,
+                                                references):
+        c = pyactup.Chunk.__new__(pyactup.Chunk)
+        c.update(content)
+        c._name = name
+        c._memory = memory
+        c._creation = creation
+        c._references = refs.copy()
+        c._reference_count = n
+        memory[pyactup.Memory._signature(c, "learn")] = c
+        memory._slot_name_index[frozenset(c.keys())].append(c)
+        if memory._indexed_attributes:
+            memory._index[pyactup.Memory._signature(c, "learn", memory._indexed_attributes)
+                          ].append(c)
+    # so that instances created subsequently, perhaps in another process, are not given
+    # the same names, which would confuse fixed_noise
+    pyactup.Chunk._name_counter = max([pyactup.Chunk._name_counter]
+                                      + [int(n) + 1 for n in names if n.isdigit()])
+    return memory
+
+
+def _similarity_matrix(function, domain, memory):
+    # Returns a list of the distinct values in domain, and a matrix of the similarities
+    # of all ordered pairs of them, raising a ValueError if any is out of range or the
+    # matrix is not symmetric.
+    try:
+        values = list(dict.fromkeys(domain))
+    except TypeError:
+        raise ValueError(f"The domain, {domain}, is not an iterable of hashable values")
+    n = len(values)
+    if function is True:
+        return values, np.eye(n)
+    result = np.ones((n, n))
+    for i, x in enumerate(values):
+        for j, y in enumerate(values):
+            if i == j:
+                continue
+            sim = function(x, y)
+            if not isinstance(sim, Real):
+                raise ValueError(f"The similarity of {x} and {y}, {sim}, is not a real number")
+            if not memory._minimum_similarity <= sim <= memory._maximum_similarity:
+                raise ValueError(f"The similarity of {x} and {y}, {sim}, is not between "
+                                 f"{memory._minimum_similarity} and "
+                                 f"{memory._maximum_similarity}")
+            result[i, j] = sim
+    if not np.allclose(result, result.T, rtol=0, atol=1e-12):
+        i, j = np.argwhere(~np.isclose(result, result.T, rtol=0, atol=1e-12))[0]
+        raise ValueError(f"The similarity function is not symmetric: the similarity of "
+                         f"{values[i]} and {values[j]} is {result[i, j]}, but that of "
+                         f"{values[j]} and {values[i]} is {result[j, i]}")
+    return values, result
+
+
+class _DomainSimilarity(pyactup.Similarity):
+    # A pyactup Similarity whose values over a finite domain have been computed, and
+    # validated, in advance, and are looked up by the positions of the values in the
+    # domain. Pairs of values not both in the domain are passed to the function.
+
+    def __init__(self, similarity, domain, matrix):
+        super().__init__(similarity._memory, similarity._function, similarity._derivative,
+                         similarity._weight, similarity._cache)
+        self._domain = domain
+        self._codes = {v: i for i, v in enumerate(domain)}
+        self._matrix = matrix
+        self._penalty_key = None
+
+    def penalties(self):
+        # The matrix of weighted mismatch penalties, as returned by _similarity().
+        key = (self._weight, self._memory._use_actr_similarity)
+        if key != self._penalty_key:
+            p = self._matrix if key[1] else self._matrix - 1
+            p = p * self._weight
+            np.fill_diagonal(p, 0)
+            self._penalty_matrix = p
+            self._penalty_rows = p.tolist()
+            self._penalty_key = key
+        return self._penalty_matrix
+
+    def _similarity(self, x, y):
+        if x == y:
+            return 0
+        i = self._codes.get(x)
+        j = self._codes.get(y)
+        if i is None or j is None:
+            return super()._similarity(x, y)
+        if self._penalty_key != (self._weight, self._memory._use_actr_similarity):
+            self.penalties()
+        return self._penalty_rows[i][j]
+
+
+class AggregateRecorder:
+    """Accumulates the rows of an :class:`Agent`'s :attr:`Agent.aggregate_details`.
+    Instances are not created directly, but are the value of
+    :attr:`Agent.aggregate_accumulator` when :attr:`Agent.aggregate_details` has been
+    set to ``True``. The rows are held column by column in compact NumPy arrays, and the
+    DataFrame that is the value of :attr:`Agent.aggregate_details` is built from them
+    on demand by :meth:`frame`. When pickled just those arrays are written, making an
+    :class:`AggregateRecorder` a much cheaper thing than the DataFrame to send from one
+    process to another, and several, typically each from a different process, can be
+    combined with :meth:`merge`.
+    """
+
+    # The columns are NumPy arrays allocated in chunks of AGGREGATE_CHUNK_ROWS rows, so
+    # that growing never copies what has already been recorded. The choice and option
+    # columns hold integer codes into a table of the distinct values seen, and become
+    # categorical columns in the DataFrame. That DataFrame is not cached, but built
+    # afresh from the chunks each time it is asked for, so that it need not be copied to
+    # protect the arrays from changes a caller might make to it.
+
+    _INTEGER_COLUMNS = ("iteration", "time")
+    _CATEGORICAL_COLUMNS = ("choice", "option")
+
+    def __init__(self, attributes, sink=None):
+        self._attributes = attributes
+        self._columns = list(AGGREGATE_COLUMNS)
+        self._chunks = []
+        self._length = 0
+        self._codes = {}
+        self._categories = []
+        self._similarities = False
+        self._matched = set()
+        self._sink = sink
+        self._iterations = None
+        if sink is not None:
+            # rows written to a sink always have the same columns
+            self._add_similarity_columns()
+
+    def __len__(self):
+        return self._length
+
+    def __getstate__(self):
+        if self._sink is not None:
+            raise TypeError("An AggregateRecorder writing to a sink cannot be pickled")
+        state = self.__dict__.copy()
+        state["_chunks"] = {c: self._column(c, 0, self._length) for c in self._columns}
+        return state
+
+    def __setstate__(self, state):
+        columns = state.pop("_chunks")
+        self.__dict__.update(state)
+        self._chunks = []
+        self._length = 0
+        self._append(columns, state["_length"])
+
+    def _dtype(self, column):
+        if column in AggregateRecorder._INTEGER_COLUMNS:
+            return np.int64
+        elif column in AggregateRecorder._CATEGORICAL_COLUMNS:
+            return np.int32
+        else:
+            return np.float64
+
+    def _new_chunk(self):
+        chunk = {c: np.empty(AGGREGATE_CHUNK_ROWS, dtype=self._dtype(c)) for c in self._columns}
+        chunk["choice"].fill(-1)
+        for c in self._columns[len(AGGREGATE_COLUMNS):]:
+            chunk[c].fill(np.nan)
+        self._chunks.append(chunk)
+
+    def _add_similarity_columns(self):
+        self._similarities = True
+        added = ["mismatch"] + [f"{a}.similarity" for a in self._attributes]
+        self._columns.extend(added)
+        for chunk in self._chunks:
+            for c in added:
+                chunk[c] = np.full(AGGREGATE_CHUNK_ROWS, np.nan)
+
+    def _spans(self, start, end):
+        # Yields the chunk, offset within it, and number of rows for each of the pieces
+        # into which the chunks divide the rows from start to end.
+        while start < end:
+            i, offset = divmod(start, AGGREGATE_CHUNK_ROWS)
+            n = min(end - start, AGGREGATE_CHUNK_ROWS - offset)
+            yield self._chunks[i], offset, n
+            start += n
+
+    def _code(self, value):
+        if (result := self._codes.get(value)) is None:
+            result = self._codes[value] = len(self._categories)
+            self._categories.append(value)
+        return result
+
+    def _option(self, attributes):
+        return tuple(a[1] for a in attributes[1:]) if self._attributes else attributes[1][1]
+
+    def record(self, iteration, time, blended_value, history):
+        # Appends one row for each of the instances described in the activation history
+        # of a single blending operation. The choice is filled in later by set_choice().
+        n = len(history)
+        if n == 0:
+            return
+        values = {"iteration": iteration,
+                  "time": time,
+                  "utility": np.fromiter((d["attributes"][0][1] for d in history),
+                                         np.float64, n),
+                  "option": np.fromiter((self._code(self._option(d["attributes"]))
+                                         for d in history), np.int32, n),
+                  "blended_value": blended_value,
+                  "retrieval_probability": np.fromiter((d["retrieval_probability"]
+                                                        for d in history), np.float64, n),
+                  "activation": np.fromiter((d["activation"] for d in history), np.float64, n),
+                  "base_level_activation": np.fromiter((d["base_level_activation"]
+                                                        for d in history), np.float64, n),
+                  "activation_noise": np.fromiter((d.get("activation_noise", 0)
+                                                   for d in history), np.float64, n)}
+        if any(d.get("similarities") for d in history):
+            if not self._similarities:
+                self._add_similarity_columns()
+            values["mismatch"] = np.fromiter((d.get("mismatch", 0) for d in history),
+                                             np.float64, n)
+            self._matched.add("mismatch")
+            for a in self._attributes:
+                v = np.fromiter(((d.get("similarities") or {}).get(a, np.nan) for d in history),
+                                np.float64, n)
+                values[f"{a}.similarity"] = v
+                if not np.isnan(v).all():
+                    self._matched.add(f"{a}.similarity")
+        self._append(values, n)
+
+    def _append(self, values, n):
+        # Appends n rows, the values of each column being either an array of length n
+        # or a scalar used for all of them; any columns not in values are left missing.
+        end = self._length + n
+        while len(self._chunks) * AGGREGATE_CHUNK_ROWS < end:
+            self._new_chunk()
+        i = 0
+        for chunk, offset, k in self._spans(self._length, end):
+            for c, v in values.items():
+                chunk[c][offset:offset+k] = v[i:i+k] if isinstance(v, np.ndarray) else v
+            i += k
+        self._length = end
+
+    def _column(self, c, start, end):
+        spans = [chunk[c][offset:offset+k] for chunk, offset, k in self._spans(start, end)]
+        return np.concatenate(spans) if spans else np.empty(0, dtype=self._dtype(c))
+
+    def merge(self, other):
+        """Appends to this :class:`AggregateRecorder` all the rows accumulated by *other*, and returns this :class:`AggregateRecorder`.
+        The iterations of the rows from *other* are renumbered to follow those already
+        present, preserving any gaps between them, so that each virtual participant
+        retains a distinct iteration. Merging is associative, so a number of
+        :class:`AggregateRecorder` objects can be combined in any grouping, such as with
+        :func:`functools.reduce`, so long as their order is preserved. *Other* is not
+        changed.
+
+        A :exc:`ValueError` is raised if *other* is not an :class:`AggregateRecorder`
+        gathered by an :class:`Agent` with the same attributes as the one that gathered
+        this one, or if either is writing to a sink.
+        """
+        if not isinstance(other, AggregateRecorder):
+            raise ValueError(f"{other} is not an AggregateRecorder")
+        if other._attributes != self._attributes:
+            raise ValueError(f"Cannot merge aggregate details of agents with different "
+                             f"attributes, {other._attributes} and {self._attributes}")
+        if self._sink is not None or other._sink is not None:
+            raise ValueError("Cannot merge aggregate details written to a sink")
+        if not other._length:
+            return self
+        if other._similarities and not self._similarities:
+            self._add_similarity_columns()
+        values = {c: other._column(c, 0, other._length) for c in other._columns}
+        if self._length:
+            values["iteration"] += (self._column("iteration", 0, self._length).max() + 1
+                                    - values["iteration"].min())
+        codes = np.fromiter((self._code(v) for v in other._categories), np.int32,
+                            len(other._categories))
+        for c in AggregateRecorder._CATEGORICAL_COLUMNS:
+            values[c] = np.where(values[c] >= 0, codes[values[c]], -1)
+        for c in self._columns[len(AGGREGATE_COLUMNS):]:
+            values.setdefault(c, np.nan)
+        self._append(values, other._length)
+        self._matched |= other._matched
+        return self
+
+    def start(self, iteration):
+        # Called at the beginning of each choose(), returning the number of rows so far.
+        # When writing to a sink any rows accumulated are handed off to it if there are
+        # enough of them, and a new iteration is beginning.
+        if self._sink is not None:
+            if (self._length >= self._sink._flush_rows
+                    and self._iterations and self._iterations[1] != iteration):
+                self.drain()
+            if self._iterations is None:
+                self._iterations = [iteration, iteration]
+            self._iterations[1] = iteration
+        return self._length
+
+    def drain(self):
+        # Hands all the rows recorded so far off to the sink, and forgets them.
+        if self._length:
+            self._sink._put(self._build(0, self._length), self._iterations)
+        self._chunks = []
+        self._length = 0
+        self._iterations = None
+
+    def set_choice(self, start, choice):
+        code = self._code(choice)
+        for chunk, offset, k in self._spans(start, self._length):
+            chunk["choice"][offset:offset+k] = code
+
+    def _categorical(self, codes):
+        if any(v is None or v != v for v in self._categories):
+            # pandas does not allow missing values as categories
+            values = np.empty(len(self._categories) + 1, dtype=object)
+            for i, v in enumerate(self._categories):
+                values[i] = v
+            values[-1] = None
+            return values[codes]
+        return pd.Categorical.from_codes(codes, categories=pd.Index(self._categories,
+                                                                    dtype=object,
+                                                                    tupleize_cols=False))
+
+    def _build(self, start, end, columns=None):
+        data = {}
+        for c in columns or self._columns:
+            data[c] = self._column(c, start, end)
+            if c in AggregateRecorder._CATEGORICAL_COLUMNS:
+                data[c] = self._categorical(data[c])
+        return pd.DataFrame(data)
+
+    def frame(self):
+        """Returns a DataFrame of the rows accumulated, as described for :attr:`Agent.aggregate_details`.
+        """
+        return self._build(0, self._length,
+                           [c for i, c in enumerate(self._columns)
+                            if i < len(AGGREGATE_COLUMNS) or c in self._matched])
+
+
+class AggregateSummary:
+    """Accumulates, in place of the rows of an :class:`Agent`'s :attr:`Agent.aggregate_details`, just what is needed to plot them.
+    Instances are not created directly, but are the value of
+    :attr:`Agent.aggregate_accumulator` when :attr:`Agent.aggregate_details` has been
+    set to ``"summary"``. Several, typically each from a different process, can be
+    combined with :meth:`merge`, and the result passed directly to :func:`df_plot`.
+    """
+
+    # What is accumulated is the number of times each choice was made at each time; and
+    # counts, sums and sums of squares of the blended values for each time and option,
+    # and of the per instance quantities for each time, option and utility.
+
+    def __init__(self, attributes):
+        self._attributes = attributes
+        self._sink = None
+        self._columns = list(AGGREGATE_COLUMNS[AGGREGATE_COLUMNS.index("retrieval_probability"):])
+        self._similarities = False
+        self._time = None
+        self._choices = defaultdict(int)
+        self._blended = {}
+        self._instances = {}
+
+    def _option(self, attributes):
+        return tuple(a[1] for a in attributes[1:]) if self._attributes else attributes[1][1]
+
+    def _add_similarity_columns(self):
+        self._similarities = True
+        self._columns.extend(["mismatch"] + [f"{a}.similarity" for a in self._attributes])
+        for k, v in self._instances.items():
+            self._instances[k] = np.vstack([v, np.zeros((len(self._columns) - len(v), 3))])
+
+    def start(self, iteration):
+        # choices are only counted at times when something was recorded, as they only
+        # appear in rows of the full aggregate details
+        self._time = None
+        return 0
+
+    def record(self, iteration, time, blended_value, history):
+        n = len(history)
+        if n == 0:
+            return
+        self._time = time
+        if not self._similarities and any(d.get("similarities") for d in history):
+            self._add_similarity_columns()
+        values = np.empty((n, len(self._columns)))
+        for j, c in enumerate(self._columns):
+            if c in ("activation_noise", "mismatch"):
+                values[:, j] = np.fromiter((d.get(c, 0) for d in history), np.float64, n)
+            elif c.endswith(".similarity"):
+                values[:, j] = np.fromiter(((d.get("similarities") or {}).get(c[:-11], np.nan)
+                                            for d in history), np.float64, n)
+            else:
+                values[:, j] = np.fromiter((d[c] for d in history), np.float64, n)
+        groups = defaultdict(list)
+        for i, d in enumerate(history):
+            groups[(self._option(d["attributes"]), float(d["attributes"][0][1]))].append(i)
+        options = defaultdict(int)
+        for (option, utility), rows in groups.items():
+            options[option] += len(rows)
+            v = values[rows]
+            present = ~np.isnan(v)
+            v = np.where(present, v, 0)
+            if (acc := self._instances.get(k := (time, option, utility))) is None:
+                acc = self._instances[k] = np.zeros((len(self._columns), 3))
+            acc[:, 0] += present.sum(axis=0)
+            acc[:, 1] += v.sum(axis=0)
+            acc[:, 2] += (v * v).sum(axis=0)
+        for option, count in options.items():
+            if (acc := self._blended.get(k := (time, option))) is None:
+                acc = self._blended[k] = np.zeros(3)
+            acc += (count, count * blended_value, count * blended_value * blended_value)
+
+    def set_choice(self, start, choice):
+        if self._time is not None:
+            self._choices[(self._time, choice)] += 1
+
+    def merge(self, other):
+        """Adds to this :class:`AggregateSummary` all the statistics accumulated by *other*, and returns this :class:`AggregateSummary`.
+        The result is as if all the virtual participants whose decisions were summarized
+        in either had been summarized in this one. Merging is associative and
+        commutative, so a number of :class:`AggregateSummary` objects can be combined in any
+        order, such as with :func:`functools.reduce`. *Other* is not changed.
+
+        A :exc:`ValueError` is raised if *other* is not an :class:`AggregateSummary`
+        gathered by an :class:`Agent` with the same attributes as the one that gathered
+        this one.
+        """
+        if not isinstance(other, AggregateSummary):
+            raise ValueError(f"{other} is not an AggregateSummary")
+        if other._attributes != self._attributes:
+            raise ValueError(f"Cannot merge aggregate details of agents with different "
+                             f"attributes, {other._attributes} and {self._attributes}")
+        if other._similarities and not self._similarities:
+            self._add_similarity_columns()
+        for k, n in other._choices.items():
+            self._choices[k] += n
+        for k, acc in other._blended.items():
+            self._blended[k] = self._blended[k] + acc if k in self._blended else acc.copy()
+        width = len(self._columns)
+        for k, acc in other._instances.items():
+            if len(acc) < width:
+                acc = np.vstack([acc, np.zeros((width - len(acc), 3))])
+            self._instances[k] = self._instances[k] + acc if k in self._instances else acc.copy()
+        return self
+
+    def frame(self):
+        """Returns a DataFrame of the summary statistics accumulated, as described for :attr:`Agent.aggregate_details`.
+        """
+        statistics = []
+        times = []
+        options = []
+        utilities = []
+        counts = []
+        for (t, choice), n in self._choices.items():
+            statistics.append("choice")
+            times.append(t)
+            options.append(choice)
+            utilities.append(np.nan)
+            counts.append((n, n, n))
+        for (t, option), acc in self._blended.items():
+            statistics.append("blended_value")
+            times.append(t)
+            options.append(option)
+            utilities.append(np.nan)
+            counts.append(acc)
+        for j, c in enumerate(self._columns):
+            if not any(acc[j, 0] for acc in self._instances.values()):
+                continue
+            for (t, option, utility), acc in self._instances.items():
+                statistics.append(c)
+                times.append(t)
+                options.append(option)
+                utilities.append(utility)
+                counts.append(acc[j])
+        counts = np.array(counts, dtype=np.float64).reshape((-1, 3))
+        opts = np.empty(len(options), dtype=object)
+        for i, o in enumerate(options):
+            opts[i] = o
+        return pd.DataFrame({"statistic": statistics,
+                             "time": np.array(times, dtype=np.int64),
+                             "option": opts,
+                             "utility": np.array(utilities, dtype=np.float64),
+                             "count": counts[:, 0].astype(np.int64),
+                             "sum": counts[:, 1],
+                             "sum_of_squares": counts[:, 2]})
+
+
+class _AggregateSink:
+    # The common machinery of ParquetSink and CSVSink: rows handed off by an Agent's
+    # AggregateRecorder are queued, and encoded and written by a background thread.
+
+    def __init__(self, path, flush_rows):
+        self._flush_rows = _count(flush_rows, "flush_rows")
+        self._path = os.fspath(path)
+        self._queue = queue.Queue(AGGREGATE_SINK_QUEUE_SIZE)
+        self._thread = None
+        self._error = None
+        self._recorder = None
+        self._closed = False
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self._path}>"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def path(self):
+        """The path to which the aggregate details are written, a string."""
+        return self._path
+
+    @property
+    def flush_rows(self):
+        """The number of rows accumulated before they are handed off to be written."""
+        return self._flush_rows
+
+    def _attach(self, attributes):
+        if self._closed:
+            raise RuntimeError(f"{self} has already been closed")
+        if self._recorder is not None:
+            raise RuntimeError(f"{self} is already in use by an Agent")
+        self._recorder = AggregateRecorder(attributes, self)
+        return self._recorder
+
+    def _check_error(self):
+        if (e := self._error) is not None:
+            self._error = None
+            raise RuntimeError(f"Error writing aggregate details to {self._path} ({e})") from e
+
+    def _put(self, df, iterations):
+        self._check_error()
+        if self._thread is None:
+            self._open()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._queue.put((df, iterations))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    self._finish()
+                    return
+                if self._error is None:
+                    self._write(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """Writes all the aggregate details gathered so far, returning when they have been written.
+        Note that this may result in rows for a single iteration being split between
+        different row groups or files.
+        """
+        if self._recorder is not None:
+            self._recorder.drain()
+        if self._thread is not None:
+            self._queue.join()
+        self._check_error()
+
+    def close(self):
+        """Writes any remaining aggregate details and closes this sink.
+        The sink may no longer be used once it has been closed, though the data it wrote
+        may, of course, still be read and plotted. Closing a sink that is already closed
+        has no effect. A sink may also be used as a context manager, in which case it is
+        closed on exiting the ``with`` statement.
+        """
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._recorder = None
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+        self._check_error()
+
+    def _open(self):
+        pass
+
+    def _write(self, df, iterations):
+        raise NotImplementedError()
+
+    def _finish(self):
+        pass
+
+
+class ParquetSink(_AggregateSink):
+    """A destination for an :class:`Agent`'s :attr:`Agent.aggregate_details` to which they are written as the agent runs.
+    Rather than accumulating aggregate details in memory until a simulation is complete,
+    assigning a :class:`ParquetSink` to :attr:`Agent.aggregate_details` causes them to be
+    written in `Parquet <https://parquet.apache.org/>`_ files as the simulation proceeds.
+    This requires the `pyarrow <https://arrow.apache.org/docs/python/>`_ package; if it
+    is not installed an :exc:`ImportError` is raised.
+
+    The *path* names a directory, which is created if necessary, and into which files
+    are written, each containing one or more complete iterations. The rows are handed
+    off to be written once at least *flush_rows* have accumulated and a new iteration
+    begins. They are then encoded and written by a background thread, while the agent
+    continues running. The files are named by the iterations they contain, and may be
+    read as they are written, for example with :func:`pandas.read_parquet`, which reads
+    the whole directory, so the directory should not already contain any Parquet files;
+    if it does a :exc:`ValueError` is raised. The columns are those described for
+    :attr:`Agent.aggregate_details`, except that the ``choice`` and ``option`` columns
+    are written as strings, and that the ``mismatch`` and similarity columns are always
+    present, containing missing values if partial matching is not used.
+
+    A sink can be used by only one agent. When the simulation is complete :meth:`close`
+    should be called to ensure any remaining data is written; alternatively the sink
+    can be used as a context manager. A :exc:`ValueError` is raised if *flush_rows* is
+    not a positive integer.
+
+    >>> with ParquetSink("run.parquet") as sink:
+    ...     a = Agent(default_utility=4)
+    ...     a.aggregate_details = sink
+    ...     for p in range(1000):
+    ...         a.reset()
+    ...         for r in range(100):
+    ...             a.respond(3 if a.choose(["safe", "risky"]) == "safe" else
+    ...                       (10 if random.random() < 0.25 else 0))
+    >>> df_plot("run.parquet", "choice")
+    """
+
+    def __init__(self, path, flush_rows=AGGREGATE_SINK_FLUSH_ROWS):
+        super().__init__(path, flush_rows)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError("ParquetSink requires the pyarrow package") from e
+        self._pyarrow = pyarrow
+        if os.path.isdir(self._path) and any(f.endswith(".parquet")
+                                             for f in os.listdir(self._path)):
+            raise ValueError(f"The directory {self._path} already contains Parquet files")
+
+    def _open(self):
+        os.makedirs(self._path, exist_ok=True)
+
+    def _write(self, df, iterations):
+        for c in ("choice", "option"):
+            df[c] = df[c].astype(str)
+        table = self._pyarrow.Table.from_pandas(df, preserve_index=False)
+        name = f"iterations-{iterations[0]:06d}-{iterations[1]:06d}"
+        if os.path.exists(os.path.join(self._path, name + ".parquet")):
+            name += f"-{len(os.listdir(self._path))}"
+        self._pyarrow.parquet.write_table(table, os.path.join(self._path, name + ".parquet"),
+                                          row_group_size=self._flush_rows)
+
+
+class CSVSink(_AggregateSink):
+    """A destination for an :class:`Agent`'s :attr:`Agent.aggregate_details` to which they are written, as CSV, as the agent runs.
+    This is similar to :class:`ParquetSink`, except that the *path* names a single CSV
+    file, overwritten if it already exists, to which rows are appended as the agent
+    runs. Tuples in the ``choice`` and ``option`` columns are written as their string
+    representations.
+    """
+
+    def __init__(self, path, flush_rows=AGGREGATE_SINK_FLUSH_ROWS):
+        super().__init__(path, flush_rows)
+        self._file = None
+
+    def _open(self):
+        self._file = open(self._path, "w", newline="")
+        self._header = True
+
+    def _write(self, df, iterations):
+        df.to_csv(self._file, header=self._header, index=False)
+        self._file.flush()
+        self._header = False
+
+    def _finish(self):
+        self._file.close()
+
+
+def _participant_set(participants):
+    if participants is None:
+        return None
+    participants = frozenset(participants)
+    if not all(isinstance(p, numbers.Integral) for p in participants):
+        raise ValueError(f"The participants, {set(participants)}, are not all integers")
+    return participants
+
+
+class DetailsPolicy:
+    """Selects which of an :class:`Agent`'s choices have their details recorded in :attr:`Agent.details`.
+    Assigning a :class:`DetailsPolicy` to :attr:`Agent.details` causes details to be
+    recorded for only some of the agent's choices, and the intermediate values
+    describing the others not to be computed at all.
+
+    Only every *sample_every* th choice of a participant is recorded, starting with the
+    first. If *participants* is not ``None`` it should be a collection of integers, and
+    only choices of those participants are recorded; participants are numbered as
+    described for :attr:`Agent.details`. If *times* is not ``None`` it should be a
+    container, such as a :class:`set` or a :class:`range`, and only choices made at
+    times it contains are recorded. If *choices* is not ``None`` it should be a
+    collection of choices, in any of the forms accepted by :meth:`Agent.choose`, and
+    only the details of those options of a choice that are the same as one of them are
+    recorded; a choice none of whose options is among them is not recorded at all.
+    These choices are checked when the policy is assigned to :attr:`Agent.details`,
+    raising the same errors :meth:`Agent.choose` would. If *maxlen* is not
+    ``None`` details are recorded in a :class:`collections.deque` of that length, so
+    that only those of the most recent *maxlen* choices recorded are retained.
+
+    A :exc:`ValueError` is raised if *sample_every* or *maxlen* is not a positive
+    integer, or if *participants* contains anything other than integers.
+
+    >>> a = Agent(default_utility=10, default_utility_populates=True)
+    >>> a.details = DetailsPolicy(sample_every=10, choices=["b"], maxlen=3)
+    >>> for i in range(100):
+    ...     a.respond(i % 7 if a.choose(["a", "b", "c"]) == "b" else 4)
+    >>> [len(d) for d in a.details], [d[0]["decision"] for d in a.details]
+    ([1, 1, 1], ['b', 'b', 'b'])
+    """
+
+    def __init__(self, sample_every=1, participants=None, times=None, choices=None,
+                 maxlen=None):
+        self._sample_every = _count(sample_every, "sample_every")
+        self._participants = _participant_set(participants)
+        self._times = times
+        self._choices = list(choices) if choices is not None else None
+        self._maxlen = _count(maxlen, "maxlen") if maxlen is not None else None
+
+    def __repr__(self):
+        return (f"<DetailsPolicy sample_every={self._sample_every}"
+                + "".join(f" {k}={v}" for k, v in (("participants", self._participants),
+                                                  ("times", self._times),
+                                                  ("choices", self._choices),
+                                                  ("maxlen", self._maxlen))
+                          if v is not None)
+                + ">")
+
+    @property
+    def sample_every(self):
+        """The interval between the choices of a participant that are recorded."""
+        return self._sample_every
+
+    @property
+    def participants(self):
+        """A frozenset of the participants recorded, or ``None`` if all are."""
+        return self._participants
+
+    @property
+    def times(self):
+        """The container of times at which choices are recorded, or ``None`` if at all."""
+        return self._times
+
+    @property
+    def choices(self):
+        """A list of the options whose details are recorded, or ``None`` if all are."""
+        return self._choices
+
+    @property
+    def maxlen(self):
+        """The greatest number of choices whose details are retained, or ``None``."""
+        return self._maxlen
+
+    def _wants(self, participant, choice, time):
+        return (choice % self._sample_every == 0
+                and (self._participants is None or participant in self._participants)
+                and (self._times is None or time in self._times))
+
+
+class TraceWriter:
+    """A destination for an :class:`Agent`'s :attr:`Agent.trace` to which it is written compactly, as JSON Lines.
+    Assigning a :class:`TraceWriter` to :attr:`Agent.trace` causes the values that would
+    otherwise be printed as tables to instead be written to *file*, which may be the
+    name of a file, overwritten if it already exists, or an open, writable text file.
+    Each choice traced is written as a single line, a JSON object with the keys
+
+    * ``agent``, the agent's :attr:`Agent.name`
+    * ``participant``, the number of the participant making the choice
+    * ``choice``, the index of the choice among that participant's, counting from zero
+    * ``time``, the agent's :attr:`Agent.time` when it was made
+    * ``attributes``, a list of the agent's :attr:`Agent.attributes`, or ``["decision"]``
+      if it has none
+    * ``mismatch``, whether partial matching was in use
+    * ``temperature``, the temperature used, :attr:`Agent.temperature` or, if that is
+      ``None``, the default derived from :attr:`Agent.noise`
+    * ``chosen``, the index of the option chosen
+    * ``options``, a list with an object for each option offered, in order, holding the
+      ``option`` itself, an object of its attribute values or, for an agent without
+      attributes, the decision; the ``blended`` value computed for it; and a list of
+      the ``instances`` contributing to that value, each an object with keys ``id``,
+      ``attributes``, ``created``, ``occurrences``, ``outcome``, ``base_activation``,
+      ``activation_noise``, ``activation`` and ``retrieval_probability``, and, if
+      partial matching is in use, ``mismatch``, its mismatch adjustment
+
+    Values that cannot be represented in JSON, such as some attribute values, are
+    written as strings. Lines are accumulated and written *buffer_records* at a time. The
+    trace can be printed in the same form as when :attr:`Agent.trace` is ``True`` by
+    :func:`print_trace`, or read with, for example, :func:`pandas.read_json` with
+    ``lines=True``.
+
+    Only every *sample_every* th choice of a participant is traced, starting with the
+    first, and if *participants* is not ``None`` it should be a collection of integers,
+    and only choices of those participants are traced. Participants are numbered as
+    described for :attr:`Agent.trace`. Choices that are not traced cost almost nothing
+    to skip. A :exc:`ValueError` is raised if *sample_every* or *buffer_records* is not
+    a positive integer, or if *participants* contains anything other than integers.
+
+    A writer may be shared by several agents. When they have finished :meth:`close`
+    should be called to ensure any remaining lines are written; alternatively the
+    writer may be used as a context manager.
+
+    >>> with TraceWriter("trace.jsonl", sample_every=100, participants={3, 17}) as w:
+    ...     a = Agent(default_utility=4)
+    ...     a.trace = w
+    ...     for p in range(20):
+    ...         a.reset()
+    ...         for r in range(1000):
+    ...             a.respond(3 if a.choose(["safe", "risky"]) == "safe" else
+    ...                       (10 if random.random() < 0.25 else 0))
+    >>> print_trace("trace.jsonl")
+    """
+
+    def __init__(self, file, sample_every=1, participants=None,
+                 buffer_records=TRACE_BUFFER_RECORDS):
+        self._sample_every = _count(sample_every, "sample_every")
+        self._buffer_records = _count(buffer_records, "buffer_records")
+        self._participants = _participant_set(participants)
+        self._buffer = []
+        self._closed = False
+        if isinstance(file, io.TextIOBase):
+            self._file = file
+            self._name = getattr(file, "name", repr(file))
+            self._owns_file = False
+        else:
+            self._name = os.fspath(file)
+            self._file = open(self._name, "w")
+            self._owns_file = True
+
+    def __repr__(self):
+        return f"<TraceWriter {self._name}>"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def sample_every(self):
+        """The interval between the choices of a participant that are traced."""
+        return self._sample_every
+
+    @property
+    def participants(self):
+        """A frozenset of the participants traced, or ``None`` if all are."""
+        return self._participants
+
+    def _wants(self, participant, choice):
+        return (choice % self._sample_every == 0
+                and (self._participants is None or participant in self._participants))
+
+    def _write(self, record):
+        if self._closed:
+            raise RuntimeError(f"{self} has already been closed")
+        self._buffer.append(json.dumps(record, default=_trace_json_value))
+        if len(self._buffer) >= self._buffer_records:
+            self.flush()
+
+    def flush(self):
+        """Writes all the lines accumulated so far."""
+        if self._buffer:
+            self._file.write("\n".join(self._buffer))
+            self._file.write("\n")
+            self._buffer = []
+        if not self._closed:
+            self._file.flush()
+
+    def close(self):
+        """Writes any remaining lines and, if it was opened by this writer, closes the file.
+        Closing a writer that is already closed has no effect.
+        """
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            if self._owns_file:
+                self._file.close()
+
+
+def _trace_json_value(value):
+    # Converts values JSON cannot otherwise encode, such as NumPy integers and
+    # arrays, and arbitrary attribute values.
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+def _print_trace_record(record, file):
+    # Prints a choice traced by Agent.choose() as tables, one for each option.
+    for option in record["options"]:
+        print(file=file)
+        if isinstance(option["option"], dict):
+            print(", ".join(f"{k}: {v}" for k, v in option["option"].items()),
+                  end="", file=file)
+        else:
+            print(option["option"], end="", file=file)
+        print(f" → {option['blended']} @ time={record['time']}", file=file)
+        tab = PrettyTable()
+        fields = (["id"] + record["attributes"] +
+                  ["created", "occurrences", "outcome", "base activation", "activation noise"])
+        if record["mismatch"]:
+            fields.append("mismatch adjustment")
+        fields.extend(["total activation", "exp(act / temp)", "retrieval probability"])
+        tab.field_names = fields
+        for d in option["instances"]:
+            row = [d["id"], *d["attributes"].values(), d["created"], d["occurrences"],
+                   d["outcome"], d["base_activation"], d["activation_noise"]]
+            if record["mismatch"]:
+                row.append(d["mismatch"])
+            row.append(d["activation"])
+            row.append(math.exp(d["activation"] / record["temperature"]))
+            row.append(d["retrieval_probability"])
+            tab.add_row(row)
+        print(tab, file=file, flush=True)
+    print(f"\n   {'='*140}", file=file)
+
+
+def print_trace(source, file=None, participants=None):
+    """Prints, for reading by humans, a trace written by a :class:`TraceWriter`.
+    The *source* should be the name of a file written by a :class:`TraceWriter`, or an
+    open text file from which one can be read. The choices are printed as tables, in
+    the same form as if :attr:`Agent.trace` had been set to ``True``. If *file* is
+    ``None``, the default, they are printed to standard out; otherwise it should be an
+    open, writable ``file``.
+    If *participants* is not ``None`` it should be a collection of integers, and only
+    choices by those participants are printed.
+    """
+    if file is None:
+        file = sys.stdout
+    if participants is not None:
+        participants = frozenset(participants)
+    with (contextlib.nullcontext(source) if isinstance(source, io.TextIOBase)
+          else open(source)) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if participants is None or record["participant"] in participants:
+                _print_trace_record(record, file)
+
+
+def _read_aggregate_details(path, columns):
+    # Reads those of the given columns that are present from a file written by a
+    # ParquetSink or CSVSink, or from a directory of such files.
+    columns = list(dict.fromkeys(columns))
+    path = os.fspath(path)
+    if os.path.isdir(path):
+        files = sorted(os.path.join(path, f) for f in os.listdir(path)
+                       if f.endswith(".parquet") or f.endswith(".csv"))
+    else:
+        files = [path]
+    if not files:
+        raise ValueError(f"No aggregate details found in {path}")
+    dfs = []
+    for f in files:
+        if f.endswith(".csv"):
+            dfs.append(pd.read_csv(f, usecols=(lambda c: c in columns)))
+        else:
+            import pyarrow.parquet
+            present = pyarrow.parquet.read_schema(f).names
+            dfs.append(pd.read_parquet(f, columns=[c for c in columns if c in present]))
+    return pd.concat(dfs, ignore_index=True) if len(dfs) > 1 else dfs[0]
+
 
 def df_plot(df, kind, title=None, xlabel=None, ylabel=None,
             include=None, exclude=None, min=None, max=None, earliest=None, latest=None,
@@ -1361,7 +3402,13 @@ def df_plot(df, kind, title=None, xlabel=None, ylabel=None,
     The first argument should be a Pandas DataFrame, congruent to one such as might be
     produced by :attr:`Agent.aggrregate_details`. The plots produced are the same as would
     have been produced by an :class:`Agent` with those aggregate details, with the rest of
-    the arguments being the same as for :meth:`Agent.plot`.
+    the arguments being the same as for :meth:`Agent.plot`. Instead of a DataFrame the
+    first argument may also be the path of a file or directory written by a
+    :class:`ParquetSink` or :class:`CSVSink`, in which case only those columns needed
+    for the plot are read, or a DataFrame of summary statistics, such as is the value of
+    :attr:`Agent.aggregate_details` when it has been set to ``"summary"``. It may also
+    be an :class:`AggregateRecorder` or :class:`AggregateSummary`, such as the result of
+    merging those gathered in several processes.
 
     This function can sometimes be useful in specialized circumstances, such as
     combining the results from multiple simulations using isomorphic Agents.
@@ -1371,14 +3418,29 @@ def df_plot(df, kind, title=None, xlabel=None, ylabel=None,
     of other errors may be raised if values in *df* are not of the types or ranges
     that might be expected in an :class:`Agent`'s results.
     """
+    required = AGGREGATE_COLUMNS
+    if isinstance(df, (AggregateRecorder, AggregateSummary)):
+        df = df.frame()
+    elif isinstance(df, (str, os.PathLike)):
+        required = ("iteration", "time", "choice", "utility", "option")
+        df = _read_aggregate_details(df, required + ((_PLOT_COLUMNS.get(kind, kind),)
+                                                     if isinstance(kind, str) else ()))
     if not isinstance(df, pd.DataFrame):
         raise ValueError(f"First argument to df_plot must be a DataFrame, not {df}")
+    if summary := "statistic" in df.columns:
+        required = SUMMARY_COLUMNS
     for c in df.columns:
-        if not (c in AGGREGATE_COLUMNS + ("mismatch",) or c.endswith(".similarity")):
+        if not (c in (SUMMARY_COLUMNS if summary else AGGREGATE_COLUMNS + ("mismatch",))
+                or (c.endswith(".similarity") and not summary)):
             raise ValueError(f"DataFrame column {c} cannot be plotted")
-    for c in AGGREGATE_COLUMNS:
+    for c in required:
         if c not in df.columns:
             raise ValueError(f"The DataFrame does not contain columns {c} and cannot be plotted")
+    if summary:
+        statistics = set(df["statistic"].unique())
+        present = lambda c: c in statistics
+    else:
+        present = lambda c: c in df and not df[c].isna().all()
     if min and not isinstance(min, numbers.Real):
         raise ValueError(f"The min value, {min}, is neither a Real number nor None")
     if max and not isinstance(max, numbers.Real):
@@ -1395,20 +3457,26 @@ def df_plot(df, kind, title=None, xlabel=None, ylabel=None,
                  }.get(kind)
     if not plot_kind:
         if isinstance(kind, str) and kind.endswith(".similarity"):
-            if kind in df:
+            if present(kind):
                 plot_kind = InstancePlot(kind, f"Mean similarities of {kind[0:-11]}",  True)
             else:
                 raise ValueError(f"The {kind[0:-11]} attribute is either absent or not partially matched")
         else:
             raise ValueError(f"Unknown plot kind {kind}")
-    if kind == "mismatch" and "mismatch" not in df:
+    if kind == "mismatch" and not present("mismatch"):
         raise ValueError("Can't generate a mismatch plot when no attributes were partially matched")
     if xlabel is None:
         xlabel = "Time"
     if ylabel is None:
         ylabel = plot_kind._description
-    data = plot_kind.get_data(df, include, exclude, min, max, earliest, latest)
-    colors_and_styles = _plot_ordering(df, data)
+    if summary:
+        data = plot_kind.get_summary_data(df, include, exclude, min, max, earliest, latest)
+        instances = df[~df["statistic"].isin(("choice", "blended_value"))]
+        colors_and_styles = _plot_ordering(instances["option"].unique(),
+                                           instances["utility"].unique(), data)
+    else:
+        data = plot_kind.get_data(df, include, exclude, min, max, earliest, latest)
+        colors_and_styles = _plot_ordering(df["option"].unique(), df["utility"].unique(), data)
     plt.clf()
     mint = None
     maxt = None
@@ -1448,11 +3516,18 @@ def df_plot(df, kind, title=None, xlabel=None, ylabel=None,
         plt.show()
     return plt.gcf()
 
-def _plot_ordering(df, data):
-    options = sorted(df["option"].unique())
+_PLOT_COLUMNS = {"choice": "choice",
+                 "bv": "blended_value",
+                 "probability": "retrieval_probability",
+                 "activation": "activation",
+                 "baselevel": "base_level_activation",
+                 "mismatch": "mismatch"}
+
+def _plot_ordering(options, utilities, data):
+    options = sorted(options)
     if len(options) > len(PLOT_COLORS):
         return None
-    utilities = sorted([n for n in df["utility"].unique()], reverse=True)
+    utilities = sorted([n for n in utilities], reverse=True)
     if all(math.isclose(u, round(u)) for u in utilities):
         utilities = [int(u) for u in utilities]
     result = {}
@@ -1515,6 +3590,52 @@ class Plot():
     def get_data(self, data, include, exclude, min, max, earliest, latest):
         raise NotImplementedError()
 
+    def get_summary_data(self, summary, include, exclude, min, max, earliest, latest):
+        raise NotImplementedError()
+
+    @staticmethod
+    def _time_range(data, earliest, latest):
+        if earliest is not None:
+            data = data[data.time >= earliest]
+        if latest is not None:
+            data = data[data.time <= latest]
+        return data
+
+    def _means(self, data, keys, earliest, latest):
+        # Returns a dict mapping tuples of the distinct values of the columns of data
+        # named by keys to a pair: the times, in increasing order, at which rows with those
+        # values occur, and the means of this plot's column in those rows at those times.
+        d = Plot._time_range(data, earliest, latest)
+        factorized = [pd.factorize(d[k]) for k in keys]
+        grouped = d.groupby([c for c, u in factorized] + [d.time.to_numpy()])[self._column].mean()
+        if grouped.empty:
+            return {}
+        groups = np.stack([grouped.index.get_level_values(i).to_numpy()
+                           for i in range(len(keys))], axis=1)
+        starts = np.flatnonzero(np.concatenate([[True],
+                                                (groups[1:] != groups[:-1]).any(axis=1)]))
+        ends = np.append(starts[1:], len(grouped))
+        times = grouped.index.get_level_values(len(keys)).to_numpy()
+        values = grouped.to_numpy()
+        return {tuple(u[g] for (c, u), g in zip(factorized, groups[s])):
+                (times[s:e].tolist(), values[s:e])
+                for s, e in zip(starts, ends)}
+
+    @staticmethod
+    def _summary_rows(summary, statistic, earliest, latest):
+        d = summary[summary.statistic == statistic]
+        if earliest is not None:
+            d = d[d.time >= earliest]
+        if latest is not None:
+            d = d[d.time <= latest]
+        return d
+
+    @staticmethod
+    def _summary_means(d):
+        grouped = d.groupby("time")[["count", "sum"]].sum()
+        grouped = grouped[grouped["count"] > 0]
+        return (list(grouped.index), list(grouped["sum"] / grouped["count"]))
+
     def yticks(self):
         return None
 
@@ -1525,34 +3646,42 @@ class ChoicePlot(Plot):
         super().__init__(column, description, limit_range)
 
     def get_data(self, data, include, exclude, min, max, earliest, latest):
-        counters = {}
-        sums = defaultdict(int)
-        times = set()
+        d = Plot._time_range(data, earliest, latest)
+        # one row for each decision made, that is for each iteration and time
+        d = d.drop_duplicates(["iteration", "time"])
+        d = d[d.choice.notna()]
+        times, time_codes = np.unique(d.time.to_numpy(), return_inverse=True)
+        choice_codes, choices = pd.factorize(d.choice)
+        counts = np.zeros((len(times), len(choices)))
+        np.add.at(counts, (time_codes, choice_codes), 1)
+        fractions = counts / counts.sum(axis=1)[:, None]
+        columns = {ch: j for j, ch in enumerate(choices)}
+        times = tuple(times.tolist())
+        result = {}
         for ch in data.choice.unique():
-            d = data[data.choice==ch]
-            if earliest is not None:
-                d = d[d.time >= earliest]
-            if latest is not None:
-                d = d[d.time <= latest]
-            grouped = d.groupby(["iteration", "time"])
-            # There's probably a better way to do this within Pandas, right?
-            cnt = Counter([t for (i, t), ignore in grouped[["iteration", "time"]]])
-            times.update(cnt.keys())
-            for k in cnt:
-                sums[k] += cnt[k]
-            counters[ch] = cnt
+            if include and ch not in include:
+                continue
+            if exclude and ch in exclude:
+                continue
+            if (j := columns.get(ch)) is not None:
+                result[ch] = (times, tuple(fractions[:, j].tolist()))
+            elif times:
+                result[ch] = (times, (0,) * len(times))
+            else:
+                result[ch] = ()
+        return result
+
+    def get_summary_data(self, summary, include, exclude, min, max, earliest, latest):
+        d = Plot._summary_rows(summary, "choice", earliest, latest)
+        sums = d.groupby("time")["count"].sum()
         result = {}
-        for ch, cnt in counters.items():
+        for ch, g in d.groupby("option", sort=False):
             if include and ch not in include:
                 continue
             if exclude and ch in exclude:
                 continue
-            for k, v in cnt.items():
-                cnt[k] /= sums[k]
-            for t in times:
-                if t not in cnt:
-                    cnt[t] = 0
-            result[ch] = tuple(zip(*sorted(cnt.items())))
+            cnt = g.groupby("time")["count"].sum().reindex(sums.index, fill_value=0)
+            result[ch] = (tuple(sums.index), tuple(cnt / sums))
         return result
 
     def yticks(self):
@@ -1564,20 +3693,25 @@ class OptionPlot(Plot):
         super().__init__(column, description, limit_range)
 
     def get_data(self, data, include, exclude, min, max, earliest, latest):
+        means = self._means(data, ["option"], earliest, latest)
         result = {}
         for opt in data.option.unique():
             if include and opt not in include:
                 continue
             if exclude and opt in exclude:
                 continue
-            d = data[(data.option==opt)]
-            if earliest is not None:
-                d = d[d.time >= earliest]
-            if latest is not None:
-                d = d[d.time <= latest]
-            grouped = d.groupby("time")
-            result[opt] = ([t for t, ignore in grouped["time"]],
-                           grouped[self._column].mean())
+            result[opt] = means.get((opt,), ([], []))
+        return result
+
+    def get_summary_data(self, summary, include, exclude, min, max, earliest, latest):
+        result = {}
+        d = Plot._summary_rows(summary, self._column, earliest, latest)
+        for opt, g in d.groupby("option", sort=False):
+            if include and opt not in include:
+                continue
+            if exclude and opt in exclude:
+                continue
+            result[opt] = Plot._summary_means(g)
         return result
 
 
@@ -1586,6 +3720,7 @@ class InstancePlot(Plot):
         super().__init__(column, description, limit_range)
 
     def get_data(self, data, include, exclude, min, max, earliest, latest):
+        means = self._means(data, ["option", "utility"], earliest, latest)
         result = {}
         for opt, util in data[["option", "utility"]].drop_duplicates().itertuples(index=False, name=None):
             if include and opt not in include:
@@ -1596,19 +3731,29 @@ class InstancePlot(Plot):
                 continue
             if max and util > max:
                 continue
-            d = data[(data.option==opt) & (data.utility==util)]
-            if earliest is not None:
-                d = d[d.time >= earliest]
-            if latest is not None:
-                d = d[d.time <= latest]
-            grouped = d.groupby("time")
-            result[f"{opt}, {util}"] = ([t for t, ignore in grouped["time"]],
-                                        grouped[self._column].mean())
+            result[f"{opt}, {util}"] = means.get((opt, util), ([], []))
         return result
 
-
-class RetrievalProbabilyPlot(InstancePlot):
-
+    def get_summary_data(self, summary, include, exclude, min, max, earliest, latest):
+        result = {}
+        d = Plot._summary_rows(summary, self._column, earliest, latest)
+        for (opt, util), g in d.groupby(["option", "utility"], sort=False):
+            if include and opt not in include:
+                continue
+            if exclude and opt in exclude:
+                continue
+            if min and util < min:
+                continue
+            if max and util > max:
+                continue
+            times, means = Plot._summary_means(g)
+            if times:
+                result[f"{opt}, {util}"] = (times, means)
+        return result
+
+
+class RetrievalProbabilyPlot(InstancePlot):
+
     def __init__(self, column, description, limit_range=False):
         super().__init__(column, description, limit_range)
 
@@ -1713,6 +3858,2127 @@ class DelayedResponse:
         return old
 
 
+class Cohort:
+    """A collection of independent virtual participants, each equivalent to a freshly created :class:`Agent`, all making their decisions in lockstep.
+    A very common pattern for PyIBL models is to run the same sequence of
+    choose/respond cycles for each of a large number of virtual participants. A
+    :class:`Cohort` holds the memories of all *participants* of them as NumPy arrays,
+    with one row per participant and one column per instance, and a single call to
+    :meth:`choose` or :meth:`respond` operates on all of the participants at once. The
+    results are statistically equivalent to those of *participants* separate
+    :class:`Agent` objects, but for large numbers of participants they are typically
+    computed one or two orders of magnitude faster.
+
+    The *participants* argument should be a positive integer; if it is not a
+    :exc:`ValueError` is raised. The *attributes*, *noise*, *decay*, *temperature*,
+    *optimized_learning*, *default_utility* and *default_utility_populates* arguments
+    are as for :class:`Agent`, except that *optimized_learning* must be either ``True``
+    or ``False``. A :class:`Cohort` can also be created from an existing :class:`Agent`
+    with :meth:`Agent.cohort`.
+
+    Partial matching is not supported; only instances matching a choice exactly are
+    consulted. Nor does a :class:`Cohort` support :attr:`Agent.details`,
+    :attr:`Agent.trace` or :attr:`Agent.aggregate_details`.
+
+    >>> c = Cohort(10_000, default_utility=4.8)
+    >>> risky = np.zeros(60)
+    >>> for round in range(60):
+            choices = c.choose(["safe", "risky"])
+            c.respond(np.where(choices == "safe", 3,
+                               np.where(np.random.random(c.participants) < 0.25, 12, 0)))
+            risky[round] = np.mean(choices == "risky")
+    >>> risky[:5]
+    array([0.4976, 0.5021, 0.4234, 0.3882, 0.3722])
+    """
+
+    def __init__(self,
+                 participants,
+                 attributes=[],
+                 noise=pyactup.DEFAULT_NOISE,
+                 decay=pyactup.DEFAULT_DECAY,
+                 temperature=None,
+                 optimized_learning=False,
+                 default_utility=None,
+                 default_utility_populates=True):
+        self._participants = _count(participants, "number of participants")
+        self._attributes = pyactup.Memory._ensure_slot_names(attributes)
+        self._noise = pyactup.DEFAULT_NOISE
+        self._temperature = None
+        self.temperature = temperature # set temperature BEFORE noise
+        self.noise = noise
+        self._lag_table = _LagTable()
+        self.decay = decay
+        self._optimized_learning = False
+        self.optimized_learning = optimized_learning
+        self.default_utility = default_utility
+        self.default_utility_populates = default_utility_populates
+        self._option_codes = {}
+        self._rng = np.random.default_rng(random.getrandbits(128))
+        self.reset()
+
+    def __repr__(self):
+        return f"<Cohort {self._participants} {id(self)}>"
+
+    @property
+    def participants(self):
+        """The number of virtual participants in this :class:`Cohort`.
+        It is set when the :class:`Cohort` is created and cannot be changed thereafter.
+        """
+        return self._participants
+
+    @property
+    def attributes(self):
+        """A tuple of the names of the attributes of the choices made by this :class:`Cohort`, as for :attr:`Agent.attributes`.
+        """
+        return self._attributes
+
+    @property
+    def time(self):
+        """The current time of all the participants in this :class:`Cohort`, as for :attr:`Agent.time`.
+        """
+        return self._time
+
+    def advance(self, increment=1):
+        """Advances the time of all the participants in this :class:`Cohort` by *increment* time steps, and returns the updated :attr:`time`.
+        The *increment* should be a non-negative integer; if it is not a
+        :exc:`ValueError` is raised.
+        """
+        self._time += _count(increment, "increment", 0)
+        return self._time
+
+    @property
+    def noise(self):
+        """The amount of noise to add during instance activation computation, as for :attr:`Agent.noise`.
+        """
+        return self._noise
+
+    @noise.setter
+    def noise(self, value):
+        pyactup.Memory.is_real(value, "noise")
+        value = float(value) if value else 0.0
+        if (self._temperature is None
+            and not pyactup.Memory._validate_temperature(None, value)):
+            warn(f"Setting noise to {value} will make the temperature too low; setting temperature to 1")
+            self._temperature = 1.0
+        self._noise = value
+
+    @property
+    def decay(self):
+        """Controls the rate at which activation for previously experienced instances decays with the passage of time, as for :attr:`Agent.decay`.
+        """
+        return self._decay
+
+    @decay.setter
+    def decay(self, value):
+        pyactup.Memory.is_real(value, "decay")
+        value = float(value) if value else 0.0
+        if value >= 1 and getattr(self, "_optimized_learning", False):
+            raise ValueError(f"The decay, {value}, must be less than one if optimized_learning is used")
+        self._decay = value
+        self._lag_table.decay = value
+
+    @property
+    def temperature(self):
+        """The temperature parameter used for blending values, as for :attr:`Agent.temperature`.
+        """
+        return self._temperature
+
+    @temperature.setter
+    def temperature(self, value):
+        if value is None or value is False:
+            value = None
+        else:
+            pyactup.Memory.is_real(value, "temperature", True, True)
+            value = float(value)
+        if not pyactup.Memory._validate_temperature(value, self._noise):
+            if value is None:
+                raise ValueError(f"The noise, {self._noise}, is too low to for the temperature to be set to None.")
+            else:
+                raise ValueError(f"The temperature, {value}, must not be less than {pyactup.MINIMUM_TEMPERATURE}.")
+        self._temperature = value
+
+    @property
+    def optimized_learning(self):
+        """Whether or not this :class:`Cohort` uses the optimized learning approximation, as for :attr:`Agent.optimized_learning`.
+        Only ``True`` and ``False`` are supported; attempting to set it to anything else
+        raises a :exc:`ValueError`. As for an :class:`Agent`, it can only be changed when
+        no participant's memory contains any instances, and a :exc:`RuntimeError` is raised
+        otherwise.
+        """
+        return self._optimized_learning
+
+    @optimized_learning.setter
+    def optimized_learning(self, value):
+        if value not in (True, False, None):
+            raise ValueError(f"The optimized_learning of a Cohort must be True or False, not {value}")
+        value = bool(value)
+        if value and self._decay >= 1:
+            raise ValueError(f"Optimized learning cannot be used when the decay, "
+                             f"{self._decay}, is greater than or equal to one.")
+        if value != self._optimized_learning and getattr(self, "_counts", None) is not None and self._counts.any():
+            raise RuntimeError("Cannot change optimized learning for a Cohort that "
+                               "already contains instances")
+        self._optimized_learning = value
+
+    @property
+    def default_utility(self):
+        """The utility, or a function to compute the utility, if there is no matching instance, as for :attr:`Agent.default_utility`.
+        """
+        return self._default_utility
+
+    @default_utility.setter
+    def default_utility(self, value):
+        if value is False:
+            value = None
+        self._callable_default_utility = not (value is None or isinstance(value, numbers.Real))
+        self._default_utility = value
+
+    @property
+    def default_utility_populates(self):
+        """Whether or not a default utility is also entered as an instance in memory, as for :attr:`Agent.default_utility_populates`.
+        """
+        return self._default_utility_populates
+
+    @default_utility_populates.setter
+    def default_utility_populates(self, value):
+        self._default_utility_populates = bool(value)
+
+    _make_queries = Agent._make_queries
+    _canonicalize_choice = Agent._canonicalize_choice
+
+    def reset(self, preserve_prepopulated=False):
+        """Erases the memories of all the participants in this :class:`Cohort` and resets its time to zero.
+        If *preserve_prepopulated* is true those instances created at time zero, and
+        their references at time zero, are retained, as for :meth:`Agent.reset`.
+        """
+        n = self._participants
+        if preserve_prepopulated and getattr(self, "_counts", None) is not None:
+            if self._optimized_learning:
+                warn("The preserve_prepopulated argument to reset() cannot be used when "
+                     "optimized_learning is on, and is being ignored")
+            else:
+                self._preserve_prepopulated()
+                return
+        self._sizes = np.zeros(n, dtype=np.int64)
+        self._options = np.full((n, COHORT_INITIAL_INSTANCES), -1, dtype=np.int64)
+        self._utilities = np.zeros((n, COHORT_INITIAL_INSTANCES))
+        self._counts = np.zeros((n, COHORT_INITIAL_INSTANCES), dtype=np.int64)
+        self._creations = np.zeros((n, COHORT_INITIAL_INSTANCES), dtype=np.int64)
+        self._reference_times = np.empty(COHORT_INITIAL_REFERENCES, dtype=np.int64)
+        self._reference_columns = np.empty((COHORT_INITIAL_REFERENCES, n), dtype=np.int64)
+        self._reference_length = 0
+        self._time = 0
+        self._last_learn_time = 0
+        self._previous_choices = None
+        self._pending_decision = None
+
+    def _preserve_prepopulated(self):
+        n = self._participants
+        m = self._reference_length
+        old = self._reference_times[:m] <= 0
+        times = self._reference_times[:m][old]
+        columns = self._reference_columns[:m][old]
+        width = self._options.shape[1]
+        counts = np.zeros((n, width), dtype=np.int64)
+        valid = columns >= 0
+        np.add.at(counts, (np.broadcast_to(np.arange(n), columns.shape)[valid], columns[valid]), 1)
+        keep = (counts > 0) & (self._creations <= 0)
+        order = np.argsort(~keep, axis=1, kind="stable")
+        self._options = np.take_along_axis(np.where(keep, self._options, -1), order, axis=1)
+        self._utilities = np.take_along_axis(self._utilities, order, axis=1)
+        self._counts = np.take_along_axis(np.where(keep, counts, 0), order, axis=1)
+        self._creations = np.take_along_axis(self._creations, order, axis=1)
+        self._sizes = keep.sum(axis=1)
+        inverse = np.argsort(order, axis=1)
+        rows = np.broadcast_to(np.arange(n), columns.shape)
+        remapped = np.full(columns.shape, -1, dtype=np.int64)
+        kept = valid & keep[rows, np.where(valid, columns, 0)]
+        remapped[kept] = inverse[rows[kept], columns[kept]]
+        self._reference_times[:len(times)] = times
+        self._reference_columns[:len(times)] = remapped
+        self._reference_length = len(times)
+        self._time = 0
+        self._last_learn_time = 0
+        self._previous_choices = None
+        self._pending_decision = None
+
+    def _ensure_width(self, width):
+        old = self._options.shape[1]
+        if width <= old:
+            return
+        new = max(width, COHORT_GROWTH_FACTOR * old)
+        def grow(a, fill):
+            result = np.full((a.shape[0], new), fill, dtype=a.dtype)
+            result[:, :old] = a
+            return result
+        self._options = grow(self._options, -1)
+        self._utilities = grow(self._utilities, 0)
+        self._counts = grow(self._counts, 0)
+        self._creations = grow(self._creations, 0)
+
+    def _append_references(self, rows, columns, when):
+        m = self._reference_length
+        if m >= len(self._reference_times):
+            new = COHORT_GROWTH_FACTOR * len(self._reference_times)
+            times = np.empty(new, dtype=np.int64)
+            times[:m] = self._reference_times[:m]
+            cols = np.empty((new, self._participants), dtype=np.int64)
+            cols[:m] = self._reference_columns[:m]
+            self._reference_times = times
+            self._reference_columns = cols
+        self._reference_times[m] = when
+        self._reference_columns[m] = -1
+        self._reference_columns[m, rows] = columns
+        self._reference_length += 1
+
+    def _learn(self, rows, options, utilities, when):
+        # rows is an array of distinct participant indices, with options (codes) and
+        # utilities aligned with it
+        width = int(self._sizes[rows].max(initial=0))
+        matches = ((self._options[rows, :width] == options[:, None])
+                   & (self._utilities[rows, :width] == utilities[:, None]))
+        if width:
+            columns = np.where(matches.any(axis=1), matches.argmax(axis=1), -1)
+        else:
+            columns = np.full(len(rows), -1)
+        if (new := columns < 0).any():
+            new_rows = rows[new]
+            new_columns = self._sizes[new_rows]
+            self._ensure_width(int(new_columns.max()) + 1)
+            self._options[new_rows, new_columns] = options[new]
+            self._utilities[new_rows, new_columns] = utilities[new]
+            self._creations[new_rows, new_columns] = when
+            self._sizes[new_rows] += 1
+            columns[new] = new_columns
+        self._counts[rows, columns] += 1
+        if not self._optimized_learning:
+            self._append_references(rows, columns, when)
+        self._last_learn_time = max(self._last_learn_time, when)
+
+    def _option_code(self, query):
+        key = tuple(query.items())
+        if (code := self._option_codes.get(key)) is None:
+            code = self._option_codes[key] = len(self._option_codes)
+        return code
+
+    @staticmethod
+    def _outcome_values(outcome, n):
+        try:
+            result = np.asarray(outcome, dtype=np.float64)
+        except (TypeError, ValueError):
+            result = None
+        if (result is None or result.ndim > 1 or (result.ndim == 1 and len(result) != n)
+            or not np.isfinite(result).all()):
+            raise ValueError(f"outcome {outcome} is neither a real number nor a sequence of "
+                             f"{n} real numbers")
+        return np.broadcast_to(result, n)
+
+    def populate(self, choices, outcome):
+        """Adds instances to the memories of all the participants, one for each of the *choices*, with the given *outcome*, at the current time.
+        The *choices* are as for :meth:`Agent.populate`. The *outcome* may be either a
+        single real number, used for all the participants, or a sequence of real numbers,
+        one for each participant. A :exc:`ValueError` is raised if any of the *choices* are
+        malformed or duplicates, or if *outcome* is not of one of these forms.
+        """
+        outcomes = Cohort._outcome_values(outcome, self._participants)
+        rows = np.arange(self._participants)
+        for q in self._make_queries(choices):
+            self._learn(rows, np.full(self._participants, self._option_code(q)), outcomes,
+                        self._time)
+
+    def _base_level_activations(self, width):
+        n = self._participants
+        t = self._time
+        with np.errstate(divide="ignore"):
+            if self._optimized_learning:
+                return (np.log(self._counts[:, :width] / (1 - self._decay))
+                        - self._decay * np.log(t - self._creations[:, :width]))
+            m = self._reference_length
+            columns = self._reference_columns[:m]
+            valid = (columns >= 0) & (columns < width)
+            lags = t - self._reference_times[:m]
+            if (lags[valid.any(axis=1)] <= 0).any():
+                raise RuntimeError(f"Error when computing activations, perhaps an instance's "
+                                   f"creation or reinforcement time is not in the past?")
+            weights = np.broadcast_to(self._lag_table(np.maximum(lags, 1))[:, None],
+                                      columns.shape)
+            flat = (columns + np.arange(n) * width)[valid]
+            sums = np.bincount(flat, weights=weights[valid], minlength=(n * width))
+            return np.log(sums.reshape((n, width)))
+
+    def _blend(self, choices, queries):
+        n = self._participants
+        width = int(self._sizes.max(initial=0))
+        activations = self._base_level_activations(width)
+        if self._noise:
+            activations += self._rng.logistic(scale=self._noise, size=activations.shape)
+        temperature = self._temperature or SQRT2 * self._noise
+        options = self._options[:, :width]
+        utilities = self._utilities[:, :width]
+        result = np.empty((n, len(choices)))
+        for j, c, q in zip(count(), choices, queries):
+            code = self._option_code(q)
+            matches = options == code
+            present = matches.any(axis=1)
+            a = np.where(matches, activations, -np.inf)
+            a -= np.where(present, a.max(axis=1, initial=-np.inf), 0)[:, None]
+            weights = np.exp(a / temperature)
+            total = weights.sum(axis=1)
+            np.divide((weights * utilities).sum(axis=1), total, out=result[:, j], where=present)
+            if not present.all():
+                if self._default_utility is None:
+                    raise RuntimeError(f"No experience available for choice {c}")
+                u = self._default_utility(c) if self._callable_default_utility else self._default_utility
+                result[~present, j] = Agent._outcome_value(u)
+                if self._default_utility_populates:
+                    rows = np.flatnonzero(~present)
+                    self._learn(rows, np.full(len(rows), code), np.full(len(rows), u, dtype=np.float64), 0)
+        return result
+
+    def choose(self, choices=None, details=False):
+        """Selects, for each participant, which of the *choices* is expected to result in the largest payoff, and returns them.
+        The *choices* are as for :meth:`Agent.choose`, and are the same for all the
+        participants. If no *choices* are supplied those used in the most recent call to
+        :meth:`choose` are reused. The result is a NumPy array, of length
+        :attr:`participants`, of the choices made by each participant, in order. Ties are
+        broken at random, independently for each participant.
+
+        If *details* is true a second value is also returned, a NumPy array of shape
+        :attr:`participants` by the number of *choices*, containing the blended values
+        computed for each choice by each participant.
+
+        After a call to :meth:`choose` a corresponding call must be made to
+        :meth:`respond` before calling :meth:`choose` again, or a :exc:`RuntimeError` is
+        raised. A :exc:`ValueError` is raised if the *choices* are malformed or duplicates,
+        or if none are supplied and there was no previous call to :meth:`choose` since
+        this :class:`Cohort` was created or last :meth:`reset`.
+        """
+        if self._pending_decision is not None:
+            raise RuntimeError("choice requested before previous outcome was supplied")
+        choices = list(choices if choices is not None else [])
+        if not choices:
+            if self._previous_choices:
+                choices = self._previous_choices
+            else:
+                raise ValueError("no choices were supplied and no default ones are available")
+        queries = self._make_queries(choices)
+        self._previous_choices = choices
+        if self._last_learn_time >= self._time:
+            self._time = self._last_learn_time + 1
+        utilities = self._blend(choices, queries)
+        best_utilities = utilities.max(axis=1, keepdims=True)
+        ties = np.where(utilities == best_utilities, self._rng.random(utilities.shape), -1)
+        best = ties.argmax(axis=1)
+        self._pending_decision = (best, queries, utilities)
+        options = np.empty(len(choices), dtype=object)
+        for i, c in enumerate(choices):
+            options[i] = c
+        result = options[best]
+        if details:
+            return result, utilities
+        return result
+
+    def respond(self, outcome=None):
+        """Provides the outcomes resulting from the most recent decisions selected by :meth:`choose`.
+        The *outcome* may be a single real number, used for all the participants, or a
+        sequence of real numbers, one for each participant, typically a NumPy array. If
+        *outcome* is ``None`` each participant learns the blended value it expected for its
+        choice, much like delayed feedback for an :class:`Agent`, though such expectations
+        cannot subsequently be updated.
+
+        If there has not been a call to :meth:`choose` since the last time :meth:`respond`
+        was called a :exc:`RuntimeError` is raised. If *outcome* is not of one of the
+        above forms a :exc:`ValueError` is raised.
+        """
+        if self._pending_decision is None:
+            raise RuntimeError(
+                f"outcome {outcome} supplied when no decision requiring an outcome is pending")
+        best, queries, utilities = self._pending_decision
+        n = self._participants
+        rows = np.arange(n)
+        if outcome is None:
+            outcomes = utilities[rows, best]
+        else:
+            outcomes = Cohort._outcome_values(outcome, n)
+        codes = np.array([self._option_code(q) for q in queries])
+        self._learn(rows, codes[best], outcomes, self._time)
+        self._pending_decision = None
+
+
+def _count(value, description, minimum=1):
+    # Returns value, which must be an integer no less than minimum, as an int.
+    try:
+        n = int(value)
+    except (TypeError, ValueError):
+        n = None
+    if n is None or n != value or n < minimum:
+        raise ValueError(f"The {description}, {value}, is not "
+                         f"{'a positive' if minimum else 'a non-negative'} integer")
+    return n
+
+
+class Experiment:
+    """Runs many independent virtual participants, each an :class:`Agent`, for a fixed number of rounds under each of one or more conditions, spreading them across multiple processes.
+    For each of the *conditions*, an iterable of arbitrary values, *participants*
+    virtual participants are run. For each participant a fresh agent is created by
+    calling *agent_factory* with the condition as its sole argument; it must return an
+    :class:`Agent`. Then, for each of the *rounds*, *round_function* is called with four
+    arguments, that agent, the condition, the round number, starting at zero, and a
+    NumPy :class:`numpy.random.Generator` specific to this participant, which should be
+    used for any random numbers the round requires, such as the outcome of a risky
+    choice. The value it returns, which should be a real number, is recorded as the
+    result of that round. The default *conditions* is a single condition, ``None``.
+
+    Each participant's agent has its :attr:`Agent.rng` replaced by a generator
+    specific to that participant, and both it and the one passed to *round_function*
+    are derived from a single master *seed* and the participant's position within the
+    experiment. So long as *agent_factory* and *round_function* use no other source of
+    randomness the results are therefore the same every time the experiment is run
+    with the same *seed*, regardless of the number of processes used or the order in
+    which they complete their work. If *seed* is ``None``, the default, a fresh one is
+    chosen, and can be retrieved with :attr:`seed`.
+
+    The participants are divided into chunks of *chunk_size* consecutive participants
+    in the same condition, and each chunk is run by one of *workers* processes of a
+    :class:`concurrent.futures.ProcessPoolExecutor`. If *workers* is ``None``, the
+    default, as many processes are used as the machine has CPUs. If it is zero the
+    participants are instead all run, one after another, in the calling process. If
+    *chunk_size* is ``None``, the default, one is chosen giving each process several
+    chunks. Because they must be sent to the other processes, unless *workers* is zero
+    *agent_factory* and *round_function* must be picklable, which typically means they
+    are functions defined at the top level of a module, not lambdas or nested functions.
+
+    A :exc:`ValueError` is raised if *participants* or *rounds* is not a positive
+    integer, *workers* is not ``None`` or a non-negative integer, *chunk_size* is not
+    ``None`` or a positive integer, or *conditions* is empty.
+
+    >>> def make_agent(condition):
+            return Agent(default_utility=(1.2 * condition))
+    >>> def run_round(agent, condition, round, rng):
+            choice = agent.choose(["safe", "risky"])
+            if choice == "safe":
+                agent.respond(3)
+            else:
+                agent.respond(condition if rng.random() < 3 / condition else 0)
+            return choice == "risky"
+    >>> results = Experiment(make_agent, run_round, [4, 12], 1000, 60, seed=1).run()
+    >>> results.mean(axis=1)[:, :5]
+    array([[0.504, 0.496, 0.684, 0.545, 0.529],
+           [0.499, 0.501, 0.476, 0.482, 0.42 ]])
+    """
+
+    def __init__(self,
+                 agent_factory,
+                 round_function,
+                 conditions=[None],
+                 participants=1,
+                 rounds=1,
+                 seed=None,
+                 workers=None,
+                 chunk_size=None):
+        self._agent_factory = agent_factory
+        self._round_function = round_function
+        self._conditions = tuple(conditions)
+        if not self._conditions:
+            raise ValueError("At least one condition must be supplied")
+        self._participants = _count(participants, "number of participants")
+        self._rounds = _count(rounds, "number of rounds")
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self._workers = _count(workers, "number of workers", 0)
+        if chunk_size is None:
+            chunk_size = -(-(len(self._conditions) * self._participants)
+                           // (EXPERIMENT_CHUNKS_PER_WORKER * max(self._workers, 1)))
+        self._chunk_size = _count(chunk_size, "chunk size")
+        self._seed = np.random.SeedSequence(seed).entropy
+
+    def __repr__(self):
+        return (f"<Experiment {len(self._conditions)}x{self._participants}x{self._rounds} "
+                f"{id(self)}>")
+
+    @property
+    def conditions(self):
+        """A tuple of the conditions under which the participants in this :class:`Experiment` are run.
+        """
+        return self._conditions
+
+    @property
+    def participants(self):
+        """The number of virtual participants run in each condition.
+        """
+        return self._participants
+
+    @property
+    def rounds(self):
+        """The number of rounds for which each virtual participant is run.
+        """
+        return self._rounds
+
+    @property
+    def workers(self):
+        """The number of processes across which the participants are spread, or zero if they are run in the calling process.
+        """
+        return self._workers
+
+    @property
+    def chunk_size(self):
+        """The maximum number of participants sent to a process together.
+        """
+        return self._chunk_size
+
+    @property
+    def seed(self):
+        """The master seed, an integer, from which the random number generators of all the participants are derived.
+        If a *seed* was supplied when this :class:`Experiment` was created it is that
+        seed. Otherwise it is the one chosen at random, and supplying it when creating a
+        subsequent :class:`Experiment` will reproduce its results.
+        """
+        return self._seed
+
+    def run(self):
+        """Runs all the participants in all the conditions, and returns their results.
+        The result is a NumPy array of shape number of :attr:`conditions` by
+        :attr:`participants` by :attr:`rounds`, containing the values returned by
+        *round_function*. Each call runs the whole experiment afresh, producing the same
+        results. If *agent_factory* or *round_function* raises an exception, the
+        participants not yet run are abandoned and the exception is propagated.
+        """
+        result = np.empty((len(self._conditions), self._participants, self._rounds))
+        chunks = [(i, start, min(start + self._chunk_size, self._participants))
+                  for i in range(len(self._conditions))
+                  for start in range(0, self._participants, self._chunk_size)]
+        def arguments(i, start, stop):
+            return (self._agent_factory, self._round_function, self._conditions[i],
+                    i, self._seed, start, stop, self._rounds)
+        if not self._workers:
+            for i, start, stop in chunks:
+                result[i, start:stop] = _run_experiment_chunk(*arguments(i, start, stop))
+            return result
+        with ProcessPoolExecutor(min(self._workers, len(chunks))) as executor:
+            futures = {executor.submit(_run_experiment_chunk, *arguments(*c)): c for c in chunks}
+            try:
+                for f in as_completed(futures):
+                    i, start, stop = futures[f]
+                    result[i, start:stop] = f.result()
+            except BaseException:
+                for f in futures:
+                    f.cancel()
+                raise
+        return result
+
+
+def _run_experiment_chunk(agent_factory, round_function, condition, index, seed,
+                          start, stop, rounds):
+    # Runs participants start through stop - 1 of the index'th condition of an
+    # Experiment, returning their results as an array with one row per participant.
+    # This is at module level so that it can be pickled to send to worker processes.
+    result = np.empty((stop - start, rounds))
+    for row, participant in enumerate(range(start, stop)):
+        agent_seed, round_seed = np.random.SeedSequence(
+            seed, spawn_key=(index, participant)).spawn(2)
+        agent = agent_factory(condition)
+        if not isinstance(agent, Agent):
+            raise TypeError(f"The agent factory returned {agent}, which is not an Agent")
+        agent.rng = np.random.default_rng(agent_seed)
+        rng = np.random.default_rng(round_seed)
+        for r in range(rounds):
+            result[row, r] = round_function(agent, condition, r, rng)
+    return result
+
+
+def fit(agent_factory, round_function, data, loss, grid=None, bounds=None, samples=100,
+        conditions=[None], participants=1, rounds=1, seed=None, workers=None, cache=None):
+    """Searches for values of model parameters minimizing a *loss* comparing the results of running a model with human *data*, and returns the losses found.
+    The model is described by *agent_factory*, *round_function*, *conditions*,
+    *participants*, *rounds* and *seed*, as for :class:`Experiment`, except that
+    *agent_factory* is called with the values of the parameters being fitted as keyword
+    arguments following the condition. For each candidate set of parameter values the
+    resulting :class:`Experiment` is run, and *loss* is called with two arguments, the
+    array of results returned by :meth:`Experiment.run` and *data*, typically a
+    DataFrame of human results; it should return a real number, smaller values
+    indicating a better fit.
+
+    The candidates are described by exactly one of *grid* or *bounds*; if both or
+    neither are supplied a :exc:`ValueError` is raised. A *grid* is a dictionary mapping
+    parameter names to iterables of values, every combination of which is a candidate.
+    *Bounds* is a dictionary mapping parameter names to pairs of real numbers, the
+    lowest and highest values to consider, from which *samples* candidates are drawn,
+    covering the space evenly by Latin hypercube sampling.
+
+    Every candidate is run with the same *seed*, so the participants of each draw the
+    same random numbers, and differences in their losses reflect the differences in
+    their parameters rather than chance. If *seed* is ``None`` one is chosen at random.
+    The candidates are run in parallel across *workers* processes, as many as the
+    machine has CPUs if it is ``None``, the default, or all in the calling process if it
+    is zero. The same constraints on *agent_factory* and *round_function* being
+    picklable apply as for :class:`Experiment`; *loss* is always called in the calling
+    process.
+
+    If *cache* is supplied it should be the path of a file in which the loss of each
+    candidate is recorded as soon as it is computed. If that file already exists, as it
+    will if an earlier call was interrupted, the losses already recorded in it are
+    reused rather than recomputed, and its seed is used if *seed* is ``None``; a last
+    line left incomplete by the interruption is discarded. The cache remembers only the
+    parameter values, not the model or *loss*, so a different file should be used for
+    each. A :exc:`ValueError` is raised if the file was written by a fit with a
+    different seed, or different *conditions*, *participants* or *rounds*.
+
+    The result is a DataFrame with one column for each parameter and a final ``loss``
+    column, and one row for each candidate, sorted by increasing loss, so that its
+    first row contains the best fitting values found.
+
+    In this example the human data are themselves simulated, by a model with a
+    noise of 0.4 and a decay of 0.7.
+
+    >>> def make_agent(condition, noise, decay):
+            return Agent(noise=noise, decay=decay, default_utility=4)
+    >>> def run_round(agent, condition, round, rng):
+            choice = agent.choose(["safe", "risky"])
+            agent.respond(3 if choice == "safe" else (10 if rng.random() < 0.3 else 0))
+            return choice == "risky"
+    >>> def loss(results, human):
+            return np.mean((results[0].mean(axis=0) - human["risky"]) ** 2)
+    >>> human = Experiment(functools.partial(make_agent, noise=0.4, decay=0.7), run_round,
+                           participants=100, rounds=100, seed=99).run()
+    >>> human_data = pd.DataFrame({"risky": human[0].mean(axis=0)})
+    >>> fit(make_agent, run_round, human_data, loss,
+            bounds={"noise": (0.1, 1.5), "decay": (0.1, 1.5)}, samples=50,
+            participants=100, rounds=100, seed=1, cache="fit.jsonl")
+           noise     decay      loss
+    0   0.437208  0.822785  0.004519
+    1   0.405861  0.302844  0.004577
+    2   0.564351  0.889448  0.005902
+    3   0.353974  0.424530  0.006279
+    ..       ...       ...       ...
+    49  1.491313  0.233118  0.065131
+    [50 rows x 3 columns]
+    """
+    if (grid is None) == (bounds is None):
+        raise ValueError("Exactly one of grid and bounds must be supplied")
+    settings = {"conditions": repr(tuple(conditions)),
+                "participants": participants,
+                "rounds": rounds}
+    losses = {}
+    if cache is not None and os.path.exists(cache):
+        records, length = _read_fit_cache(cache)
+        if records:
+            header = records.pop(0)
+            if seed is None:
+                seed = header["seed"]
+            if header != dict(settings, seed=np.random.SeedSequence(seed).entropy):
+                raise ValueError(f"The cache {cache} was written by a different fit")
+            for record in records:
+                losses[_fit_key(record["parameters"])] = record["loss"]
+        if length < os.path.getsize(cache):
+            # discards a line left incomplete by an interruption, so that appending
+            # starts afresh at the end of the last complete one
+            with open(cache, "r+b") as f:
+                f.truncate(length)
+    experiment = Experiment(agent_factory, round_function, conditions, participants,
+                            rounds, seed, workers=0)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = _count(workers, "number of workers", 0)
+    if grid is not None:
+        names = list(grid)
+        candidates = [dict(zip(names, (_fit_value(v) for v in values)))
+                      for values in product(*(list(grid[n]) for n in names))]
+    else:
+        names = list(bounds)
+        samples = _count(samples, "number of samples")
+        for n in names:
+            low, high = bounds[n]
+            if not (isinstance(low, Real) and isinstance(high, Real) and low <= high):
+                raise ValueError(f"The bounds of {n}, {bounds[n]}, are not a pair of "
+                                 f"increasing real numbers")
+        # The samples depend only on the seed, so that a resumed fit draws the same ones.
+        rng = np.random.default_rng(np.random.SeedSequence(experiment.seed,
+                                                           spawn_key=(len(names),)))
+        strata = rng.permuted(np.tile(np.arange(samples), (len(names), 1)), axis=1).T
+        points = (strata + rng.random((samples, len(names)))) / samples
+        candidates = [{n: float(bounds[n][0] + (bounds[n][1] - bounds[n][0]) * u)
+                       for n, u in zip(names, row)}
+                      for row in points]
+    if not candidates:
+        raise ValueError("There are no candidate parameter values to fit")
+    pending = [c for c in candidates if _fit_key(c) not in losses]
+    with open(cache, "a") if cache is not None else contextlib.nullcontext() as f:
+        if f is not None and f.tell() == 0:
+            f.write(json.dumps(dict(settings, seed=experiment.seed)) + "\n")
+            f.flush()
+        def finish(parameters, results):
+            value = float(loss(results, data))
+            losses[_fit_key(parameters)] = value
+            if f is not None:
+                f.write(json.dumps({"parameters": parameters, "loss": value}) + "\n")
+                f.flush()
+        arguments = (agent_factory, round_function, experiment.conditions,
+                     experiment.participants, experiment.rounds, experiment.seed)
+        if not workers or len(pending) < 2:
+            for c in pending:
+                finish(c, _fit_candidate(*arguments, c))
+        else:
+            with ProcessPoolExecutor(min(workers, len(pending))) as executor:
+                futures = {executor.submit(_fit_candidate, *arguments, c): c for c in pending}
+                try:
+                    for future in as_completed(futures):
+                        finish(futures[future], future.result())
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+    result = pd.DataFrame({n: [c[n] for c in candidates] for n in names})
+    result["loss"] = [losses[_fit_key(c)] for c in candidates]
+    return result.sort_values("loss", kind="stable", ignore_index=True)
+
+
+def _trace_participants(agent, trials, temperature):
+    # Replays the trials of each of several participants, each a triple of arrays of the
+    # human choices, outcomes, and either choices on offer or a single list of them used
+    # for all the trials, on a fork of agent, and returns an array of their total log
+    # likelihoods. This is at module level so that it can be pickled to send to worker
+    # processes.
+    result = np.empty(len(trials))
+    for p, (human, outcomes, offered) in enumerate(trials):
+        a = agent.fork()
+        total = 0.0
+        fixed = not isinstance(offered, np.ndarray)
+        for i in range(len(human)):
+            choices = offered if fixed else list(offered[i])
+            a.choose(choices)
+            utilities = a._pending_decision[3]
+            try:
+                j = choices.index(human[i])
+            except ValueError:
+                raise ValueError(f"The human choice {human[i]} is not one of {choices}")
+            best = max(utilities)
+            total += ((utilities[j] - best) / temperature
+                      - math.log(math.fsum(math.exp((u - best) / temperature)
+                                           for u in utilities)))
+            a.respond(outcomes[i], human[i])
+        result[p] = total
+    return result
+
+
+def _fit_value(value):
+    # Parameter values are recorded in fit()'s cache as JSON, so NumPy scalars, such as
+    # those in a grid made with np.linspace(), are converted to the Python equivalents.
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _fit_key(parameters):
+    return json.dumps(parameters, sort_keys=True)
+
+
+def _read_fit_cache(path):
+    # Returns a list of the objects recorded in the lines of a cache written by fit(),
+    # and the length in bytes of those lines. A final line that is incomplete, as it
+    # may be if fit() was interrupted while writing it, is ignored.
+    with open(path, "rb") as f:
+        lines = f.read().splitlines(keepends=True)
+    records = []
+    length = 0
+    for i, line in enumerate(lines):
+        try:
+            record = json.loads(line) if line.strip() else None
+        except ValueError:
+            record = None
+            if i < len(lines) - 1:
+                raise ValueError(f"Line {i + 1} of the cache {path} is corrupt") from None
+        if not line.endswith(b"\n") or (record is None and line.strip()):
+            break
+        if record is not None:
+            records.append(record)
+        length += len(line)
+    return records, length
+
+
+def _fit_candidate(agent_factory, round_function, conditions, participants, rounds, seed,
+                   parameters):
+    return Experiment(functools.partial(_parameterized_agent, agent_factory, parameters),
+                      round_function, conditions, participants, rounds, seed,
+                      workers=0).run()
+
+
+def _parameterized_agent(agent_factory, parameters, condition):
+    return agent_factory(condition, **parameters)
+
+
+class _LagTable:
+    # A table of lag ** -decay for positive integer lags, as used in computing base level
+    # activations. Since time is always an integer the lags are, too, and looking them up
+    # replaces a power computation for every reference with a gather. The table grows as
+    # longer lags are needed, and is rebuilt whenever the decay is changed.
+
+    def __init__(self, decay=0.0):
+        self._decay = decay
+        self._table = np.empty(0)
+        self._build(LAG_TABLE_INITIAL_SIZE)
+
+    def _build(self, size):
+        self._table = np.empty(size)
+        self._table[0] = np.nan
+        self._table[1:] = np.arange(1, size, dtype=np.float64) ** -(self._decay or 0.0)
+
+    @property
+    def decay(self):
+        return self._decay
+
+    @decay.setter
+    def decay(self, value):
+        if value != self._decay:
+            self._decay = value
+            self._build(len(self._table))
+
+    def __call__(self, lags):
+        # The lags must all be positive integers.
+        if (n := lags.max(initial=0)) >= len(self._table):
+            self._build(max(n + 1, LAG_TABLE_GROWTH_FACTOR * len(self._table)))
+        return self._table[lags]
+
+
+class _ArrayChunk(dict):
+    # A read only view of one instance of an _ArrayMemory, looking enough like a
+    # pyactup.Chunk for the purposes of Agent.instances() and the like.
+
+    __slots__ = ["_name", "_creation", "_reference_count", "_references"]
+
+    def __init__(self, content, name, creation, reference_count, references):
+        self.update(content)
+        self._name = name
+        self._creation = creation
+        self._reference_count = reference_count
+        self._references = references
+
+    def __repr__(self):
+        return "<Chunk {} {} {}>".format(self._name, dict(self), self._reference_count)
+
+    @property
+    def reference_count(self):
+        return self._reference_count
+
+    @property
+    def references(self):
+        return self._references
+
+
+class _InstanceGroup:
+    # The instances in an _ArrayMemory sharing the same values of its indexed
+    # attributes, that is, for an Agent that is not partially matching, the instances of
+    # one choice. Utilities, creation times and reference counts are held in NumPy arrays
+    # indexed by slot, and the references of all the instances in a pair of parallel
+    # arrays of times and slots. A slot whose instance has been forgotten is never reused,
+    # so slots are always in the order in which their instances were created. The values
+    # of partially matched attributes, and their positions in those attributes' domains,
+    # are gathered into columns lazily, when first needed.
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.signatures = {}
+        self.contents = []
+        self.names = []
+        self.keysets = set()
+        self.columns = {}
+        self.coded = {}
+        self.numeric = {}
+        self.ordered = {}
+        self.size = 0
+        self.utilities = np.empty(ARRAY_MEMORY_INITIAL_SIZE)
+        self.creations = np.empty(ARRAY_MEMORY_INITIAL_SIZE, dtype=np.int64)
+        self.counts = np.zeros(ARRAY_MEMORY_INITIAL_SIZE, dtype=np.int64)
+        self.length = 0
+        self.reference_times = np.empty(ARRAY_MEMORY_INITIAL_SIZE, dtype=np.int64)
+        self.reference_slots = np.empty(ARRAY_MEMORY_INITIAL_SIZE, dtype=np.int64)
+        self.reference_ordinals = np.empty(ARRAY_MEMORY_INITIAL_SIZE, dtype=np.int64)
+        # Created by the first call of coarsen(), after which a reference may stand for
+        # several, as described there.
+        self.reference_weights = None
+        self.reference_oldest = None
+        self.reference_newest = None
+        self.coarsen_at = REFERENCE_COARSENING_MINIMUM
+
+    def _reference_arrays(self):
+        return [a for a in (self.reference_times, self.reference_slots,
+                            self.reference_ordinals, self.reference_weights,
+                            self.reference_oldest, self.reference_newest)
+                if a is not None]
+
+    def copy(self, owner):
+        # Returns a copy of this group belonging to owner, with copies of the occupied
+        # parts of its arrays and of its other mutable state, other than the lazily
+        # gathered columns, which are gathered afresh.
+        result = _InstanceGroup.__new__(_InstanceGroup)
+        result.__dict__.update(self.__dict__)
+        result.owner = owner
+        for k in _InstanceGroup._SLOT_ARRAYS:
+            setattr(result, k, _InstanceGroup._grow(getattr(self, k)[:self.size].copy(),
+                                                    ARRAY_MEMORY_INITIAL_SIZE))
+        for k in _InstanceGroup._REFERENCE_ARRAYS + _InstanceGroup._MERGED_ARRAYS:
+            if (a := getattr(self, k)) is not None:
+                setattr(result, k, _InstanceGroup._grow(a[:self.length].copy(),
+                                                        ARRAY_MEMORY_INITIAL_SIZE))
+        result.contents = list(self.contents)
+        result.names = list(self.names)
+        result.signatures = dict(self.signatures)
+        result.keysets = set(self.keysets)
+        result.columns = {}
+        result.coded = {}
+        result.numeric = {}
+        result.ordered = {}
+        return result
+
+    @staticmethod
+    def _grow(a, n):
+        if n <= len(a):
+            return a
+        result = np.zeros(max(n, ARRAY_MEMORY_GROWTH_FACTOR * len(a)), dtype=a.dtype)
+        result[:len(a)] = a
+        return result
+
+    def add(self, signature, content, name, creation):
+        slot = self.size
+        self.size += 1
+        self.utilities = _InstanceGroup._grow(self.utilities, self.size)
+        self.creations = _InstanceGroup._grow(self.creations, self.size)
+        self.counts = _InstanceGroup._grow(self.counts, self.size)
+        self.utilities[slot] = content[0][1]
+        self.creations[slot] = creation
+        self.counts[slot] = 0
+        self.contents.append(content)
+        self.keysets.add(frozenset(k for k, v in content))
+        self.names.append(name)
+        self.signatures[signature] = slot
+        return slot
+
+    def cite(self, slot, when, store=True):
+        if store:
+            n = self.length
+            self.length += 1
+            self.reference_times = _InstanceGroup._grow(self.reference_times, self.length)
+            self.reference_slots = _InstanceGroup._grow(self.reference_slots, self.length)
+            self.reference_ordinals = _InstanceGroup._grow(self.reference_ordinals, self.length)
+            self.reference_times[n] = when
+            self.reference_slots[n] = slot
+            self.reference_ordinals[n] = self.counts[slot]
+            if self.reference_weights is not None:
+                self.reference_weights = _InstanceGroup._grow(self.reference_weights, self.length)
+                self.reference_oldest = _InstanceGroup._grow(self.reference_oldest, self.length)
+                self.reference_newest = _InstanceGroup._grow(self.reference_newest, self.length)
+                self.reference_weights[n] = 1
+                self.reference_oldest[n] = when
+                self.reference_newest[n] = when
+        self.counts[slot] += 1
+
+    def uncite(self, slot, when):
+        n = self.length
+        found = np.flatnonzero((self.reference_slots[:n] == slot)
+                               & (self.reference_times[:n] == when))
+        if self.reference_weights is not None:
+            single = found[self.reference_weights[found] == 1]
+            if len(single) == 0:
+                # take the reference out of a merged one spanning its time
+                found = np.flatnonzero((self.reference_slots[:n] == slot)
+                                       & (self.reference_oldest[:n] <= when)
+                                       & (self.reference_newest[:n] >= when))
+                if len(found) == 0:
+                    return False
+                self.reference_weights[found[0]] -= 1
+                self.counts[slot] -= 1
+                return True
+            found = single
+        if len(found) == 0:
+            return False
+        i = found[0]
+        later = np.flatnonzero(self.reference_slots[i+1:n] == slot) + i + 1
+        self.reference_ordinals[later] -= 1
+        for a in self._reference_arrays():
+            a[i:n-1] = a[i+1:n]
+        self.length -= 1
+        self.counts[slot] -= 1
+        return True
+
+    def live(self):
+        return np.flatnonzero(self.counts[:self.size] > 0)
+
+    def compact(self, keep):
+        # Discards all but the instances in the ascending array of slots keep, which are
+        # renumbered consecutively, together with their references; the lazily gathered
+        # columns are discarded, to be gathered afresh. Returns an array mapping old slots
+        # to new ones, or to -1 for those discarded.
+        remap = np.full(self.size, -1, dtype=np.int64)
+        remap[keep] = np.arange(len(keep))
+        n = self.length
+        refs = remap[self.reference_slots[:n]] >= 0
+        self.length = int(refs.sum())
+        for a in self._reference_arrays():
+            a[:self.length] = a[:n][refs]
+        self.reference_slots[:self.length] = remap[self.reference_slots[:self.length]]
+        for a in (self.utilities, self.creations, self.counts):
+            a[:len(keep)] = a[keep]
+        self.counts[len(keep):self.size] = 0
+        self.size = len(keep)
+        self.contents = [self.contents[s] for s in keep.tolist()]
+        self.names = [self.names[s] for s in keep.tolist()]
+        self.signatures = {k: int(remap[s]) for k, s in self.signatures.items()
+                           if remap[s] >= 0}
+        self.keysets = {frozenset(k for k, v in c) for c in self.contents}
+        self.columns = {}
+        self.coded = {}
+        self.numeric = {}
+        self.ordered = {}
+        return remap
+
+    def coarsen(self, when, width):
+        # Merges references of the same slot whose lags at time when, and so, as the
+        # ratio of two lags only approaches one as time passes, at all later times, lie
+        # in the same interval of natural logarithms of lags of the given width, into a
+        # single reference at (about) their mean time, weighted by their number, and
+        # remembering the oldest and newest times it spans. The contribution of such a
+        # merged reference to the sum of powers of lags lies between those of that many
+        # references at those two times, so its relative error, and that of the whole
+        # sum, is less than the ratio of powers of their lags, exp(width * decay) at most.
+        # Merged references can themselves be merged again later.
+        n = self.length
+        if self.reference_weights is None:
+            self.reference_weights = np.ones(len(self.reference_times), dtype=np.int64)
+            self.reference_oldest = self.reference_times.copy()
+            self.reference_newest = self.reference_times.copy()
+        slots = self.reference_slots[:n]
+        weights = self.reference_weights[:n]
+        oldest = self.reference_oldest[:n]
+        newest = self.reference_newest[:n]
+        buckets = np.floor(np.log((when - oldest).astype(np.float64)) / width)
+        together = buckets == np.floor(np.log((when - newest).astype(np.float64)) / width)
+        # references already spanning more than one interval are kept apart from others
+        buckets = np.where(together, buckets, -1 - np.arange(n))
+        order = np.lexsort((buckets, slots))
+        keys = np.column_stack((slots[order], buckets[order]))
+        starts = np.flatnonzero(np.concatenate(([True], (keys[1:] != keys[:-1]).any(1))))
+        if len(starts) == n:
+            return
+        merged_weights = np.add.reduceat(weights[order], starts)
+        merged_oldest = np.minimum.reduceat(oldest[order], starts)
+        merged_newest = np.maximum.reduceat(newest[order], starts)
+        means = np.add.reduceat(self.reference_times[:n][order] * weights[order], starts)
+        merged_times = np.clip(np.rint(means / merged_weights).astype(np.int64),
+                               merged_oldest, merged_newest)
+        merged_slots = slots[order][starts]
+        merged_ordinals = np.minimum.reduceat(self.reference_ordinals[:n][order], starts)
+        # keep each slot's references in chronological order
+        chronological = np.lexsort((merged_times, merged_slots))
+        m = len(starts)
+        for a, v in ((self.reference_times, merged_times),
+                     (self.reference_slots, merged_slots),
+                     (self.reference_ordinals, merged_ordinals),
+                     (self.reference_weights, merged_weights),
+                     (self.reference_oldest, merged_oldest),
+                     (self.reference_newest, merged_newest)):
+            a[:m] = v[chronological]
+        self.length = m
+
+    _SLOT_ARRAYS = ("utilities", "creations", "counts")
+    _REFERENCE_ARRAYS = ("reference_times", "reference_slots", "reference_ordinals")
+    _MERGED_ARRAYS = ("reference_weights", "reference_oldest", "reference_newest")
+
+    @staticmethod
+    def pack(groups):
+        # Returns the state of the groups as a dict of a few lists and arrays, each
+        # concatenating the occupied parts of those of all the groups, which pickles far
+        # faster than the groups themselves, particularly if there are many small ones.
+        # The lazily gathered columns are discarded, and the signatures rebuilt from the
+        # contents on unpacking. If, as is usual, all the instances have the same
+        # attributes in the same order, their contents are held as returned by
+        # content_columns(), both pickled and rebuilt much faster than tuples of pairs.
+        sizes = np.array([g.size for g in groups], dtype=np.int64)
+        lengths = np.array([g.length for g in groups], dtype=np.int64)
+        merged = np.array([g.reference_weights is not None for g in groups], dtype=bool)
+        state = {"sizes": sizes,
+                 "lengths": lengths,
+                 "merged": merged,
+                 "coarsen_at": np.array([g.coarsen_at for g in groups], dtype=np.int64),
+                 "names": [n for g in groups for n in g.names]}
+        def join(arrays):
+            return np.concatenate(arrays) if arrays else np.empty(0, dtype=np.int64)
+        for k in _InstanceGroup._SLOT_ARRAYS:
+            state[k] = join([getattr(g, k)[:g.size] for g in groups])
+        for k in _InstanceGroup._REFERENCE_ARRAYS:
+            state[k] = join([getattr(g, k)[:g.length] for g in groups])
+        for k in _InstanceGroup._MERGED_ARRAYS:
+            state[k] = join([getattr(g, k)[:g.length] for g in groups
+                             if g.reference_weights is not None])
+        contents = [c for g in groups for c in g.contents]
+        state["contents"] = _InstanceGroup.content_columns(contents) or contents
+        return state
+
+    @staticmethod
+    def content_columns(contents):
+        # If all of contents, a non-empty list of instance contents, have the same
+        # attributes in the same order, returns a list of those attributes and a list of
+        # the values of each of them in the instances, in order; otherwise None.
+        # The pairs are taken one attribute at a time, rather than by zip(*contents),
+        # which would create an iterator for each instance.
+        if not contents or len(set(map(len, contents))) != 1:
+            return None
+        pairs = [list(map(itemgetter(i), contents)) for i in range(len(contents[0]))]
+        if not all(len(set(map(itemgetter(0), p))) == 1 for p in pairs):
+            return None
+        return ([p[0][0] for p in pairs], [list(map(itemgetter(1), p)) for p in pairs])
+
+    @staticmethod
+    def unpack(state, owner):
+        # The inverse of pack(). The arrays of the groups are views of those of state,
+        # which is safe as a group only ever writes within the occupied part of an array,
+        # first replacing it by a larger copy if it is to grow.
+        sizes = state["sizes"].tolist()
+        lengths = state["lengths"].tolist()
+        merged = state["merged"].tolist()
+        contents = state["contents"]
+        if isinstance(contents, tuple):
+            keys, values = contents
+            contents = list(zip(*(zip(repeat(k), v) for k, v in zip(keys, values))))
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            if order == list(range(len(keys))):
+                signatures = contents
+            else:
+                signatures = list(zip(*(zip(repeat(keys[i]), values[i]) for i in order)))
+            keysets = {frozenset(keys)}
+        else:
+            signatures = [tuple(sorted(c)) for c in contents]
+            keysets = None
+        live = (state["counts"] > 0).tolist()
+        names = state["names"]
+        groups = []
+        slot_start = reference_start = merged_start = 0
+        for size, length, is_merged, coarsen_at in zip(sizes, lengths, merged,
+                                                       state["coarsen_at"].tolist()):
+            g = _InstanceGroup.__new__(_InstanceGroup)
+            g.owner = owner
+            slot_end = slot_start + size
+            reference_end = reference_start + length
+            for k in _InstanceGroup._SLOT_ARRAYS:
+                setattr(g, k, state[k][slot_start:slot_end])
+            for k in _InstanceGroup._REFERENCE_ARRAYS:
+                setattr(g, k, state[k][reference_start:reference_end])
+            for k in _InstanceGroup._MERGED_ARRAYS:
+                setattr(g, k, state[k][merged_start:merged_start + length]
+                              if is_merged else None)
+            g.size = size
+            g.length = length
+            g.coarsen_at = coarsen_at
+            g.contents = contents[slot_start:slot_end]
+            g.names = names[slot_start:slot_end]
+            g.signatures = dict(compress(zip(signatures[slot_start:slot_end], count()),
+                                         live[slot_start:slot_end]))
+            g.keysets = (set(keysets) if keysets is not None
+                         else {frozenset(k for k, v in c) for c in g.contents})
+            g.columns = {}
+            g.coded = {}
+            g.numeric = {}
+            g.ordered = {}
+            groups.append(g)
+            slot_start = slot_end
+            reference_start = reference_end
+            if is_merged:
+                merged_start += length
+        return groups
+
+    def column(self, attribute):
+        # Returns a list of the values of attribute, indexed by slot.
+        result = self.columns.setdefault(attribute, [])
+        if len(result) < self.size:
+            result.extend(dict(c).get(attribute) for c in self.contents[len(result):])
+        return result
+
+    def numbers(self, attribute):
+        # Returns a float array, indexed by slot, of the values of attribute.
+        result = self.numeric.get(attribute, np.empty(0))
+        if (n := len(result)) < self.size:
+            values = self.column(attribute)[n:self.size]
+            result = self.numeric[attribute] = np.concatenate(
+                (result, np.fromiter(values, np.float64, len(values))))
+        return result
+
+    def sorted_index(self, attribute):
+        # Returns an array of the values of attribute, as floats, in ascending order, and
+        # an array of the corresponding slots. Instances added since the last call are
+        # merged in, so the index always reflects every slot, live or not.
+        values, slots = self.ordered.get(attribute, (np.empty(0), np.empty(0, dtype=np.int64)))
+        if (n := len(slots)) < self.size:
+            new = self.numbers(attribute)[n:self.size]
+            order = np.argsort(new, kind="stable")
+            at = np.searchsorted(values, new[order], "right")
+            values = np.insert(values, at, new[order])
+            slots = np.insert(slots, at, order + n)
+            self.ordered[attribute] = (values, slots)
+        return values, slots
+
+    def codes(self, attribute, codes):
+        # Returns an array, indexed by slot, of the positions of the values of attribute
+        # in the domain whose positions are given by the dict codes, or -1 for values not
+        # in that domain.
+        cached = self.coded.get(attribute)
+        if cached is None or cached[0] is not codes:
+            cached = self.coded[attribute] = [codes, np.empty(0, dtype=np.int64)]
+        result = cached[1]
+        if (n := len(result)) < self.size:
+            values = self.column(attribute)[n:self.size]
+            result = cached[1] = np.concatenate(
+                (result, np.fromiter((codes.get(v, -1) for v in values), np.int64,
+                                     len(values))))
+        return result
+
+    def reference_table(self, window):
+        # Returns an array of the offsets, into a flat array of reference times, of the
+        # references of each slot, with a final entry for the end of the last, and that
+        # flat array, holding the references of each slot as would be reported by the
+        # references of a pyactup.Chunk with the given optimized learning window.
+        n = self.length
+        return _InstanceGroup.references_by_slot(
+            self.reference_slots[:n], self.reference_times[:n],
+            self.reference_weights[:n] if self.reference_weights is not None else None,
+            self.size, window)
+
+    @staticmethod
+    def references_by_slot(slots, times, weights, size, window):
+        # As for reference_table(), given parallel arrays of the slots, times and weights,
+        # or None if none have been merged, of references to slots less than size.
+        if window == 0:
+            return np.zeros(size + 1, dtype=np.int64), np.empty(0, dtype=np.int64)
+        order = np.argsort(slots, kind="stable")
+        slots = slots[order]
+        times = times[order]
+        if weights is not None:
+            # a merged reference is reported as that many references at its time
+            weights = weights[order]
+            slots = np.repeat(slots, weights)
+            times = np.repeat(times, weights)
+        counts = np.bincount(slots, minlength=size)
+        if window is not None:
+            ends = np.cumsum(counts)
+            keep = np.arange(len(slots)) >= (ends - np.minimum(counts, window))[slots]
+            times = times[keep]
+            counts = np.minimum(counts, window)
+        return np.concatenate(([0], np.cumsum(counts))), times
+
+    def slot_references(self, slots, window):
+        # Returns a list of tuples of reference times, one for each of the slots, as
+        # would be reported by the references of a pyactup.Chunk.
+        offsets, times = self.reference_table(window)
+        offsets = offsets.tolist()
+        times = times.tolist()
+        return [tuple(times[offsets[s]:offsets[s+1]]) for s in slots]
+
+
+class _ArrayMemory(pyactup.Memory):
+    # A pyactup.Memory that, rather than holding its instances as Chunk objects, holds
+    # them in _InstanceGroups, so that blending can be done in a single vectorized pass.
+    # Only those parts of the Memory API used by Agent are supported, and thresholds and
+    # saliences are not. The instances are listed in the order they were created in
+    # _order, as pairs of the key of their group in _groups and their slot.
+    #
+    # A memory can be forked, the fork sharing the groups, and _order, of the original,
+    # copy on write. A memory may only modify those groups whose owner is its _token, and
+    # must replace any other by a copy before modifying it; forking gives both memories
+    # new tokens. Similarly a memory must copy _order before modifying it if
+    # _order_shared.
+
+    _name_counter = 0
+
+    def __init__(self, **kwargs):
+        self._lag_table = _LagTable()
+        self._groups = {}
+        self._order = []
+        self._order_shared = False
+        self._token = object()
+        self._instance_count = 0
+        self._retrieval_epsilon = None
+        self._pruned = 0
+        self._activation_tolerance = None
+        super().__init__(**kwargs)
+
+    def __len__(self):
+        return self._instance_count
+
+    def __getstate__(self):
+        # The groups are packed together, the instances are identified in _order by the
+        # position of their group rather than by its key, and similarities are detached.
+        state = dict(self.__dict__)
+        keys = list(self._groups.keys())
+        index = {k: i for i, k in enumerate(keys)}
+        state["_groups"] = (keys, _InstanceGroup.pack(list(self._groups.values())))
+        state["_order"] = (np.fromiter(map(index.__getitem__, map(itemgetter(0), self._order)),
+                                       np.int64, len(self._order)),
+                           np.fromiter(map(itemgetter(1), self._order), np.int64,
+                                       len(self._order)))
+        state["_similarities"] = _detached_similarities(self._similarities)
+        state["_activation_history"] = None
+        del state["_token"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._token = object()
+        self._order_shared = False
+        keys, packed = self._groups
+        groups = _InstanceGroup.unpack(packed, self._token)
+        self._groups = dict(zip(keys, groups))
+        owners, slots = self._order
+        self._order = list(zip(map(keys.__getitem__, owners.tolist()), slots.tolist()))
+        _attach_similarities(self, self._similarities)
+        # as for _memory_from_chunk_table(); the last instance created has the greatest name
+        _ArrayMemory._name_counter = max(
+            [_ArrayMemory._name_counter]
+            + [int(n) + 1 for k, s in self._order[-1:]
+               if (n := self._groups[k].names[s]).isdigit()])
+
+    def fork(self):
+        # Returns a new _ArrayMemory with the same contents and parameters as this one,
+        # sharing its groups copy on write, and with a copy of its random number generator.
+        result = _ArrayMemory.__new__(_ArrayMemory)
+        result.__dict__.update(self.__dict__)
+        result._groups = dict(self._groups)
+        self._token = object()
+        result._token = object()
+        self._order_shared = result._order_shared = True
+        result._lag_table = copy.copy(self._lag_table)
+        result._rng = copy.deepcopy(self._rng)
+        result._similarities = {}
+        for name, similarity in self._similarities.items():
+            result._similarities[name] = copy.copy(similarity)
+            result._similarities[name]._memory = result
+        result._slot_name_index = defaultdict(list)
+        result._index = defaultdict(list)
+        result._activation_history = None
+        if self._fixed_noise is not None:
+            result._fixed_noise = dict(self._fixed_noise)
+        return result
+
+    def _own(self, key):
+        # Returns the group with key, first replacing it by a copy if it is shared.
+        g = self._groups[key]
+        if g.owner is not self._token:
+            g = self._groups[key] = g.copy(self._token)
+        return g
+
+    def _append_order(self, key, slot):
+        if self._order_shared:
+            self._order = list(self._order)
+            self._order_shared = False
+        self._order.append((key, slot))
+
+    @property
+    def decay(self):
+        return self._decay
+
+    @decay.setter
+    def decay(self, value):
+        pyactup.Memory.decay.fset(self, value)
+        self._lag_table.decay = self._decay
+
+    def __repr__(self):
+        return f"<_ArrayMemory {id(self)}: {list(self._indexed_attributes)}, {len(self)}, {self._time}>"
+
+    def _chunk(self, group, slot, references=None):
+        if references is None:
+            references = group.slot_references([slot], self._optimized_learning)[0]
+        return _ArrayChunk(group.contents[slot], group.names[slot],
+                           int(group.creations[slot]), int(group.counts[slot]), references)
+
+    def values(self):
+        # The references of each group are gathered the first time one of its instances
+        # is reached, rather than separately for each instance.
+        tables = {}
+        for k, s in self._order:
+            if (g := self._groups[k]).counts[s] > 0:
+                if (table := tables.get(k)) is None:
+                    offsets, times = g.reference_table(self._optimized_learning)
+                    table = tables[k] = (offsets.tolist(), times.tolist())
+                offsets, times = table
+                yield self._chunk(g, s, tuple(times[offsets[s]:offsets[s+1]]))
+
+    def instance_table(self):
+        # Returns a description of the live instances, in the order in which they were
+        # created: a dict mapping each attribute, including "_utility", to a list of its
+        # values in them; arrays of their creation times and reference counts; and an
+        # array of offsets into a flat array of the times of their references, as
+        # reported by values(), and that array.
+        # The arrays of all the groups are concatenated, each slot of each group being
+        # identified by its position in that concatenation. As there may be very many
+        # groups, each holding only one or a few instances, nothing is computed for each
+        # group or for each instance in Python: the whole of each group's array is
+        # concatenated, and the unoccupied tails then discarded in one indexing.
+        groups = list(self._groups.values())
+        n = len(groups)
+        sizes = np.fromiter(map(attrgetter("size"), groups), np.int64, n)
+        lengths = np.fromiter(map(attrgetter("length"), groups), np.int64, n)
+        bases = np.cumsum(sizes) - sizes
+        def gather(arrays, used):
+            if not arrays:
+                return np.empty(0, dtype=np.int64)
+            allocated = np.fromiter(map(len, arrays), np.int64, n)
+            ends = np.cumsum(used)
+            return np.concatenate(arrays)[np.repeat(np.cumsum(allocated) - allocated
+                                                    - (ends - used), used)
+                                          + np.arange(ends[-1])]
+        creations = gather(list(map(attrgetter("creations"), groups)), sizes)
+        counts = gather(list(map(attrgetter("counts"), groups)), sizes)
+        weights = None
+        if any(g.reference_weights is not None for g in groups):
+            ones = np.ones(lengths.max(), dtype=np.int64)
+            weights = gather([ones if (w := g.reference_weights) is None else w
+                              for g in groups], lengths)
+        offsets, times = _InstanceGroup.references_by_slot(
+            gather(list(map(attrgetter("reference_slots"), groups)), lengths)
+            + np.repeat(bases, lengths),
+            gather(list(map(attrgetter("reference_times"), groups)), lengths),
+            weights, len(creations), self._optimized_learning)
+        index = dict(zip(self._groups, count()))
+        order = len(self._order)
+        ids = (bases[np.fromiter(map(index.__getitem__, map(itemgetter(0), self._order)),
+                                 np.int64, order)]
+               + np.fromiter(map(itemgetter(1), self._order), np.int64, order))
+        ids = ids[counts[ids] > 0]
+        contents = list(chain.from_iterable(map(attrgetter("contents"), groups)))
+        contents = list(map(contents.__getitem__, ids.tolist()))
+        if (columns := _InstanceGroup.content_columns(contents)) is not None:
+            columns = dict(zip(*columns))
+        else:
+            values = [dict(c) for c in contents]
+            columns = {k: [v[k] for v in values]
+                       for k in dict.fromkeys(chain.from_iterable(values))}
+        begins = offsets[ids]
+        lengths = offsets[ids + 1] - begins
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        times = times[np.repeat(begins - offsets[:-1], lengths) + np.arange(offsets[-1])]
+        return columns, creations[ids], counts[ids], offsets, times
+
+    def reset(self, preserve_prepopulated=False, index=None):
+        if preserve_prepopulated and self._optimized_learning is not None:
+            preserve_prepopulated = False
+            warn("The preserve_prepopulated argument to reset() cannot be used when "
+                 "optimized_learning is on, and is being ignored")
+        preserved = []
+        if preserve_prepopulated:
+            for k, s in self._order:
+                if (g := self._groups[k]).counts[s] > 0 and g.creations[s] <= 0:
+                    refs = g.slot_references([s], None)[0]
+                    preserved.append((g.contents[s], g.names[s], int(g.creations[s]),
+                                      [r for r in refs if r <= 0]))
+        self._groups = {}
+        self._order = []
+        self._order_shared = False
+        self._instance_count = 0
+        super().reset(False, index)
+        for content, name, creation, refs in preserved:
+            g, s = self._add(dict(content), content, name, creation)
+            for r in refs:
+                g.cite(s, r)
+
+    def _add(self, slots, content, name, creation):
+        key = pyactup.Memory._signature(slots, None, self._indexed_attributes)
+        if key not in self._groups:
+            g = self._groups[key] = _InstanceGroup(self._token)
+        else:
+            g = self._own(key)
+        s = g.add(pyactup.Memory._signature(slots, "learn"), content, name, creation)
+        self._append_order(key, s)
+        self._instance_count += 1
+        return g, s
+
+    def learn(self, slots, advance=None):
+        slots = self._ensure_slots(slots, True)
+        signature = pyactup.Memory._signature(slots, "learn")
+        key = pyactup.Memory._signature(slots, None, self._indexed_attributes)
+        g = self._own(key) if key in self._groups else None
+        created = False
+        if g is None or (s := g.signatures.get(signature)) is None:
+            _ArrayMemory._name_counter += 1
+            g, s = self._add(slots, tuple(slots.items()), f"{_ArrayMemory._name_counter:04d}",
+                             self._time)
+            created = True
+        g.cite(s, self._time, self._optimized_learning != 0)
+        result = None
+        if created:
+            result = self._chunk(g, s, (self._time,) if self._optimized_learning != 0 else ())
+        if advance is True:
+            self.advance()
+        elif advance is not None:
+            self.advance(advance)
+        return result
+
+    def learn_many(self, rows, times):
+        # Learns each of rows, dicts of already validated slots, at the corresponding one
+        # of times, which must be in non-decreasing order and not in the future, as
+        # learn() would at that time, but computing each signature just once.
+        store = self._optimized_learning != 0
+        for slots, when in zip(rows, times):
+            signature = pyactup.Memory._signature(slots, "learn")
+            key = pyactup.Memory._signature(slots, None, self._indexed_attributes)
+            if (g := self._groups.get(key)) is None:
+                g = self._groups[key] = _InstanceGroup(self._token)
+            elif g.owner is not self._token:
+                g = self._own(key)
+            if (s := g.signatures.get(signature)) is None:
+                _ArrayMemory._name_counter += 1
+                s = g.add(signature, tuple(slots.items()), f"{_ArrayMemory._name_counter:04d}",
+                          when)
+                self._append_order(key, s)
+                self._instance_count += 1
+            g.cite(s, when, store)
+
+    def forget(self, slots, when):
+        if self._optimized_learning is not None:
+            raise RuntimeError("The forget() method cannot be used with optimized learning")
+        slots = self._ensure_slots(slots, True)
+        signature = pyactup.Memory._signature(slots, "forget")
+        key = pyactup.Memory._signature(slots, None, self._indexed_attributes)
+        g = self._groups.get(key)
+        if g is None or (s := g.signatures.get(signature)) is None:
+            return False
+        if not (g := self._own(key)).uncite(s, when):
+            return False
+        if not g.counts[s]:
+            del g.signatures[signature]
+            self._instance_count -= 1
+        return True
+
+    def _live_base_levels(self):
+        # Returns a list of (key, slot) pairs of the live instances, in the order in
+        # which they were created, and an array of their base level activations.
+        levels = {}
+        for k, g in self._groups.items():
+            if len(slots := g.live()):
+                levels[k] = np.zeros(g.size)
+                if self._decay is not None:
+                    levels[k][slots] = self._checked_base_levels([(g, slots)])
+        instances = [(k, s) for k, s in self._order if self._groups[k].counts[s] > 0]
+        return instances, np.fromiter((levels[k][s] for k, s in instances), np.float64,
+                                      len(instances))
+
+    def _remove(self, instances):
+        # Removes the given (key, slot) pairs of live instances, compacting their groups.
+        doomed = defaultdict(set)
+        for k, s in instances:
+            doomed[k].add(s)
+        remaps = {}
+        for k, slots in doomed.items():
+            g = self._own(k)
+            keep = np.array([s for s in g.live().tolist() if s not in slots], dtype=np.int64)
+            remaps[k] = g.compact(keep)
+        self._order = [(k, int(remaps[k][s])) if k in remaps else (k, s)
+                       for k, s in self._order if k not in remaps or remaps[k][s] >= 0]
+        self._order_shared = False
+        self._groups = {k: g for k, g in self._groups.items() if g.size}
+        self._instance_count -= len(instances)
+
+    def _candidates(self, conditions, extra, partial=()):
+        # Returns a list of pairs, an _InstanceGroup and an array of the slots within it
+        # of the live instances matching conditions, and having the partial attributes.
+        if ((extra is not None and extra != "_utility"
+             and not any(extra in dict(g.contents[0]) for g in self._groups.values()))):
+            return []
+        if self._indexed_attributes and set(conditions) == self._indexed_attributes:
+            g = self._groups.get(pyactup.Memory._signature(conditions, None,
+                                                           self._indexed_attributes))
+            return [(g, g.live())] if g is not None else []
+        result = []
+        names = set(conditions).union(partial)
+        for g in self._groups.values():
+            if not any(names <= k for k in g.keysets):
+                continue
+            slots = g.live()
+            if conditions or len(g.keysets) > 1:
+                slots = np.array([s for s in slots
+                                  if all(dict(g.contents[s]).get(a) == v
+                                         for a, v in conditions.items())
+                                  and names <= dict(g.contents[s]).keys()],
+                                 dtype=np.int64)
+            if len(slots):
+                result.append((g, slots))
+        return result
+
+    def _base_levels(self, g, slots):
+        t = self._time
+        d = self._decay
+        if self._optimized_learning == 0:
+            return (np.log(g.counts[slots] / (1 - d))
+                    - d * np.log((t - g.creations[slots]).astype(np.float64)))
+        n = g.length
+        if (self._activation_tolerance is not None and self._decay and n >= g.coarsen_at
+                and g.owner is self._token
+                and (g.reference_times[:n] if g.reference_newest is None
+                           else g.reference_newest[:n]).max() < t):
+            g.coarsen(t, self._activation_tolerance / self._decay)
+            g.coarsen_at = max(REFERENCE_COARSENING_FACTOR * g.length,
+                               REFERENCE_COARSENING_MINIMUM)
+            n = g.length
+        selected = np.zeros(g.size, dtype=bool)
+        selected[slots] = True
+        refs = selected[g.reference_slots[:n]]
+        if self._optimized_learning is not None:
+            refs &= (g.reference_ordinals[:n]
+                     >= g.counts[g.reference_slots[:n]] - self._optimized_learning)
+        lags = t - g.reference_times[:n][refs]
+        if lags.min(initial=1) > 0:
+            weights = self._lag_table(lags)
+        else:
+            # let the arithmetic raise an error, or not, as pyactup would
+            weights = lags.astype(np.float64) ** -d
+        if g.reference_weights is not None:
+            weights = weights * g.reference_weights[:n][refs]
+        sums = np.bincount(g.reference_slots[:n][refs], weights, minlength=g.size)[slots]
+        if self._optimized_learning is not None:
+            k = self._optimized_learning
+            counts = g.counts[slots]
+            if (over := counts > k).any():
+                middles = np.zeros(g.size)
+                oldest = refs & (g.reference_ordinals[:n]
+                                 == g.counts[g.reference_slots[:n]] - k)
+                middles[g.reference_slots[:n][oldest]] = g.reference_times[:n][oldest]
+                # Masked arrays, as in pyactup, so that degenerate tails contribute zero.
+                middles = np.ma.masked_array(middles[slots][over])
+                ages = np.ma.masked_array((t - g.creations[slots][over]).astype(np.float64))
+                dd = 1 - d
+                sums[over] += ((counts[over] - k) * (ages ** dd - middles ** dd)
+                               / ((ages - middles) * dd)).filled(0)
+        return np.log(sums)
+
+    @staticmethod
+    def _vectorized(attribute, value, similarity):
+        # Whether the penalties for attribute can be computed without calling a similarity
+        # function once for each instance.
+        return ((isinstance(similarity, _DomainSimilarity) and value in similarity._codes)
+                or isinstance(similarity._function, _SimilarityKernel))
+
+    def _prune(self, candidates, activations, partial, epsilon):
+        # Decides which candidates may be left out of blending their utilities. The
+        # activations include everything but the mismatch penalties of those partial
+        # attributes whose similarities must be computed by calling their functions.
+        # Taking those penalties at their best possible values gives upper bounds on the
+        # activations, and hence the retrieval weights, of all the candidates. Candidates
+        # are evaluated in descending order of these bounds, until the bounded total
+        # retrieval probability of the rest, times the spread of the utilities, is at
+        # most epsilon, so that leaving them out cannot move the blended value by more.
+        # Returns a sorted array of the positions of the candidates retained, and the
+        # matrix of the penalties of all the partial attributes for them.
+        n = len(activations)
+        costly = [i for i, p in enumerate(partial) if not _ArrayMemory._vectorized(*p)]
+        columns = np.empty((n, len(partial)))
+        for i, p in enumerate(partial):
+            if i not in costly:
+                columns[:, i] = np.concatenate([self._penalties(g, s, *p) for g, s in candidates])
+        offset = 0 if self._use_actr_similarity else 1
+        best = sum((self._maximum_similarity - offset) * partial[i][2]._weight for i in costly)
+        known = [i for i in range(len(partial)) if i not in costly]
+        bounds = activations + (np.sum(columns[:, known], 1) + best) * self._mismatch
+        owners = np.concatenate([np.full(len(s), k) for k, (g, s) in enumerate(candidates)])
+        flat_slots = np.concatenate([s for g, s in candidates])
+        utilities = np.concatenate([g.utilities[s] for g, s in candidates])
+        spread = utilities.max() - utilities.min()
+        order = np.argsort(-bounds, kind="stable")
+        top = bounds[order[0]]
+        tails = np.append(np.cumsum(np.exp((bounds[order] - top)
+                                           / self._temperature)[::-1])[::-1], 0)
+        k = max(int(np.argmax(tails * spread <= epsilon * tails[0])), 1)
+        done = 0
+        weight = 0
+        while True:
+            batch = order[done:k]
+            for j in np.unique(owners[batch]).tolist():
+                selected = batch[owners[batch] == j]
+                for i in costly:
+                    columns[selected, i] = self._penalties(candidates[j][0],
+                                                           flat_slots[selected], *partial[i])
+            exact = activations[batch] + np.sum(columns[batch], 1) * self._mismatch
+            weight += np.sum(np.exp((exact - top) / self._temperature))
+            done = k
+            if k == n or tails[k] * spread <= epsilon * (weight + tails[k]):
+                break
+            k = min(2 * k, n)
+        return np.sort(order[:k]), columns
+
+    def _penalties(self, g, slots, attribute, value, similarity):
+        # Returns an array of the weighted mismatch penalties of the values of attribute
+        # of the instances in slots of g when compared to value.
+        if (isinstance(similarity, _DomainSimilarity)
+                and (probe := similarity._codes.get(value)) is not None):
+            codes = g.codes(attribute, similarity._codes)[slots]
+            result = similarity.penalties()[codes, probe]
+            if (unknown := codes < 0).any():
+                column = g.column(attribute)
+                result[unknown] = [similarity._similarity(column[s], value)
+                                   for s in slots[unknown].tolist()]
+            return result
+        if isinstance(similarity._function, _SimilarityKernel):
+            values = g.numbers(attribute)[slots]
+            result = similarity._function.vector(values, value)
+            if ((result < self._minimum_similarity)
+                    | (result > self._maximum_similarity)).any():
+                bad = result[(result < self._minimum_similarity)
+                             | (result > self._maximum_similarity)][0]
+                raise ValueError(f"similarity value, {bad}, is not between "
+                                 f"{self._minimum_similarity} and {self._maximum_similarity}")
+            if not self._use_actr_similarity:
+                result = result - 1
+            result *= similarity._weight
+            result[values == value] = 0
+            return result
+        column = g.column(attribute)
+        return np.fromiter((similarity._similarity(column[s], value) for s in slots.tolist()),
+                           np.float64, len(slots))
+
+    def _checked_base_levels(self, candidates):
+        with np.errstate(divide="raise", over="raise", under="ignore", invalid="raise"):
+            try:
+                return np.concatenate([self._base_levels(g, s) for g, s in candidates])
+            except FloatingPointError as e:
+                raise RuntimeError(f"Error when computing activations, perhaps a chunk's "
+                                   f"creation or reinforcement time is not in the past? ({e})")
+
+    def _draw_noise(self, candidates, n):
+        if self._noise_distribution is not None:
+            noise = self._noise * np.array([self._noise_distribution() for i in range(n)],
+                                           dtype=np.float64)
+        else:
+            noise = self._rng.logistic(scale=self._noise, size=n)
+        if self._fixed_noise is not None:
+            names = [g.names[s] for g, slots in candidates for s in slots]
+            if self._fixed_noise_time != self._time:
+                self._clear_fixed_noise()
+                for name, x in zip(names, noise):
+                    self._fixed_noise[name] = x
+            else:
+                for name, x, i in zip(names, noise, count()):
+                    if y := self._fixed_noise.get(name):
+                        noise[i] = y
+                    else:
+                        self._fixed_noise[name] = x
+        return noise
+
+    def _base_level_bounds(self, g, slots):
+        # Upper bounds on the base level activations of the instances in slots of g, or
+        # None if there are none cheaper than computing them. As all lags are at least one
+        # no reference contributes more than one to the sum of powers of lags. When
+        # optimized_learning is an integer, however, the approximation of the older
+        # references, as in pyactup, is computed from the time of the oldest retained
+        # reference rather than from a lag, and can contribute far more than one for each
+        # of them, so no bound is offered.
+        if self._decay is None:
+            return np.zeros(len(slots))
+        if self._optimized_learning == 0:
+            if self._decay >= 1:
+                return None
+            return np.log(g.counts[slots] / (1 - self._decay))
+        if self._optimized_learning:
+            return None
+        return np.log(g.counts[slots].astype(np.float64))
+
+    def _ranged(self, candidates, noise, partial, epsilon):
+        # Narrows the candidates to those whose values of a partially matched attribute
+        # with a bounded similarity function lie within some distance of the probe value,
+        # found from a sorted index of those values. Those further away have similarities
+        # no greater than that at this distance, and, as for _prune(), so bounding their
+        # activations bounds the effect of leaving them out on the blended value. The
+        # distance starts small and is increased until that effect is at most epsilon.
+        # Returns None if no suitable attribute is being partially matched, or all the
+        # candidates must be retained; otherwise the retained candidates, with their
+        # noise, base level activations, and the matrix of their penalties.
+        bounded = [p for p in partial if isinstance(p[2]._function, _BoundedSimilarity)]
+        if not bounded:
+            return None
+        attribute, value, similarity = max(bounded, key=lambda p: p[2]._weight)
+        kernel = similarity._function
+        bounds = [self._base_level_bounds(g, s) for g, s in candidates]
+        if not isinstance(value, Real) or any(b is None for b in bounds):
+            return None
+        bounds = np.concatenate(bounds)
+        probe = min(max(value, kernel.minimum), kernel.maximum)
+        if noise is not None:
+            bounds = bounds + noise
+        n = len(bounds)
+        utilities = np.concatenate([g.utilities[s] for g, s in candidates])
+        spread = utilities.max() - utilities.min()
+        offset = 0 if self._use_actr_similarity else 1
+        others = sum((self._maximum_similarity - offset) * p[2]._weight
+                     for p in partial if p[0] != attribute)
+        width = kernel.maximum - kernel.minimum
+        # Weights relative to the greatest bound, so that none overflows; those of the
+        # instances beyond the distance are then found by subtracting those within it
+        # from the total, allowing generously for rounding error, so that only the
+        # instances within it need be visited.
+        top = bounds.max()
+        weights = np.exp((bounds - top) / self._temperature)
+        total = np.sum(weights)
+        slack = 4 * n * np.finfo(np.float64).eps * total
+        offsets = np.cumsum([0] + [len(s) for g, s in candidates])
+        ranks = []
+        for g, slots in candidates:
+            member = np.zeros(g.size, dtype=bool)
+            member[slots] = True
+            ranks.append((member, np.cumsum(member) - 1))
+        # Start at the distance beyond which, were the activations within it no smaller
+        # than their bounds, the instances could just be left out.
+        needed = self._temperature * math.log(epsilon / spread) if spread > 0 else -math.inf
+        nearest = offset + (needed / self._mismatch - others) / similarity._weight
+        if not nearest > 0:
+            return None
+        if kernel._exponent == 2:
+            nearest = math.sqrt(nearest)
+        distance = max(width * (1 - nearest), width / 64)
+        while distance < width:
+            lo = probe - distance if probe - distance > kernel.minimum else -math.inf
+            hi = probe + distance if probe + distance < kernel.maximum else math.inf
+            kept = []
+            inside = []
+            for (g, slots), first, (member, rank) in zip(candidates, offsets.tolist(), ranks):
+                values, ordered = g.sorted_index(attribute)
+                near = ordered[np.searchsorted(values, lo, "left"):
+                               np.searchsorted(values, hi, "right")]
+                near = near[member[near]]
+                kept.append((g, near))
+                inside.append(first + rank[near])
+            inside = np.concatenate(inside)
+            if len(inside) == n:
+                return None
+            nearest = 1 - distance / width
+            if kernel._exponent == 2:
+                nearest **= 2
+            penalty = ((nearest - offset) * similarity._weight + others) * self._mismatch
+            within = np.sum(weights[inside])
+            rest = (max(total - within, 0) + slack) * math.exp(penalty / self._temperature)
+            # a cheap test, with the activations within also bounded, before the exact one
+            if rest * spread > epsilon * (rest + within):
+                distance *= 1.5
+                continue
+            kept = [(k, g, np.sort(s)) for k, (g, s) in enumerate(kept) if len(s)]
+            inside = np.concatenate([offsets[k] + ranks[k][1][s] for k, g, s in kept])
+            kept = [(g, s) for k, g, s in kept]
+            base = self._checked_base_levels(kept)
+            pens = np.concatenate([np.column_stack([self._penalties(g, s, *p)
+                                                    for p in partial])
+                                   for g, s in kept])
+            exact = base + noise[inside] if noise is not None else base
+            exact = exact + np.sum(pens, 1) * self._mismatch
+            within = np.sum(np.exp((exact - top) / self._temperature))
+            if within > 0 and rest * spread <= epsilon * (within + rest):
+                return (kept, (noise[inside] if noise is not None else None), base, pens)
+            distance *= 1.5
+        return None
+
+    def _array_activations(self, conditions, extra, epsilon=None):
+        partial = []
+        if self._mismatch is not None:
+            exact = {}
+            for n, v in conditions.items():
+                if s := self._similarities.get(n):
+                    partial.append((n, v, s))
+                else:
+                    exact[n] = v
+        else:
+            exact = conditions
+        candidates = self._candidates(exact, extra, [p[0] for p in partial])
+        if not candidates:
+            return None, None
+        n = sum(len(slots) for g, slots in candidates)
+        noise = self._draw_noise(candidates, n) if self._noise else None
+        penalties = None
+        if (epsilon is not None and extra == "_utility" and partial
+                and (ranged := self._ranged(candidates, noise, partial, epsilon))):
+            candidates, noise, result, penalties = ranged
+            self._pruned += n - len(result)
+            n = len(result)
+        else:
+            result = self._checked_base_levels(candidates)
+        history = self._activation_history
+        if history is not None:
+            start = len(history)
+            for g, slots in candidates:
+                refs = g.slot_references(slots, self._optimized_learning)
+                for s, r in zip(slots.tolist(), refs):
+                    history.append({"time": self._time,
+                                    "name": g.names[s],
+                                    "creation_time": int(g.creations[s]),
+                                    "attributes": g.contents[s],
+                                    "reference_count": int(g.counts[s]),
+                                    "references": r})
+            for h, b in zip(history[start:], result):
+                h["base_level_activation"] = b
+        if noise is not None:
+            result += noise
+            if history is not None:
+                for h, x in zip(history[start:], noise):
+                    h["activation_noise"] = x
+        if partial:
+            if penalties is None and (epsilon is not None and extra == "_utility"
+                                      and not all(_ArrayMemory._vectorized(*p)
+                                                  for p in partial)):
+                keep, penalties = self._prune(candidates, result, partial, epsilon)
+                self._pruned += n - len(keep)
+                owners = np.concatenate([np.full(len(s), k)
+                                         for k, (g, s) in enumerate(candidates)])[keep]
+                flat_slots = np.concatenate([s for g, s in candidates])[keep]
+                candidates = [(g, flat_slots[owners == k]) for k, (g, s) in enumerate(candidates)]
+                candidates = [(g, s) for g, s in candidates if len(s)]
+                result = result[keep]
+                penalties = penalties[keep]
+                if history is not None:
+                    history[start:] = [history[start + i] for i in keep.tolist()]
+            elif penalties is None:
+                penalties = np.concatenate([np.column_stack([self._penalties(g, slots, *p)
+                                                             for p in partial])
+                                            for g, slots in candidates])
+            if history is not None:
+                offset = 0 if self._use_actr_similarity else 1
+                for h, pens in zip(history[start:], penalties):
+                    h["similarities"] = {p[0]: x + offset for p, x in zip(partial, pens)}
+            penalties = np.sum(penalties, 1) * self._mismatch
+            result += penalties
+            if history is not None:
+                for h, x in zip(history[start:], penalties):
+                    h["mismatch"] = x
+        if history is not None:
+            for h, a in zip(history[start:], result):
+                h["activation"] = a
+        return result, candidates
+
+    def _blend(self, outcome_attribute, slots, epsilon=None):
+        pyactup.Memory._ensure_slot_name(outcome_attribute)
+        activations, candidates = self._array_activations(self._ensure_slots(slots),
+                                                          outcome_attribute, epsilon)
+        if candidates is None:
+            return None, None
+        with np.errstate(divide="raise", over="raise", under="ignore", invalid="raise"):
+            wp = np.exp(activations / self._temperature)
+            wp /= np.sum(wp)
+        if (history := self._activation_history) is not None:
+            for h, p in zip(history[len(history) - len(wp):], wp):
+                h["retrieval_probability"] = p
+        return wp, candidates
+
+    def blend(self, outcome_attribute, slots={}, instance_salience=False, feature_salience=False):
+        if instance_salience or feature_salience:
+            raise NotImplementedError("Saliences are not supported by the array engine")
+        probs, candidates = self._blend(outcome_attribute, slots, self._retrieval_epsilon)
+        if candidates is None:
+            return None
+        if outcome_attribute == "_utility":
+            values = np.concatenate([g.utilities[s] for g, s in candidates])
+        else:
+            values = [dict(g.contents[s])[outcome_attribute]
+                      for g, slots in candidates for s in slots]
+        with np.errstate(divide="raise", over="raise", under="ignore", invalid="raise"):
+            try:
+                return np.average(np.array(values, dtype=np.float64), weights=probs)
+            except Exception as e:
+                raise RuntimeError(f"Error computing blended value, is perhaps the value "
+                                   f"of the {outcome_attribute} slot not numeric in "
+                                   f"one of the matching chunks? ({e})")
+
+    def discrete_blend(self, outcome_attribute, slots={}):
+        probs, candidates = self._blend(outcome_attribute, slots)
+        if candidates is None:
+            return None, None
+        values = [dict(g.contents[s])[outcome_attribute] for g, slots in candidates for s in slots]
+        options = defaultdict(list)
+        for v, p in zip(values, probs):
+            options[v].append(p)
+        best = []
+        best_value = -math.inf
+        for k, v in options.items():
+            v = sum(v)
+            options[k] = v
+            if v > best_value:
+                best = [k]
+                best_value = v
+            elif v == best_value:
+                best.append(k)
+        return (random.choice(best),
+                dict(sorted(options.items(), key=lambda x: x[1], reverse=True)))
+
+
+class _SimilarityKernel:
+    # A similarity function that can also be applied to a NumPy array of the values of
+    # many instances and a single probe value, computing all their similarities in one
+    # vectorized expression; the array engine does so rather than calling the function
+    # once for each instance.
+
+    def vector(self, values, probe):
+        raise NotImplementedError()
+
+
+class _PositiveSimilarity(_SimilarityKernel):
+    # Wraps positive_linear_similarity() and positive_quadratic_similarity(), retaining
+    # their names and documentation.
+
+    def __init__(self, function, exponent):
+        functools.update_wrapper(self, function)
+        self._exponent = exponent
+
+    def __call__(self, x, y):
+        return self.__wrapped__(x, y)
+
+    def __reduce__(self):
+        return self.__name__
+
+    def __repr__(self):
+        return f"<similarity function {self.__name__}>"
+
+    def vector(self, values, probe):
+        if probe <= 0 or (values <= 0).any():
+            bad = values[values <= 0][0] if probe > 0 else probe
+            raise ValueError(f"the similarity arguments include {bad}, which is not positive")
+        result = 1 - np.abs(values - probe) / np.maximum(values, probe)
+        return result ** 2 if self._exponent == 2 else result
+
+
+class _BoundedSimilarity(_SimilarityKernel):
+    # The similarity functions returned by bounded_linear_similarity() and
+    # bounded_quadratic_similarity().
+
+    def __init__(self, minimum, maximum, exponent):
+        if minimum >= maximum:
+            raise ValueError(f"minimum, {minimum}, is not less than maximum, {maximum}")
+        self.minimum = minimum
+        self.maximum = maximum
+        self._exponent = exponent
+
+    def __call__(self, x, y):
+        minimum = self.minimum
+        maximum = self.maximum
+        if x < minimum:
+            warn(f"{x} is less than {minimum}, so {minimum} is instead being used in computing similarity")
+            x = minimum
+        elif x > maximum:
+            warn(f"{x} is greater than {maximum}, so {maximum} is instead being used in computing similarity")
+            x = maximum
+        if y < minimum:
+            warn(f"{y} is less than {minimum}, so {minimum} is instead being used in computing similarity")
+            y = minimum
+        elif y > maximum:
+            warn(f"{y} is greater than {maximum}, so {maximum} is instead being used in computing similarity")
+            y = maximum
+        result = 1 - abs(x - y) / abs(maximum - minimum)
+        return result**2 if self._exponent == 2 else result
+
+    def __reduce__(self):
+        return (bounded_quadratic_similarity if self._exponent == 2
+                else bounded_linear_similarity,
+                (self.minimum, self.maximum))
+
+    def __repr__(self):
+        kind = "quadratic" if self._exponent == 2 else "linear"
+        return f"<bounded {kind} similarity function from {self.minimum} to {self.maximum}>"
+
+    def vector(self, values, probe):
+        clipped = np.clip(values, self.minimum, self.maximum)
+        p = min(max(probe, self.minimum), self.maximum)
+        if n := int(np.count_nonzero(clipped != values)) + (p != probe):
+            warn(f"{n} values not between {self.minimum} and {self.maximum} were replaced "
+                 f"by the nearer of them in computing similarity")
+        result = 1 - np.abs(clipped - p) / abs(self.maximum - self.minimum)
+        return result ** 2 if self._exponent == 2 else result
+
+
 def positive_linear_similarity(x, y):
     """Returns a similarity value of two positive :class:`Real` numbers, scaled linearly by the larger of them.
 If *x* and *y* are equal the value is one, and otherwise a positive float less than one
@@ -1747,6 +6013,8 @@ If either *x* or *y* is not positive a :exc:`ValueError` is raised.
         x, y = y, x
     return 1 - (y - x) / y
 
+positive_linear_similarity = _PositiveSimilarity(positive_linear_similarity, 1)
+
 def positive_quadratic_similarity(x, y):
     """Returns a similarity value of two positive :class:`Real` numbers, scaled quadratically by the larger of them.
 If *x* and *y* are equal the value is one, and otherwise a positive float less than one
@@ -1775,6 +6043,8 @@ If either *x* or *y* is not positive a :exc:`ValueError` is raised.
 """
     return positive_linear_similarity(x, y)**2
 
+positive_quadratic_similarity = _PositiveSimilarity(positive_quadratic_similarity, 2)
+
 def bounded_linear_similarity(minimum, maximum):
     """Returns a function of two arguments that returns a similarity value reflecting a linear scale between *minimum* and *maximum*.
 The two arguments to the function returned should be :class:`Real` numbers between
@@ -1791,7 +6061,9 @@ Raises a :exc:`ValueError` if either *minimum* or *maximum* is not a Real number
 When the returned function is called if either of its arguments is not a Real number a
 :exc:`ValueError` is then raised. If either of those arguments is less than *minimum*,
 or greater than *maximum*, a warning is issued, and either *minimum* or *maximum*,
-respectively, is instead used as the argument's value.
+respectively, is instead used as the argument's value. When the ``"array"``
+:attr:`Agent.engine` applies the returned function to many instances at once a single
+warning is issued for all the values out of range.
 
 >>> f = bounded_linear_similarity(-1, 1)
 >>> f(0, 1)
@@ -1808,23 +6080,7 @@ respectively, is instead used as the argument's value.
 0.9999999999999999
 
     """
-    if minimum >= maximum:
-        raise ValueError(f"minimum, {minimum}, is not less than maximum, {maximum}")
-    def _similarity(x, y):
-        if x < minimum:
-            warn(f"{x} is less than {minimum}, so {minimum} is instead being used in computing similarity")
-            x = minimum
-        elif x > maximum:
-            warn(f"{x} is greater than {maximum}, so {maximum} is instead being used in computing similarity")
-            x = maximum
-        if y < minimum:
-            warn(f"{y} is less than {minimum}, so {minimum} is instead being used in computing similarity")
-            y = minimum
-        elif y > maximum:
-            warn(f"{y} is greater than {maximum}, so {maximum} is instead being used in computing similarity")
-            y = maximum
-        return 1 - abs(x - y) / abs(maximum - minimum)
-    return _similarity
+    return _BoundedSimilarity(minimum, maximum, 1)
 
 def bounded_quadratic_similarity(minimum, maximum):
     """Returns a function of two arguments that returns a similarity value reflecting a quadratic scale between *minimum* and *maximum*.
@@ -1842,7 +6098,9 @@ Raises a :exc:`ValueError` if either *minimum* or *maximum* is not a Real number
 When the returned function is called if either of its arguments is not a Real number a
 :exc:`ValueError` is then raised. If either of those arguments is less than *minimum*,
 or greater than *maximum*, a warning is issued, and either *minimum* or *maximum*,
-respectively, is instead used as the argument's value.
+respectively, is instead used as the argument's value. When the ``"array"``
+:attr:`Agent.engine` applies the returned function to many instances at once a single
+warning is issued for all the values out of range.
 
 >>> f = bounded_quadratic_similarity(-1, 1)
 >>> f(0, 1)
@@ -1859,8 +6117,7 @@ respectively, is instead used as the argument's value.
 0.9999999999999998
 
     """
-    f = bounded_linear_similarity(minimum, maximum)
-    return lambda x, y: f(x, y)**2
+    return _BoundedSimilarity(minimum, maximum, 2)
 
 
 # Local variables:
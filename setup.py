@@ -20,6 +20,7 @@ setup(name="pyibl",
           "pyactup>=2.2.3",
           "prettytable",
           "ordered_set",
+          "pylru",
           "pandas",
           "matplotlib",
           "packaging"],
@@ -1,6 +1,12 @@
 # Copyright 2014-2025 Carnegie Mellon University
 
+import copy
+import functools
+import json
 import math
+import os
+import pickle
+import numpy as np
 import pytest
 import random
 import re
@@ -355,6 +361,50 @@ def test_respond():
     del d["outcome"]
     assert d ==  {"decision": "A", "created": 4, "occurrences": (4,)}
 
+def test_populate_many(tmp_path):
+    import pandas as pd
+    rnd = random.Random(0)
+    rows = [{"button": rnd.choice(["left", "right"]), "lit": rnd.randint(1, 3),
+             "outcome": rnd.choice([0, 2.5, 5]), "time": rnd.randint(0, 10), "ignored": "x"}
+            for i in range(200)]
+    df = pd.DataFrame(rows)
+    df.to_csv(tmp_path / "rows.csv", index=False)
+    for engine in ("pyactup", "array"):
+        for optimized in (False, True):
+            expected = Agent(["button", "lit"], engine=engine, optimized_learning=optimized)
+            expected.advance(10)
+            for r in sorted(rows, key=lambda r: r["time"]):
+                expected.populate([(r["button"], r["lit"])], r["outcome"], when=r["time"])
+            expected = expected.instances(None)
+            for data in (df, rows, df.to_records(index=False), tmp_path / "rows.csv",
+                         str(tmp_path / "rows.csv")):
+                a = Agent(["button", "lit"], engine=engine, optimized_learning=optimized)
+                a.advance(10)
+                a.populate_many(data, time="time")
+                assert a.time == 10
+                assert a.instances(None) == expected
+            a.choose([("left", 1), ("right", 2)])
+            a.respond(1)
+            assert a.time == 11
+    a = Agent(engine="array")
+    a.populate_many([{"decision": "A", "payoff": 1}, {"decision": "B", "payoff": 2},
+                     {"decision": "A", "payoff": 1}], outcome="payoff")
+    assert a.instances(None) == [{"decision": "A", "outcome": 1, "created": 0,
+                                  "occurrences": (0, 0)},
+                                 {"decision": "B", "outcome": 2, "created": 0,
+                                  "occurrences": (0,)}]
+    bad = [pd.DataFrame({"decision": ["A"], "outcome": ["high"]}),
+           pd.DataFrame({"decision": [["A"]], "outcome": [1]}),
+           pd.DataFrame({"decision": [None], "outcome": [1]}),
+           pd.DataFrame({"choice": ["A"], "outcome": [1]}),
+           pd.DataFrame({"decision": ["A", "B"], "outcome": [1, 2], "time": [0, 0.5]}),
+           pd.DataFrame({"decision": ["A", "B"], "outcome": [1, 2], "time": [0, 1]})]
+    for data in bad:
+        a = Agent()
+        with pytest.raises(ValueError):
+            a.populate_many(data, time=("time" if "time" in data else None))
+        assert len(a.instances(None)) == 0
+
 def test_populate():
     a = Agent()
     assert len(a.instances(None)) == 0
@@ -802,6 +852,48 @@ def test_instances(tmp_path):
     lines = p.read_text().split("\n")
     assert len(lines) > 100 + len(choices)
 
+def test_instances_frame():
+    import pandas as pd
+    for engine in ("pyactup", "array"):
+        for ol in (False, True, 3):
+            a = Agent(["button", "lit"], engine=engine, optimized_learning=ol,
+                      mismatch_penalty=1, seed=7)
+            a.similarity(["lit"], lambda x, y: 1 if x == y else 0.5)
+            a.populate([("left", True), ("right", False), ("middle", True),
+                        ("middle", False)], 4)
+            for i in range(60):
+                a.choose([("left", True), ("right", False), ("middle", i % 3 == 0)])
+                a.respond(i % 7)
+            expected = a.instances(None)
+            assert list(a.iter_instances()) == expected
+            df, offsets, times = a.instances_frame(references=True)
+            assert list(df.columns) == ["button", "lit", "outcome", "created",
+                                        "reference_count", "last_reference"]
+            assert len(df) == len(expected) == len(offsets) - 1
+            assert list(df["button"]) == [d["button"] for d in expected]
+            assert list(df["lit"]) == [d["lit"] for d in expected]
+            assert list(df["outcome"]) == [d["outcome"] for d in expected]
+            assert list(df["created"]) == [d["created"] for d in expected]
+            for i, d in enumerate(expected):
+                assert tuple(times[offsets[i]:offsets[i+1]]) == d["occurrences"]
+                if d["occurrences"]:
+                    assert df["last_reference"][i] == max(d["occurrences"])
+                else:
+                    assert pd.isna(df["last_reference"][i])
+            if ol is False:
+                assert list(df["reference_count"]) == [len(d["occurrences"])
+                                                       for d in expected]
+            pd.testing.assert_frame_equal(a.instances_frame(), df)
+    a = Agent()
+    a.populate(["x", "y"], 1)
+    a.choose("xy")
+    a.respond(2)
+    df = a.instances_frame()
+    assert list(df.columns) == ["decision", "outcome", "created", "reference_count",
+                                "last_reference"]
+    assert list(df["decision"]) == ["x", "y", a.instances(None)[-1]["decision"]]
+    assert len(Agent(["a"]).instances_frame()) == 0
+
 def test_details():
     a = Agent(temperature=1, noise=0, decay=10)
     a.details = True
@@ -835,6 +927,57 @@ def test_details():
     assert a.details[0] == "a"
     assert len(a.details) == 2
 
+def test_details_policy():
+    from collections import deque
+    for engine in ("pyactup", "array"):
+        a = Agent(default_utility=10, default_utility_populates=True, engine=engine)
+        a.details = DetailsPolicy(sample_every=5, participants={2})
+        assert a.details == [] and a.details_policy.sample_every == 5
+        for p in range(3):
+            a.reset()
+            for i in range(12):
+                a.choose(["a", "b"])
+                a.respond(i)
+        assert len(a.details) == 3
+        assert [d["blended"] for d in a.details[0]] == [10, 10]
+        assert all(len(d) == 2 and d[0]["activations"] for d in a.details[1:])
+        t = a.time
+        a.details = DetailsPolicy(times=range(t + 3, t + 7), choices=["b", "c"], maxlen=2)
+        assert isinstance(a.details, deque) and a.details.maxlen == 2
+        for i in range(10):
+            a.choose(["a", "b", "c"])
+            a.respond(i)
+        assert len(a.details) == 2
+        assert all([d["decision"] for d in det] == ["b", "c"] for det in a.details)
+        a.details = DetailsPolicy(choices=["z"])
+        a.choose(["a", "b"])
+        a.respond(1)
+        assert a.details == []
+        a.details = True
+        assert a.details_policy is None
+        a.choose(["a", "b"])
+        a.respond(1)
+        assert len(a.details) == 1 and len(a.details[0]) == 2
+        a.details = DetailsPolicy(participants={0})
+        assert a.fork().details is None and a.fork().details_policy is None
+    a = Agent(["p", "q"], default_utility=1)
+    for chosen in ([("l", 1)], [["l", 1]], [{"q": 1, "p": "l"}]):
+        a.details = DetailsPolicy(choices=chosen)
+        for options in ([("l", 1), ("r", 2)], [["l", 1], ["r", 2]],
+                        [{"p": "l", "q": 1}, {"p": "r", "q": 2}]):
+            a.choose(options)
+            a.respond(1)
+        assert len(a.details) == 3
+        assert all([(d["p"], d["q"]) for d in det] == [("l", 1)] for det in a.details)
+    with pytest.raises(ValueError):
+        a.details = DetailsPolicy(choices=[("l", 1), ["l", 1]])
+    with pytest.raises(ValueError):
+        DetailsPolicy(sample_every=0)
+    with pytest.raises(ValueError):
+        DetailsPolicy(maxlen=1.5)
+    with pytest.raises(ValueError):
+        DetailsPolicy(participants=["x"])
+
 def test_trace(capsys):
     a = Agent(default_utility=10)
     a.choose("abcd")
@@ -860,6 +1003,52 @@ def test_trace(capsys):
     a.noise = 0
     a.choose("abcd")            # shouldn't raise error with zero noise
 
+def test_trace_writer(tmp_path, capsys):
+    p = tmp_path / "trace.jsonl"
+    with TraceWriter(p, sample_every=10, participants={2, 4}, buffer_records=3) as w:
+        assert w.sample_every == 10 and w.participants == {2, 4}
+        a = Agent(["button"], default_utility=10, default_utility_populates=True)
+        a.trace = w
+        assert a.trace is w
+        for i in range(5):
+            a.reset()
+            for j in range(25):
+                a.choose([{"button": "left"}, {"button": "right"}])
+                a.respond(random.random() * 5)
+        b = a.fork()
+        assert b.trace is False
+        b.choose()
+        b.respond(1)
+    assert capsys.readouterr().out == ""
+    records = [json.loads(line) for line in p.read_text().splitlines()]
+    assert [(r["participant"], r["choice"]) for r in records] == [
+        (p, c) for p in (2, 4) for c in (0, 10, 20)]
+    for r in records:
+        assert r["agent"] == a.name and r["attributes"] == ["button"]
+        assert [o["option"] for o in r["options"]] == [{"button": "left"},
+                                                         {"button": "right"}]
+        for o in r["options"]:
+            if r["choice"] == 0:
+                assert o["instances"] == [] and o["blended"] == 10
+                continue
+            assert isclose(sum(i["retrieval_probability"] for i in o["instances"]), 1)
+            assert isclose(o["blended"], sum(i["retrieval_probability"] * i["outcome"]
+                                             for i in o["instances"]))
+    print_trace(p, participants={4})
+    out = capsys.readouterr().out
+    assert out.count("button: left →") == 3
+    assert re.search("button.+base activation.+activation noise.+retrieval probability", out)
+    a.trace = True
+    a.choose()
+    a.respond(2)
+    assert capsys.readouterr().out.count("button: right →") == 1
+    with pytest.raises(RuntimeError):
+        a.trace = w
+    with pytest.raises(ValueError):
+        TraceWriter(p, sample_every=0)
+    with pytest.raises(ValueError):
+        TraceWriter(p, participants=["x"])
+
 def test_positive_linear_similarity():
     assert isclose(positive_linear_similarity(1, 2), 0.5)
     assert isclose(positive_linear_similarity(2, 1), 0.5)
@@ -1378,3 +1567,961 @@ def test_plot():
         a.plot("foo")
     with pytest.raises(ValueError):
         a.plot("")
+
+def test_cohort():
+    with pytest.raises(ValueError):
+        Cohort(0)
+    with pytest.raises(ValueError):
+        Cohort(2.5)
+    with pytest.raises(ValueError):
+        Cohort(10, optimized_learning=3)
+    c = Cohort(3, temperature=1, noise=0)
+    assert c.participants == 3 and c.time == 0
+    c.populate("A", 10)
+    c.populate("B", 5)
+    assert list(c.choose("AB")) == ["A", "A", "A"]
+    assert c.time == 1
+    with pytest.raises(RuntimeError):
+        c.choose("AB")
+    c.respond(0)
+    choices, bv = c.choose(details=True)
+    assert list(choices) == ["B", "B", "B"]
+    assert bv.shape == (3, 2)
+    assert all(isclose(v, 4.142135623730951) for v in bv[:, 0])
+    assert all(isclose(v, 5.0) for v in bv[:, 1])
+    c.respond([10, 20, 30])
+    assert c.time == 2
+    with pytest.raises(RuntimeError):
+        c.respond(0)
+    c.choose()
+    with pytest.raises(ValueError):
+        c.respond([1, 2])
+    c.respond(None)
+    c.reset(True)
+    assert c.time == 0
+    assert list(c.choose("AB")) == ["A", "A", "A"]
+    c.respond(0)
+    c = Cohort(4, ["button", "lit"], default_utility=1)
+    choices = c.choose([("left", True), {"button": "right", "lit": False}])
+    assert len(choices) == 4
+    assert all(ch in (("left", True), {"button": "right", "lit": False}) for ch in choices)
+    c.respond(0)
+    with pytest.raises(ValueError):
+        c.choose([("left", True), ("left", True)])
+    c = Cohort(2)
+    with pytest.raises(RuntimeError):
+        c.choose("ab")
+    a = Agent(noise=0.3, decay=0.6, default_utility=7, optimized_learning=True)
+    c = a.cohort(5)
+    assert isclose(c.noise, 0.3) and isclose(c.decay, 0.6)
+    assert c.optimized_learning and c.default_utility == 7
+    for r in range(10):
+        c.choose("xyz")
+        c.respond(np.arange(5))
+    with pytest.warns(UserWarning):
+        a.mismatch_penalty = 1
+    with pytest.raises(ValueError):
+        a.cohort(5)
+    # a Cohort is statistically equivalent to many separate Agents
+    participants = 2000
+    rounds = 30
+    with randomseed():
+        rng = np.random.default_rng(0)
+        c = Cohort(participants, default_utility=4.8)
+        cohort_risky = np.zeros(rounds)
+        for r in range(rounds):
+            choices = c.choose(["safe", "risky"])
+            c.respond(np.where(choices == "safe", 3,
+                               np.where(rng.random(participants) < 0.25, 12, 0)))
+            cohort_risky[r] = np.mean(choices == "risky")
+        agent_risky = np.zeros(rounds)
+        a = Agent(default_utility=4.8)
+        for p in range(participants // 4):
+            a.reset()
+            for r in range(rounds):
+                choice = a.choose(["safe", "risky"])
+                a.respond(3 if choice == "safe" else (12 if random.random() < 0.25 else 0))
+                agent_risky[r] += (choice == "risky")
+        agent_risky /= participants // 4
+    assert np.mean(np.abs(cohort_risky - agent_risky)) < 0.03
+
+def test_array_engine():
+    assert Agent().engine == "pyactup"
+    assert Agent(engine="array").engine == "array"
+    with pytest.raises(ValueError):
+        Agent(engine="fast")
+    assert Agent(engine="array", mismatch_penalty=1).mismatch_penalty == 1
+    def run(engine, optimized_learning, attributes):
+        with randomseed():
+            a = Agent(attributes, engine=engine, optimized_learning=optimized_learning,
+                      default_utility=(None if attributes else 9))
+            a.aggregate_details = True
+            if attributes:
+                a.populate([{"button": b, "lit": x} for b in "lr" for x in (True, False)], 8)
+            choices = []
+            values = []
+            for i in range(60):
+                if attributes:
+                    ch = [{"button": b, "lit": random.random() < 0.5} for b in "lr"]
+                else:
+                    ch = "abc"
+                c, d = a.choose(ch, details=True)
+                choices.append(c)
+                values.extend(x["blended_value"] for x in d)
+                if optimized_learning is False and i % 7 == 0:
+                    a.respond().update(random.random() * 10)
+                else:
+                    a.respond(random.random() * (10 if c != "b" else 6))
+                if optimized_learning is False and i == 30:
+                    a.reset(True)
+            return choices, values, a.instances(None), a.aggregate_details
+    for ol in (False, True, 2):
+        for attributes in ([], ["button", "lit"]):
+            p = run("pyactup", ol, attributes)
+            r = run("array", ol, attributes)
+            assert p[0] == r[0]
+            assert all(isclose(x, y) for x, y in zip(p[1], r[1]))
+            assert p[2] == r[2]
+            assert p[3].shape == r[3].shape
+            assert all(isclose(x, y)
+                       for x, y in zip(p[3]["activation"], r[3]["activation"]))
+    # changing the decay part way through uses a rebuilt table of lag powers
+    values = []
+    for engine in ("pyactup", "array"):
+        with randomseed():
+            a = Agent(engine=engine, noise=0, default_utility=10)
+            for i in range(1500):
+                a.choose("ab")
+                a.respond(i % 3)
+                if i == 700:
+                    a.decay = 0.3
+            a.decay = 1.7
+            values.append([d["blended_value"] for d in a.choose("ab", details=True)[1]])
+    assert all(isclose(x, y) for x, y in zip(*values))
+
+def test_rng():
+    with pytest.raises(ValueError):
+        Agent(seed=1, rng=np.random.default_rng(1))
+    with pytest.raises(ValueError):
+        Agent(rng=17)
+    def run(seed=None, rng=None, engine="pyactup"):
+        a = Agent(default_utility=5, seed=seed, rng=rng, engine=engine)
+        result = []
+        for i in range(100):
+            random.random()
+            c = a.choose("abcd")
+            a.respond(3 if c == "a" else (6 if i % 3 else 0))
+            result.append(c)
+        return result
+    r = run(seed=42)
+    assert len(set(r)) > 1
+    assert run(seed=42) == r
+    assert run(rng=np.random.default_rng(42)) == r
+    assert run(seed=42, engine="array") == r
+    assert run(seed=43) != r
+    a = Agent(seed=7)
+    g = a.rng
+    assert isinstance(g, np.random.Generator)
+    a.reset()
+    assert a.rng is g
+    a.rng = None
+    assert a.rng is not g and isinstance(a.rng, np.random.Generator)
+    with pytest.raises(ValueError):
+        a.rng = "foo"
+
+def test_aggregate_recorder(monkeypatch):
+    monkeypatch.setattr("pyibl.AGGREGATE_CHUNK_ROWS", 7)
+    with randomseed():
+        a = Agent(["button", "lit"], default_utility=3)
+        a.aggregate_details = True
+        frames = []
+        for p in range(3):
+            a.reset()
+            for r in range(6):
+                a.choose([("left", r % 2 == 0), ("right", True)])
+                a.respond(random.random() * 5)
+            frames.append(a.aggregate_details)
+    df = frames[-1]
+    assert df.shape[1] == 10 and len(df) > 3 * 7
+    assert df["choice"].dtype == "category" and df["option"].dtype == "category"
+    assert set(df["option"]) == {("left", True), ("left", False), ("right", True)}
+    assert not df["choice"].isna().any()
+    for f in frames[:-1]:
+        assert f.equals(df.iloc[:len(f)])
+    assert a.aggregate_details is not df and a.aggregate_details.equals(df)
+    df.loc[0, "utility"] = -1000
+    assert a.aggregate_details.loc[0, "utility"] != -1000
+
+def test_aggregate_sinks(tmp_path):
+    import pandas as pd
+    from pyibl import df_plot
+    with pytest.raises(ValueError):
+        CSVSink(tmp_path / "x.csv", flush_rows=0)
+    def run(details):
+        with randomseed():
+            a = Agent(default_utility=5)
+            a.aggregate_details = details
+            for p in range(12):
+                a.reset()
+                for r in range(20):
+                    a.choose(["safe", "risky"])
+                    a.respond(random.random() * 10)
+            return a
+    df = run(True).aggregate_details
+    sink = CSVSink(tmp_path / "run.csv", flush_rows=100)
+    a = run(sink)
+    assert a.aggregate_details is sink
+    with pytest.raises(RuntimeError):
+        Agent().aggregate_details = sink
+    sink.close()
+    sink.close()
+    csv = pd.read_csv(tmp_path / "run.csv")
+    assert csv.shape == (len(df), 11)
+    assert list(csv["choice"]) == list(df["choice"])
+    assert all(isclose(x, y) for x, y in zip(csv["activation"], df["activation"]))
+    with pytest.raises(RuntimeError):
+        Agent().aggregate_details = sink
+    pytest.importorskip("pyarrow")
+    path = tmp_path / "run.parquet"
+    with ParquetSink(path, flush_rows=200) as sink:
+        a = run(sink)
+        a.plot("bv", show=False)
+    files = sorted(os.listdir(path))
+    assert len(files) > 1 and files[0].startswith("iterations-000001-")
+    pq = pd.read_parquet(path)
+    assert pq.shape == (len(df), 11)
+    assert list(pq["iteration"]) == list(df["iteration"])
+    assert all(isclose(x, y) for x, y in zip(pq["blended_value"], df["blended_value"]))
+    for kind in ("choice", "bv", "probability"):
+        expected = [list(line.get_ydata())
+                    for line in df_plot(df, kind, show=False).axes[0].lines]
+        for source in (path, tmp_path / "run.csv"):
+            actual = [list(line.get_ydata())
+                      for line in df_plot(source, kind, show=False).axes[0].lines]
+            assert len(actual) == len(expected)
+            for x, y in zip(actual, expected):
+                assert all(isclose(p, q) for p, q in zip(x, y))
+    with pytest.raises(ValueError):
+        df_plot(path, "mismatch", show=False)
+    # existing data is never overwritten
+    with pytest.raises(ValueError):
+        ParquetSink(path)
+    assert sorted(os.listdir(path)) == files
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "notes.txt").write_text("keep")
+    with ParquetSink(other, flush_rows=200) as sink:
+        run(sink)
+    assert (other / "notes.txt").read_text() == "keep"
+
+def test_aggregate_summary():
+    from pyibl import df_plot
+    def run(details):
+        with randomseed():
+            a = Agent(["button", "lit"], mismatch_penalty=1)
+            a.similarity("lit", lambda x, y: 1 - abs(x - y) / 4)
+            a.populate([("left", 1), ("right", 2)], 4)
+            a.aggregate_details = details
+            for p in range(10):
+                a.reset(True)
+                for r in range(15):
+                    a.choose([("left", random.randint(1, 3)), ("right", 2)])
+                    a.respond(random.choice([0, 2, 5]))
+            return a
+    full = run(True).aggregate_details
+    a = run("summary")
+    summary = a.aggregate_details
+    assert tuple(summary.columns) == ("statistic", "time", "option", "utility",
+                                      "count", "sum", "sum_of_squares")
+    choices = summary[summary.statistic == "choice"]
+    assert choices["count"].sum() == full.groupby(["iteration", "time"]).ngroups
+    act = summary[summary.statistic == "activation"]
+    assert act["count"].sum() == len(full)
+    assert isclose(act["sum"].sum(), full["activation"].sum())
+    assert isclose(act["sum_of_squares"].sum(), (full["activation"] ** 2).sum())
+    def lines(fig):
+        return [(line.get_label(), line.get_color(), list(line.get_xdata()),
+                 list(line.get_ydata())) for line in fig.axes[0].lines]
+    for kind in ("choice", "bv", "probability", "baselevel", "mismatch", "lit.similarity"):
+        for kwargs in ({}, {"earliest": 3, "latest": 12, "min": 1}):
+            expected = lines(df_plot(full, kind, show=False, **kwargs))
+            actual = lines(df_plot(summary, kind, show=False, **kwargs))
+            assert len(actual) == len(expected) > 0
+            for x, y in zip(actual, expected):
+                assert x[:3] == y[:3]
+                assert all(isclose(p, q) for p, q in zip(x[3], y[3]))
+    assert lines(a.plot("bv", show=False)) == lines(df_plot(summary, "bv", show=False))
+    with pytest.raises(ValueError):
+        df_plot(summary, "button.similarity", show=False)
+
+def test_aggregate_merge():
+    import pandas as pd
+    from pyibl import df_plot
+    def run(details, participants, seed, mismatch_penalty=1):
+        with randomseed(seed):
+            a = Agent(["button", "lit"], mismatch_penalty=mismatch_penalty)
+            a.similarity("lit", lambda x, y: 1 - abs(x - y) / 4)
+            a.populate([("left", 1), ("right", 2)], 4)
+            a.aggregate_details = details
+            for p in range(participants):
+                a.reset(True)
+                for r in range(15):
+                    a.choose([("left", random.randint(1, 3) if mismatch_penalty else 1),
+                              ("right", 2)])
+                    a.respond(random.choice([0, 2, 5]))
+            return a
+    agents = [run(True, 4, 1, None), run(True, 3, 2), run(True, 5, 3)]
+    parts = [pickle.loads(pickle.dumps(a.aggregate_accumulator)) for a in agents]
+    assert all(isinstance(p, AggregateRecorder) for p in parts)
+    for p, a in zip(parts, agents):
+        assert p.frame().equals(a.aggregate_details)
+    assert "mismatch" not in parts[0].frame().columns
+    copies = lambda: [pickle.loads(pickle.dumps(p)) for p in parts]
+    merged = copies()
+    assert merged[0].merge(merged[1]).merge(merged[2]) is merged[0]
+    merged = merged[0].frame()
+    a, b, c = copies()
+    assert merged.equals(a.merge(b.merge(c)).frame())
+    assert len(merged) == sum(len(a.aggregate_details) for a in agents)
+    assert sorted(merged["iteration"].unique()) == list(range(1, 13))
+    expected = []
+    offset = 0
+    for a in agents:
+        df = a.aggregate_details.copy()
+        df["iteration"] += offset
+        offset = df["iteration"].max()
+        expected.append(df)
+    expected = pd.concat(expected, ignore_index=True)
+    categorical = {"choice": object, "option": object}
+    pd.testing.assert_frame_equal(merged.astype(categorical), expected.astype(categorical))
+    assert merged["mismatch"].isna().sum() == len(agents[0].aggregate_details)
+    summaries = [run("summary", 4, 1, None), run("summary", 3, 2), run("summary", 5, 3)]
+    summary = pickle.loads(pickle.dumps(summaries[0].aggregate_accumulator))
+    assert isinstance(summary, AggregateSummary)
+    for a in summaries[1:]:
+        summary.merge(a.aggregate_accumulator)
+    def lines(fig):
+        # the full details of the agent not partially matching contribute missing
+        # mismatches, plotted as gaps, but not summarized at all
+        return [(line.get_label(),
+                 *map(list, zip(*((x, y) for x, y in zip(line.get_xdata(), line.get_ydata())
+                                  if not np.isnan(y)))))
+                for line in fig.axes[0].lines]
+    full = copies()
+    full[0].merge(full[1]).merge(full[2])
+    for kind in ("choice", "bv", "probability", "mismatch"):
+        expected = lines(df_plot(full[0], kind, show=False))
+        actual = lines(df_plot(summary, kind, show=False))
+        assert len(actual) == len(expected) > 0
+        for x, y in zip(actual, expected):
+            assert x[:2] == y[:2]
+            assert all(isclose(p, q) for p, q in zip(x[2], y[2]))
+    with pytest.raises(ValueError):
+        summary.merge(parts[0])
+    a = Agent(["button"])
+    assert a.aggregate_accumulator is None
+    a.aggregate_details = True
+    with pytest.raises(ValueError):
+        parts[0].merge(a.aggregate_accumulator)
+
+def test_plot_data():
+    import pandas as pd
+    from pyibl import ChoicePlot, OptionPlot, InstancePlot
+    df = pd.DataFrame({"iteration": [1, 1, 1, 1, 2, 2, 2, 2, 2],
+                       "time": [1, 1, 2, 2, 1, 1, 2, 2, 3],
+                       "choice": ["a", "a", "b", "b", "a", "a", "a", "a", "b"],
+                       "utility": [1.0, 2.0, 1.0, 3.0, 1.0, 2.0, 1.0, 3.0, 3.0],
+                       "option": ["a", "b", "a", "b", "a", "b", "a", "b", "b"],
+                       "blended_value": [1.0, 2.0, 1.5, 2.5, 1.0, 2.0, 3.0, 4.5, 3.0],
+                       "retrieval_probability": [1.0] * 9,
+                       "activation": [0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5],
+                       "base_level_activation": [0.0] * 9,
+                       "activation_noise": [0.0] * 9})
+    args = (None, None, None, None, None, None)
+    assert ChoicePlot("choice", "").get_data(df, *args) == {"a": ((1, 2, 3), (1.0, 0.5, 0.0)),
+                                                            "b": ((1, 2, 3), (0.0, 0.5, 1.0))}
+    assert ChoicePlot("choice", "").get_data(df, ["b"], None, None, None, 2, None) == {
+        "b": ((2, 3), (0.5, 1.0))}
+    bv = OptionPlot("blended_value", "").get_data(df, *args)
+    assert list(bv) == ["a", "b"]
+    assert bv["a"][0] == [1, 2] and list(bv["a"][1]) == [1.0, 2.25]
+    assert bv["b"][0] == [1, 2, 3] and list(bv["b"][1]) == [2.0, 3.5, 3.0]
+    act = InstancePlot("activation", "").get_data(df, None, None, 1.5, None, None, 2)
+    assert list(act) == ["b, 2.0", "b, 3.0"]
+    assert act["b, 2.0"][0] == [1] and list(act["b, 2.0"][1]) == [2.0]
+    assert act["b, 3.0"][0] == [2] and list(act["b, 3.0"][1]) == [3.0]
+
+def test_similarity_cache():
+    calls = []
+    def sim(x, y):
+        calls.append((x, y))
+        return 1 - abs(x - y) / 10
+    def run(cache):
+        calls.clear()
+        a = Agent(["size"], mismatch_penalty=1, noise=0.25,
+                  rng=np.random.default_rng(17))
+        a.similarity("size", sim, cache=cache)
+        results = []
+        for i in range(3):
+            a.reset()
+            a.populate([{"size": s} for s in range(5)], 10)
+            for s in (7, 3, 8, 7, 3):
+                results.append(a.choose([{"size": s}, {"size": s + 1}]))
+                a.respond(s % 3)
+        return a, results
+    a, cached = run(4096)
+    cached_calls = len(calls)
+    info = a.similarity_cache_info("size")
+    assert info["misses"] == cached_calls
+    assert info["hits"] > 0
+    assert info["size"] == 2 * cached_calls - sum(1 for x, y in calls if x == y)
+    assert info["capacity"] == 4096
+    b, bounded = run(2)
+    assert len(calls) > cached_calls
+    assert b.similarity_cache_info("size")["size"] <= 2
+    assert cached == bounded
+    a.similarity("size", sim)
+    assert a.similarity_cache_info("size") == {"hits": 0, "misses": 0,
+                                               "size": 0, "capacity": 4096}
+    assert Agent(["size"]).similarity_cache_info("size") is None
+    c = Agent(["size"])
+    c.similarity("size", sim)
+    assert c.similarity_cache_info("size") is None
+    for bad in (0, -1, 2.5, True, "10"):
+        with pytest.raises(ValueError):
+            c.similarity("size", sim, cache=bad)
+    d = Agent(mismatch_penalty=1)
+    d.similarity(function=lambda x, y: 1 - abs(x - y) / 10, cache=10)
+    d.populate([1, 2], 0)
+    d.choose([1, 2])
+    assert d.similarity_cache_info()["misses"] > 0
+
+def test_similarity_domain():
+    payments = [2, 3, 4, 5, 6, 7, 8, 9]
+    probabilities = [0.05, 0.22, 0.36, 0.41, 0.51]
+    def run(engine, domain):
+        with randomseed():
+            a = Agent(["payment", "probability"], engine=engine, mismatch_penalty=2.5)
+            a.similarity("payment", lambda x, y: 1 - abs(x - y) / 10,
+                         domain=(payments if domain else None))
+            a.similarity("probability", lambda x, y: 1 - abs(x - y), 0.5,
+                         domain=(probabilities if domain else None))
+            a.populate([{"payment": 5, "probability": 0.36},
+                        {"payment": 2, "probability": 0.05}], 4)
+            a.details = True
+            choices = []
+            values = []
+            for i in range(40):
+                # 10 and 0.9 lie outside the domains
+                ch = random.sample([{"payment": x, "probability": y}
+                                    for x in payments + [10]
+                                    for y in probabilities + [0.9]], 3)
+                c = a.choose(ch)
+                choices.append(c)
+                values.extend(x["blended"] for x in a.details[-1])
+                a.respond(random.choice([c["payment"], -c["payment"], 0]))
+            activations = [(x["attributes"], x["mismatch"], x["similarities"])
+                           for x in a.details[-1][0]["activations"]]
+            return choices, values, activations
+    results = [run(e, d) for e in ("pyactup", "array") for d in (False, True)]
+    for r in results[1:]:
+        assert r[0] == results[0][0]
+        assert all(isclose(x, y) for x, y in zip(r[1], results[0][1]))
+        for x, y in zip(r[2], results[0][2]):
+            assert x[0] == y[0]
+            assert isclose(x[1], y[1])
+            assert all(isclose(x[2][k], y[2][k]) for k in y[2])
+    a = Agent(["x"], mismatch_penalty=1)
+    calls = []
+    def sim(x, y):
+        calls.append((x, y))
+        return 1 - abs(x - y) / 10
+    a.similarity("x", sim, domain=[1, 2, 3, 2])
+    assert len(calls) == 6
+    a.similarity("x", weight=0.5)
+    assert len(calls) == 6
+    a.similarity("x", lambda x, y: 1 - abs(x - y) / 5)
+    assert isclose(a._memory._similarities["x"]._similarity(1, 3), -0.2)
+    with pytest.raises(ValueError):
+        a.similarity("x", lambda x, y: 1 - abs(x - y), domain=[1, 2, 3])
+    with pytest.raises(ValueError):
+        a.similarity("x", lambda x, y: 1 - max(x - y, 0) / 10, domain=[1, 2, 3])
+    with pytest.raises(ValueError):
+        a.similarity("x", lambda x, y: "similar", domain=[1, 2])
+    with pytest.raises(ValueError):
+        a.similarity("x", sim, domain=[[1], [2]])
+    a.similarity("x")
+    a.similarity("x", sim)
+    assert not hasattr(a._memory._similarities["x"], "_domain")
+
+def test_similarity_kernels():
+    values = np.array([1.0, 2.0, 3.5, 8.0])
+    for f in (positive_linear_similarity, positive_quadratic_similarity,
+              bounded_linear_similarity(0, 10), bounded_quadratic_similarity(0, 10)):
+        assert all(isclose(x, f(v, 3)) for x, v in zip(f.vector(values, 3), values))
+        assert pickle.loads(pickle.dumps(f))(1, 3) == f(1, 3)
+    assert positive_linear_similarity.__name__ == "positive_linear_similarity"
+    with pytest.raises(ValueError):
+        positive_linear_similarity.vector(np.array([1.0, 0.0]), 2)
+    with pytest.raises(ValueError):
+        positive_quadratic_similarity.vector(values, -1)
+    f = bounded_linear_similarity(2, 4)
+    with pytest.warns(UserWarning) as record:
+        assert all(isclose(x, y) for x, y in zip(f.vector(values, 3), [0.5, 0.5, 0.75, 0.5]))
+    assert len(record) == 1 and "2 values" in str(record[0].message)
+    def run(engine, kernel):
+        with randomseed():
+            a = Agent(["x", "y"], engine=engine, mismatch_penalty=2)
+            a.similarity("x", kernel if kernel else lambda x, y: kernel_x(x, y))
+            a.similarity("y", bounded_quadratic_similarity(0, 20) if kernel
+                         else lambda x, y: kernel_y(x, y), 0.5)
+            a.populate([{"x": x, "y": y} for x in (1, 5, 9) for y in (0, 10, 20)], 10)
+            a.details = True
+            result = []
+            for i in range(30):
+                ch = random.sample([{"x": x, "y": y} for x in range(1, 11) for y in (2, 12)], 3)
+                result.append(a.choose(ch))
+                result.extend(d["blended"] for d in a.details[-1])
+                a.respond(random.random() * 10)
+            return result, [d["mismatch"] for d in a.details[-1][0]["activations"]]
+    kernel_x = positive_linear_similarity
+    kernel_y = bounded_quadratic_similarity(0, 20)
+    results = [run(e, k) for e in ("pyactup", "array") for k in (kernel_x, None)]
+    for r in results[1:]:
+        assert all(x == y if isinstance(x, dict) else isclose(x, y)
+                   for x, y in zip(r[0], results[0][0]))
+        assert all(isclose(x, y) for x, y in zip(r[1], results[0][1]))
+
+def test_retrieval_epsilon():
+    assert Agent().retrieval_epsilon is None
+    with pytest.raises(ValueError):
+        Agent(retrieval_epsilon=0.01)
+    for bad in (0, -1, "small"):
+        with pytest.raises(ValueError):
+            Agent(engine="array", retrieval_epsilon=bad)
+    pairs = [{"x": x, "y": y} for x in range(40) for y in range(40)]
+    def run(epsilon):
+        rnd = random.Random(5)
+        a = Agent(["x", "y"], engine="array", mismatch_penalty=10, seed=7,
+                  retrieval_epsilon=epsilon)
+        a.similarity("x", bounded_linear_similarity(0, 39))
+        a.similarity("y", lambda u, v: 1 - abs(u - v) / 40)
+        population = rnd.sample(pairs, 800)
+        for k in range(0, 800, 100):
+            a.populate(population[k:k+100], rnd.random() * 10, -rnd.randrange(20))
+        values = []
+        pruned = []
+        for i in range(15):
+            c, d = a.choose(rnd.sample(pairs, 3), details=True)
+            values.append([x["blended_value"] for x in d])
+            pruned.append(a.pruned_instances)
+            a.respond(rnd.random() * 10)
+        return values, pruned
+    exact, none_pruned = run(None)
+    assert not any(none_pruned)
+    for epsilon in (1e-6, 1e-2):
+        values, pruned = run(epsilon)
+        assert sum(pruned) > 0
+        for x, y in zip(values, exact):
+            assert all(abs(u - v) <= epsilon for u, v in zip(x, y))
+
+def test_range_index():
+    for epsilon in (1e-6, 1e-2):
+        rnd = random.Random(11)
+        a = Agent(["x"], engine="array", mismatch_penalty=20, temperature=0.2, seed=3,
+                  retrieval_epsilon=epsilon)
+        a.similarity("x", bounded_quadratic_similarity(0, 100))
+        a.populate([{"x": x} for x in range(0, 101, 2)], 5)
+        pruned = 0
+        for i in range(40):
+            options = [{"x": x} for x in rnd.sample(range(101), 3)]
+            b = copy.deepcopy(a)
+            b.retrieval_epsilon = None
+            c, d = a.choose(options, details=True)
+            pruned += a.pruned_instances
+            e = b.choose(options, details=True)[1]
+            assert b.pruned_instances == 0
+            for x, y in zip(d, e):
+                assert abs(x["blended_value"] - y["blended_value"]) <= epsilon
+            if i % 3 == 0:
+                r = a.respond()
+                a.choose(options)
+                a.respond(rnd.random() * 10)
+                r.update(rnd.random() * 10)
+            else:
+                a.respond(rnd.random() * 10)
+            if i % 10 == 5:
+                a.populate([{"x": rnd.randrange(101)}], rnd.random() * 10)
+            if i == 20:
+                a.reset(True)
+        assert pruned > 0
+    # the approximation used when optimized_learning is an integer can exceed the
+    # logarithm of the reference count
+    for ol in (False, True, 1, 2):
+        for position in (50, 60, 70, 80):
+            a = Agent(["x"], engine="array", decay=0.9, mismatch_penalty=8, noise=0,
+                      temperature=1, optimized_learning=ol, retrieval_epsilon=0.8)
+            a.similarity("x", bounded_linear_similarity(0, 100))
+            a.populate([{"x": 0}], 0)
+            for i in range(3):
+                a.populate([{"x": position}], 10)
+            b = copy.deepcopy(a)
+            b.retrieval_epsilon = None
+            u = a.choose([{"x": 0}], details=True)[1][0]["blended_value"]
+            v = b.choose([{"x": 0}], details=True)[1][0]["blended_value"]
+            assert abs(u - v) <= 0.8
+
+def test_eviction():
+    for bad in (0, -1, 2.5, True, "many"):
+        with pytest.raises(ValueError):
+            Agent(max_instances=bad)
+    with pytest.raises(ValueError):
+        Agent(evict_below_activation="low")
+    results = {}
+    for engine in ("pyactup", "array"):
+        for kwargs in ({"max_instances": 100}, {"evict_below_activation": -2.5}):
+            a = Agent(["x"], engine=engine, seed=5, default_utility=2, **kwargs)
+            assert a.evicted_instances == 0 and a.evicted_activation is None
+            rnd = random.Random(3)
+            sizes = []
+            for i in range(600):
+                a.choose([{"x": x} for x in range(3)])
+                if i % 50 == 0:
+                    r = a.respond()
+                    a.choose()
+                    a.respond(rnd.random())
+                    r.update(rnd.random())
+                else:
+                    a.respond(rnd.random())
+                sizes.append(len(a._memory))
+            assert a.evicted_instances > 0
+            assert len(a._memory) + a.evicted_instances == 3 + 600 + 600 // 50
+            if "max_instances" in kwargs:
+                assert max(sizes) <= 101
+            else:
+                assert a.evicted_activation < -2.5
+                assert max(sizes[300:]) < 300
+            results[engine, tuple(kwargs)] = (a.evicted_instances, a.evicted_activation,
+                                              [dict(c) for c in a._memory.values()])
+            a.reset()
+            assert a.evicted_instances == 0 and len(a._memory) == 0
+    for kwargs in ("max_instances",), ("evict_below_activation",):
+        assert results["pyactup", kwargs] == results["array", kwargs]
+
+def test_adaptive_optimized_learning():
+    with pytest.raises(ValueError):
+        Agent(optimized_learning="auto")
+    for bad in (0, -1, "tiny", True):
+        with pytest.raises(ValueError):
+            Agent(engine="array", activation_tolerance=bad)
+    assert Agent(engine="array").activation_tolerance == 0.001
+    a = Agent(engine="array")
+    a.optimized_learning = "auto"
+    assert a.optimized_learning == "auto"
+    a.populate(["a"], 1)
+    with pytest.raises(RuntimeError):
+        a.optimized_learning = False
+    agents = [Agent(engine="array", optimized_learning=ol, seed=9, activation_tolerance=0.01)
+              for ol in (False, "auto")]
+    rnd = random.Random(4)
+    for a in agents:
+        a.populate(["safe", "risky"], 5)
+    delayed = []
+    for i in range(3000):
+        choice = "safe" if rnd.random() < 0.8 else "risky"
+        outcome = rnd.choice([0, 3, 10])
+        for a in agents:
+            a.choose(["safe", "risky"])
+            if i == 100:
+                delayed.append(a.respond(None, choice))
+            else:
+                a.respond(outcome, choice)
+    for r in delayed:
+        r.update(7)
+    lengths = [sum(g.length for g in a._memory._groups.values()) for a in agents]
+    assert lengths[0] == 3002 and lengths[1] < lengths[0] / 2
+    for a in agents:
+        a.details = True
+        a.choose(["safe", "risky"])
+    for x, y in zip(*(a.details[-1] for a in agents)):
+        assert x["blended"] == pytest.approx(y["blended"], abs=0.01)
+        for u, v in zip(x["activations"], y["activations"]):
+            assert u["attributes"] == v["attributes"]
+            assert u["reference_count"] == v["reference_count"]
+            assert abs(u["base_level_activation"] - v["base_level_activation"]) <= 0.01
+    assert [len(a.instances(None)) for a in agents] == [len(agents[0].instances(None))] * 2
+    agents[1].reset()
+    assert agents[1].optimized_learning == "auto" and len(agents[1]._memory) == 0
+
+def _typed_instances(agent):
+    # instances(None), with the type of each value, so that, say, 0 and 0.0 differ
+    return [{k: (type(v), v) for k, v in d.items()} for d in agent.instances(None)]
+
+def test_snapshot(tmp_path):
+    with pytest.raises(ValueError):
+        Agent.restore(b"not a snapshot")
+    for engine in ("pyactup", "array"):
+        a = Agent(["x", "y"], engine=engine, mismatch_penalty=2, seed=8, fixed_noise=True)
+        a.similarity("y", bounded_linear_similarity(0, 20), weight=0.75)
+        a.populate([{"x": x, "y": 10} for x in range(6)], 5)
+        rnd = random.Random(6)
+        def options():
+            return [{"x": x, "y": rnd.randrange(20)} for x in rnd.sample(range(6), 3)]
+        for i in range(40):
+            a.choose(options())
+            a.respond(rnd.random() * 10)
+        a.choose(options())
+        b = Agent.restore(a.snapshot())
+        a.save(tmp_path / engine)
+        c = Agent.load(tmp_path / engine)
+        assert b is not a and b.name == a.name and b.engine == engine
+        assert b.time == a.time and b.mismatch_penalty == 2 and b.details is None
+        assert b.instances(None) == a.instances(None) == c.instances(None)
+        assert _typed_instances(b) == _typed_instances(a) == _typed_instances(c)
+        assert type(a.instances(None)[0]["created"]) is int
+        state = random.getstate()
+        for agent in (a, b, c):
+            rnd.setstate(state)
+            agent.respond(3)
+            agent.details = True
+            for i in range(20):
+                agent.choose(options())
+                agent.respond(rnd.random() * 10)
+        # new instances' names come from a counter shared by all agents
+        for agent in (a, b, c):
+            for d in agent.details:
+                for x in d:
+                    for act in x["activations"]:
+                        del act["name"]
+        assert a.details == b.details == c.details
+        assert a.instances(None) == b.instances(None) == c.instances(None)
+    a = Agent(engine="array", optimized_learning="auto", seed=2)
+    a.populate(["a", "b"], 1)
+    for i in range(1000):
+        a.choose(["a", "b"])
+        a.respond(i % 3)
+    b = Agent.restore(a.snapshot())
+    assert b.optimized_learning == "auto"
+    for agent in (a, b):
+        agent.details = True
+        agent.choose(["a", "b"])
+    assert a.details == b.details
+
+def test_fork():
+    for engine in ("pyactup", "array"):
+        a = Agent(["x", "y"], engine=engine, mismatch_penalty=1, seed=4)
+        a.similarity("y", lambda u, v: 1 - abs(u - v) / 10)
+        a.populate([{"x": x, "y": y} for x in range(3) for y in range(10)], 5)
+        rnd = random.Random(2)
+        def options():
+            return [{"x": x, "y": rnd.randrange(10)} for x in range(3)]
+        for i in range(30):
+            a.choose(options())
+            a.respond(rnd.random() * 10)
+        a.choose(options())
+        before = a.instances(None)
+        b = a.fork()
+        assert _typed_instances(b) == _typed_instances(a)
+        assert b is not a and b._memory is not a._memory and b.time == a.time
+        c = b.fork()
+        state = rnd.getstate()
+        histories = []
+        for agent in (a, b):
+            rnd.setstate(state)
+            agent.respond(4)
+            history = []
+            for i in range(20):
+                history.append(agent.choose(options()))
+                agent.respond(rnd.random() * 10)
+            histories.append((history, agent.instances(None)))
+        assert histories[0] == histories[1]
+        assert c.instances(None) == before
+        c.respond(100)
+        c.choose(options())
+        r = c.respond()
+        c.choose(options())
+        c.respond(1)
+        r.update(2)
+        assert a.instances(None) == histories[0][1]
+        assert b.instances(None) == histories[0][1]
+        assert len(c.instances(None)) == len(before) + 3
+        c.reset()
+        assert len(a.instances(None)) == len(histories[0][1])
+
+
+def _experiment_agent(condition):
+    return Agent(default_utility=(1.2 * condition))
+
+def _experiment_round(agent, condition, round, rng):
+    choice = agent.choose(["safe", "risky"])
+    if choice == "safe":
+        agent.respond(3)
+    else:
+        agent.respond(condition if rng.random() < 3 / condition else 0)
+    return choice == "risky"
+
+def test_experiment():
+    with pytest.raises(ValueError):
+        Experiment(_experiment_agent, _experiment_round, [4], participants=0)
+    with pytest.raises(ValueError):
+        Experiment(_experiment_agent, _experiment_round, [4], rounds=2.5)
+    with pytest.raises(ValueError):
+        Experiment(_experiment_agent, _experiment_round, [4], workers=-1)
+    with pytest.raises(ValueError):
+        Experiment(_experiment_agent, _experiment_round, [])
+    e = Experiment(_experiment_agent, _experiment_round, [4, 12], 20, 15, seed=3, workers=0)
+    assert e.conditions == (4, 12) and e.participants == 20 and e.rounds == 15
+    assert e.seed == 3 and e.workers == 0
+    serial = e.run()
+    assert serial.shape == (2, 20, 15)
+    assert set(np.unique(serial)) == {0, 1}
+    assert np.array_equal(serial, e.run())
+    for workers, chunk_size in ((1, None), (2, 3), (3, 40)):
+        assert np.array_equal(serial, Experiment(_experiment_agent, _experiment_round,
+                                                 [4, 12], 20, 15, seed=3,
+                                                 workers=workers,
+                                                 chunk_size=chunk_size).run())
+    assert not np.array_equal(serial, Experiment(_experiment_agent, _experiment_round,
+                                                 [4, 12], 20, 15, seed=4, workers=0).run())
+    e = Experiment(_experiment_agent, _experiment_round, [4], 5, 5, workers=0)
+    assert np.array_equal(e.run(), Experiment(_experiment_agent, _experiment_round, [4],
+                                              5, 5, seed=e.seed, workers=0).run())
+    with pytest.raises(TypeError):
+        Experiment(lambda c: None, _experiment_round, workers=0).run()
+
+
+def _fit_agent(condition, noise, decay):
+    return Agent(noise=noise, decay=decay, default_utility=1.2 * condition)
+
+def test_fit(tmp_path):
+    import pandas as pd
+    human = pd.DataFrame({"risky": np.linspace(0.5, 0.3, 10)})
+    calls = []
+    def loss(results, data):
+        calls.append(results.shape)
+        return float(np.mean((results.mean(axis=(0, 1)) - data["risky"]) ** 2))
+    grid = {"noise": [0.1, 0.25, 0.5], "decay": np.linspace(0.2, 1.0, 3)}
+    kwargs = {"conditions": [4, 12], "participants": 6, "rounds": 10, "seed": 7}
+    serial = fit(_fit_agent, _experiment_round, human, loss, grid, workers=0, **kwargs)
+    assert list(serial.columns) == ["noise", "decay", "loss"]
+    assert len(serial) == 9 and len(calls) == 9 and calls[0] == (2, 6, 10)
+    assert list(serial["loss"]) == sorted(serial["loss"])
+    assert sorted(set(serial["decay"])) == list(np.linspace(0.2, 1.0, 3))
+    parallel = fit(_fit_agent, _experiment_round, human, loss, grid, workers=2, **kwargs)
+    pd.testing.assert_frame_equal(serial, parallel)
+    # common random numbers: the best candidate's results are those of an Experiment
+    # with the same seed
+    best = serial.iloc[0]
+    results = Experiment(functools.partial(_fit_agent, noise=best["noise"],
+                                           decay=best["decay"]),
+                         _experiment_round, workers=0, **kwargs).run()
+    assert isclose(loss(results, human), best["loss"])
+    cache = tmp_path / "fit.jsonl"
+    def interrupted(results, data):
+        if len(calls) >= 4:
+            raise KeyboardInterrupt()
+        return loss(results, data)
+    calls.clear()
+    with pytest.raises(KeyboardInterrupt):
+        fit(_fit_agent, _experiment_round, human, interrupted, grid, workers=0,
+            cache=cache, **kwargs)
+    assert len(calls) == 4
+    calls.clear()
+    resumed = fit(_fit_agent, _experiment_round, human, loss, grid, workers=0,
+                  cache=cache, **dict(kwargs, seed=None))
+    assert len(calls) == 5
+    pd.testing.assert_frame_equal(serial, resumed)
+    calls.clear()
+    assert fit(_fit_agent, _experiment_round, human, loss, grid, workers=0, cache=cache,
+               **kwargs).equals(serial)
+    assert not calls
+    with pytest.raises(ValueError):
+        fit(_fit_agent, _experiment_round, human, loss, grid, workers=0, cache=cache,
+            **dict(kwargs, seed=8))
+    # an interruption while writing may leave the last line incomplete
+    cache.write_text(cache.read_text()[:-10])
+    calls.clear()
+    resumed = fit(_fit_agent, _experiment_round, human, loss, grid, workers=0,
+                  cache=cache, **dict(kwargs, seed=None))
+    assert len(calls) == 1
+    pd.testing.assert_frame_equal(serial, resumed)
+    lines = cache.read_text().splitlines()
+    assert len(lines) == 10 and all(json.loads(line) for line in lines)
+    cache.write_text(lines[0][:5])
+    calls.clear()
+    pd.testing.assert_frame_equal(serial, fit(_fit_agent, _experiment_round, human, loss,
+                                              grid, workers=0, cache=cache, **kwargs))
+    assert len(calls) == 9 and len(cache.read_text().splitlines()) == 10
+    sampled = fit(_fit_agent, _experiment_round, human, loss,
+                  bounds={"noise": (0.1, 0.5), "decay": (0.2, 1.0)}, samples=5,
+                  workers=0, **kwargs)
+    assert len(sampled) == 5
+    assert sampled["noise"].between(0.1, 0.5).all() and sampled["decay"].between(0.2, 1).all()
+    assert sorted((sampled["noise"] - 0.1) // 0.08) == [0, 1, 2, 3, 4]
+    with pytest.raises(ValueError):
+        fit(_fit_agent, _experiment_round, human, loss)
+    with pytest.raises(ValueError):
+        fit(_fit_agent, _experiment_round, human, loss, grid, bounds={"noise": (0, 1)})
+    with pytest.raises(ValueError):
+        fit(_fit_agent, _experiment_round, human, loss, bounds={"noise": (1, 0)})
+
+
+def test_trace_likelihood():
+    import pandas as pd
+    def likelihood(agent, trials, temperature):
+        a = agent.fork()
+        total = 0
+        for offered, choice, outcome in trials:
+            _, data = a.choose(offered, details=True)
+            values = {d["choice"]: d["blended_value"] for d in data}
+            total += (values[choice] / temperature
+                      - math.log(sum(math.exp(v / temperature) for v in values.values())))
+            a.respond(outcome, choice)
+        return total
+    for engine in ("pyactup", "array"):
+        a = Agent(["button", "lit"], engine=engine, noise=0, temperature=1.5,
+                  mismatch_penalty=1)
+        a.similarity("lit", bounded_linear_similarity(0, 4))
+        a.populate([("left", 1), ("right", 2)], 4)
+        rnd = random.Random(0)
+        rows = []
+        # the participants' trials are interleaved
+        for t in range(12):
+            for subject in ("s2", "s1", "s3"):
+                offered = [("left", rnd.randint(1, 3)), ("right", 2)]
+                rows.append({"subject": subject, "offered": offered,
+                             "choice": rnd.choice(offered), "payoff": rnd.choice([0, 2, 5])})
+        df = pd.DataFrame(rows)
+        before = a.instances(None)
+        result = a.trace_likelihood(df, "choice", "payoff", choices_col="offered",
+                                    participant_col="subject")
+        assert a.instances(None) == before and a.time == 0
+        assert list(result.index) == ["s2", "s1", "s3"] and result.index.name == "subject"
+        for subject, value in result.items():
+            d = df[df.subject == subject]
+            assert isclose(value, likelihood(a, zip(d.offered, d.choice, d.payoff), 1.5))
+            assert isclose(value, a.trace_likelihood(d, "choice", "payoff",
+                                                     choices_col="offered"))
+        assert all(result < 0)
+        assert result.equals(a.trace_likelihood(df, "choice", "payoff", choices_col="offered",
+                                                participant_col="subject", workers=2))
+        hotter = a.trace_likelihood(df, "choice", "payoff", choices_col="offered",
+                                    participant_col="subject", temperature=100)
+        assert all(abs(hotter - 12 * math.log(0.5)) < 0.1)
+    a = Agent(noise=0, temperature=1, default_utility=10)
+    human = pd.DataFrame({"choice": ["safe", "risky", "safe"], "payoff": [3, 0, 3]})
+    assert isclose(a.trace_likelihood(human, "choice", "payoff"),
+                   likelihood(a, zip([["safe", "risky"]] * 3, human.choice, human.payoff), 1))
+    with pytest.raises(ValueError):
+        a.trace_likelihood(human, "choice", "outcome")
+    with pytest.raises(ValueError):
+        a.trace_likelihood(human, "choice", "payoff", ["safe", "other"])
+    empty = a.trace_likelihood(human.assign(subject=[1, 2, 3]).iloc[:0], "choice",
+                               "payoff", participant_col="subject")
+    assert len(empty) == 0 and empty.name == "log_likelihood" and empty.dtype == np.float64
+    with pytest.raises(ValueError, match="missing"):
+        a.trace_likelihood(human.assign(subject=[1, None, 2]), "choice", "payoff",
+                           participant_col="subject")
+    a.choose(["safe", "risky"])
+    with pytest.raises(RuntimeError):
+        a.trace_likelihood(human, "choice", "payoff")